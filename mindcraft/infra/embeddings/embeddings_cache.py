@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from mindcraft.infra.embeddings.embeddings_registry import EmbeddingsRegistry
+from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
+from mindcraft.settings import EMBEDDINGS_CACHE_MAX_ENTRIES, EMBEDDINGS_CACHE_MAX_BYTES
+
+
+class EmbeddingsCache:
+    """
+    Process-wide LRU cache of query embeddings, keyed by model and text. It is shared by all the stores, so the
+    interaction of a player is embedded once per turn (LTM, World, styles) and repeated phrases are never re-embedded.
+    """
+    _entries = OrderedDict()
+    _lock = threading.Lock()
+    _bytes = 0
+    _stats = {"hits": 0, "misses": 0, "evictions": 0}
+    max_entries = EMBEDDINGS_CACHE_MAX_ENTRIES
+    max_bytes = EMBEDDINGS_CACHE_MAX_BYTES
+
+    @classmethod
+    def get(cls, embeddings: EmbeddingsTypes, text: str):
+        """
+        Retrieves the embeddings of a text if they are cached
+        :param embeddings: one of EmbeddingsTypes
+        :param text: the text
+        :return: a float32 vector or None
+        """
+        key = (embeddings, text)
+        with cls._lock:
+            vector = cls._entries.get(key)
+            if vector is None:
+                cls._stats["misses"] += 1
+                return None
+            cls._entries.move_to_end(key)
+            cls._stats["hits"] += 1
+            return vector
+
+    @classmethod
+    def put(cls, embeddings: EmbeddingsTypes, text: str, vector: np.ndarray):
+        """
+        Stores the embeddings of a text, evicting the least recently used entries if the cache is full
+        :param embeddings: one of EmbeddingsTypes
+        :param text: the text
+        :param vector: the embeddings of the text
+        """
+        key = (embeddings, text)
+        vector = np.array(vector, dtype=np.float32).ravel()
+        vector.setflags(write=False)
+        with cls._lock:
+            previous = cls._entries.pop(key, None)
+            if previous is not None:
+                cls._bytes -= previous.nbytes
+            cls._entries[key] = vector
+            cls._bytes += vector.nbytes
+            while len(cls._entries) > 0 and (len(cls._entries) > cls.max_entries or cls._bytes > cls.max_bytes):
+                _, evicted = cls._entries.popitem(last=False)
+                cls._bytes -= evicted.nbytes
+                cls._stats["evictions"] += 1
+
+    @classmethod
+    def encode(cls, embeddings: EmbeddingsTypes, texts: list[str]) -> np.ndarray:
+        """
+        Returns the embeddings of `texts`, calculating in one batch only those which are not cached
+        :param embeddings: one of EmbeddingsTypes
+        :param texts: the texts
+        :return: a float32 matrix with one row per text
+        """
+        vectors = [cls.get(embeddings, text) for text in texts]
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if len(missing) > 0:
+            computed = dict(zip(missing, EmbeddingsRegistry.encode(embeddings, missing)))
+            for text, vector in computed.items():
+                cls.put(embeddings, text, vector)
+            vectors = [computed[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return np.vstack(vectors) if len(vectors) > 0 else np.empty((0, 0), dtype=np.float32)
+
+    @classmethod
+    def clear(cls):
+        """ Empties the cache"""
+        with cls._lock:
+            cls._entries.clear()
+            cls._bytes = 0
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        Statistics of the cache
+        :return: dictionary with `hits`, `misses`, `evictions`, number of `entries` and `bytes` used
+        """
+        with cls._lock:
+            stats = dict(cls._stats)
+            stats["entries"] = len(cls._entries)
+            stats["bytes"] = cls._bytes
+            return stats
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from mindcraft.infra.embeddings.embeddings_registry import EmbeddingsRegistry
+from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
+from mindcraft.settings import EMBEDDINGS_DATA_PATH, EMBEDDINGS_BATCH_SIZE
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows. The cache is then only safe to share between the threads of one process.
+    fcntl = None
+
+
+class EmbeddingsDiskCache:
+    """
+    Persistent, content-addressed cache of embeddings, keyed by (embeddings model, hash of the text). Vectors are
+    appended to a raw float32 file which is read memory-mapped, and the index is a compact file with one fixed-size
+    digest per row. Re-ingesting an unchanged (or slightly edited) book only calculates the embeddings of new chunks.
+    Several processes can share the same cache: appends are done under a file lock, and the rows appended by other
+    processes are read before looking up or appending texts.
+    """
+    DIGEST_SIZE = 16
+    _instances = dict()
+    _instances_lock = threading.Lock()
+
+    def __init__(self, embeddings: EmbeddingsTypes, path: str = EMBEDDINGS_DATA_PATH):
+        """
+        :param embeddings: one of EmbeddingsTypes. Each model has its own folder inside `path`
+        :param path: folder where to store the cache
+        """
+        self._embeddings = embeddings
+        self._path = os.path.join(path, embeddings.name.lower())
+        self._vectors_path = os.path.join(self._path, "vectors.f32")
+        self._index_path = os.path.join(self._path, "index.bin")
+        self._meta_path = os.path.join(self._path, "meta.json")
+        self._lock_path = os.path.join(self._path, "cache.lock")
+        self._lock = threading.Lock()
+        self._dim = None
+        self._index = dict()
+        self._rows = 0
+        self._vectors = None
+        if os.path.exists(self._meta_path):
+            with self._file_lock():
+                self._repair()
+                self._refresh()
+
+    @classmethod
+    def get_instance(cls, embeddings: EmbeddingsTypes, path: str = EMBEDDINGS_DATA_PATH):
+        """
+        Returns the cache of `embeddings` in `path`, opening it only once per process
+        :param embeddings: one of EmbeddingsTypes
+        :param path: folder where the cache is stored
+        """
+        key = (embeddings, os.path.realpath(path))
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = EmbeddingsDiskCache(embeddings, path)
+            return cls._instances[key]
+
+    def digest(self, text: str) -> bytes:
+        """
+        Content address of a text for the embeddings model of this cache
+        :param text: the text
+        :return: the digest of `DIGEST_SIZE` bytes
+        """
+        return hashlib.blake2b(f"{self._embeddings.value}\0{text}".encode("utf-8"),
+                               digest_size=self.DIGEST_SIZE).digest()
+
+    @contextmanager
+    def _file_lock(self):
+        """ Exclusive lock on the cache files, shared by all the processes using them"""
+        os.makedirs(self._path, exist_ok=True)
+        with open(self._lock_path, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _repair(self):
+        """
+        Truncates the index and the vectors to the rows present in both, e.g. after an interrupted write. Called under
+        the file lock, so that a write in progress in another process is not mistaken for an interrupted one.
+        """
+        with open(self._meta_path, "r") as f:
+            dim = json.load(f)["dim"]
+        index_size = os.path.getsize(self._index_path) if os.path.exists(self._index_path) else 0
+        vectors_size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        rows = min(index_size // self.DIGEST_SIZE, vectors_size // (4 * dim))
+        if rows * self.DIGEST_SIZE != index_size:
+            with open(self._index_path, "r+b") as f:
+                f.truncate(rows * self.DIGEST_SIZE)
+        if rows * 4 * dim != vectors_size:
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(rows * 4 * dim)
+
+    def _refresh(self):
+        """
+        Reads the rows appended to the index since it was last read, by this or another process. The vectors file is
+        always written before the index, so every indexed row has its vector.
+        """
+        if self._dim is None:
+            if not os.path.exists(self._meta_path):
+                return
+            with open(self._meta_path, "r") as f:
+                self._dim = json.load(f)["dim"]
+        if not os.path.exists(self._index_path):
+            return
+        rows = os.path.getsize(self._index_path) // self.DIGEST_SIZE
+        if rows <= self._rows:
+            return
+        with open(self._index_path, "rb") as f:
+            f.seek(self._rows * self.DIGEST_SIZE)
+            index = f.read((rows - self._rows) * self.DIGEST_SIZE)
+        for i in range(len(index) // self.DIGEST_SIZE):
+            self._index.setdefault(index[i * self.DIGEST_SIZE:(i + 1) * self.DIGEST_SIZE], self._rows + i)
+        self._rows += len(index) // self.DIGEST_SIZE
+
+    def _matrix(self) -> np.ndarray:
+        """ Read-only memory map of the vectors file"""
+        if self._vectors is None or self._vectors.shape[0] != self._rows:
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(self._rows, self._dim))
+        return self._vectors
+
+    def _append(self, digests: list[bytes], vectors: np.ndarray):
+        """
+        Appends new vectors under the file lock. The rows appended by other processes are read first, so that texts
+        they already stored are skipped and the new rows are numbered after the end of the files. The vectors file
+        is written before the index so an interrupted write never indexes a row which does not exist.
+        """
+        with self._file_lock():
+            self._refresh()
+            if self._dim is None:
+                self._dim = int(vectors.shape[1])
+                with open(self._meta_path, "w") as f:
+                    json.dump({"embeddings": self._embeddings.value, "dim": self._dim}, f)
+
+            new = [i for i, digest in enumerate(digests) if digest not in self._index]
+            if len(new) == 0:
+                return
+            digests = [digests[i] for i in new]
+            vectors = np.ascontiguousarray(vectors[new], dtype=np.float32)
+            with open(self._vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            with open(self._index_path, "ab") as f:
+                f.write(b"".join(digests))
+            self._refresh()
+
+    def encode(self, texts: list[str], batch_size: int = EMBEDDINGS_BATCH_SIZE) -> np.ndarray:
+        """
+        Returns the embeddings of `texts`, only calculating (and persisting) those which are not in the cache
+        :param texts: texts to calculate embeddings from
+        :param batch_size: number of texts sent to the model at once
+        :return: a float32 matrix with one row per text
+        """
+        digests = [self.digest(text) for text in texts]
+        with self._lock:
+            self._refresh()
+            missing = dict()
+            for digest, text in zip(digests, texts):
+                if digest not in self._index and digest not in missing:
+                    missing[digest] = text
+            if len(missing) > 0:
+                vectors = EmbeddingsRegistry.encode(self._embeddings, list(missing.values()), batch_size)
+                self._append(list(missing.keys()), vectors)
+            if len(texts) == 0:
+                return np.empty((0, self._dim if self._dim is not None else 0), dtype=np.float32)
+            rows = np.fromiter((self._index[digest] for digest in digests), dtype=np.int64, count=len(digests))
+            return np.array(self._matrix()[rows], dtype=np.float32)
+
+    def __contains__(self, text: str) -> bool:
+        """:return True if the embeddings of `text` are in the cache"""
+        with self._lock:
+            self._refresh()
+            return self.digest(text) in self._index
+
+    def __len__(self) -> int:
+        """:return number of vectors in the cache"""
+        with self._lock:
+            self._refresh()
+            return len(self._index)
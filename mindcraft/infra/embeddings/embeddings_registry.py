@@ -0,0 +1,96 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
+from mindcraft.settings import EMBEDDINGS_MAX_MODELS, LOGGER_FORMAT, DATE_FORMAT
+
+import logging
+
+logging.basicConfig(format=LOGGER_FORMAT, datefmt=DATE_FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingsRegistry:
+    """
+    Process-wide registry of embedding models. Every `Store` (world, LTM, styles...) of every NPC shares the same
+    loaded model for a given `EmbeddingsTypes`, so the model is constructed only once per process.
+    """
+    _models = OrderedDict()
+    _lock = threading.Lock()
+    _stats = {"loads": 0, "hits": 0, "evictions": 0}
+    max_models = EMBEDDINGS_MAX_MODELS
+
+    @classmethod
+    def get_model(cls, embeddings: EmbeddingsTypes):
+        """
+        Returns the model for `embeddings`, loading it if it was not loaded yet. If more than `max_models` are
+        loaded, the least recently used one is evicted.
+        :param embeddings: one of EmbeddingsTypes
+        :return: the SentenceTransformer model
+        """
+        with cls._lock:
+            if embeddings in cls._models:
+                cls._models.move_to_end(embeddings)
+                cls._stats["hits"] += 1
+                return cls._models[embeddings]
+
+            try:
+                from sentence_transformers import SentenceTransformer
+            except ImportError:
+                raise ImportError("`sentence_transformers` is required to calculate embeddings. To install it, type:\n"
+                                  "`pip install sentence_transformers`")
+
+            logger.info(f"Loading embeddings model {embeddings.value}")
+            model = SentenceTransformer(str(embeddings.value))
+            cls._models[embeddings] = model
+            cls._stats["loads"] += 1
+
+            while len(cls._models) > max(cls.max_models, 1):
+                evicted, _ = cls._models.popitem(last=False)
+                cls._stats["evictions"] += 1
+                logger.info(f"Evicted embeddings model {evicted.value}")
+
+            return model
+
+    @classmethod
+    def encode(cls, embeddings: EmbeddingsTypes, texts: list[str], batch_size: int = 32) -> np.ndarray:
+        """
+        Transforms a list of texts into embeddings using the shared model of `embeddings`
+        :param embeddings: one of EmbeddingsTypes
+        :param texts: texts to calculate embeddings from
+        :param batch_size: number of texts sent to the model at once
+        :return: a float32 matrix of shape (len(texts), dimensions)
+        """
+        model = cls.get_model(embeddings)
+        vectors = model.encode(list(texts), batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+        return np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+
+    @classmethod
+    def evict(cls, embeddings: EmbeddingsTypes = None):
+        """
+        Unloads a model from memory. If `embeddings` is None, all the models are unloaded.
+        :param embeddings: one of EmbeddingsTypes or None
+        """
+        with cls._lock:
+            keys = list(cls._models.keys()) if embeddings is None else [embeddings]
+            for key in keys:
+                if cls._models.pop(key, None) is not None:
+                    cls._stats["evictions"] += 1
+
+    @classmethod
+    def is_loaded(cls, embeddings: EmbeddingsTypes) -> bool:
+        """:return True if the model of `embeddings` is already loaded"""
+        return embeddings in cls._models
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        Loading statistics of the registry
+        :return: dictionary with the number of `loads`, `hits`, `evictions` and the names of the `loaded` models
+        """
+        with cls._lock:
+            stats = dict(cls._stats)
+            stats["loaded"] = [x.value for x in cls._models.keys()]
+            return stats
@@ -0,0 +1,192 @@
+import asyncio
+import json
+import time
+from typing import AsyncIterator
+
+from mindcraft.infra.engine.llm import LLM
+from mindcraft import settings
+from mindcraft.infra.prompts.templates.prompt_template import PromptTemplate
+from mindcraft.infra.engine.llm_types import LLMType
+
+import logging
+
+from mindcraft.settings import LOGGER_FORMAT, DATE_FORMAT, FAST_INFERENCE_POOL_SIZE, FAST_INFERENCE_CONNECT_TIMEOUT, \
+    FAST_INFERENCE_READ_TIMEOUT, FAST_INFERENCE_RETRIES, FAST_INFERENCE_BACKOFF
+
+logging.basicConfig(format=LOGGER_FORMAT, datefmt=DATE_FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class AsyncRemoteVLLM(LLM):
+    RETRY_STATUSES = (502, 503, 504)
+
+    def __init__(self,
+                 engine: LLMType = LLMType.ZEPHYR7B_AWQ,
+                 temperature: float = 0.8,
+                 pool_size: int = FAST_INFERENCE_POOL_SIZE,
+                 connect_timeout: float = FAST_INFERENCE_CONNECT_TIMEOUT,
+                 read_timeout: float = FAST_INFERENCE_READ_TIMEOUT,
+                 retries: int = FAST_INFERENCE_RETRIES,
+                 backoff: float = FAST_INFERENCE_BACKOFF):
+        """
+        Asyncio client of a remote vLLM server, the counterpart of `RemoteVLLM` for asyncio applications: answers
+        are async iterators, so one event loop can drive many conversations at once. Connections are kept alive
+        and reused.
+        :param engine: one of the LLMType engines to use.
+        :param temperature: temperature to use in generation
+        :param pool_size: max. number of connections kept open to the server
+        :param connect_timeout: seconds to wait for the connection to the server
+        :param read_timeout: max. seconds to wait for the server between two chunks of the answer
+        :param retries: times a request is retried if the server could not be reached or was unavailable
+        (502, 503, 504). Requests are never retried once the server started answering.
+        :param backoff: backoff factor of the retries: they wait `backoff * 2 ** (retry - 1)` seconds
+        """
+        super().__init__(engine, temperature)
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImportError("`aiohttp` is required for the asyncio client. To install it, type:\n"
+                              "`pip install aiohttp`")
+        self._aiohttp = aiohttp
+        self._pool_size = pool_size
+        self._timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self._retries = max(retries, 0)
+        self._backoff = backoff
+        self._session = None
+        self._loop = None
+
+    def _get_session(self):
+        """
+        The session is created the first time it is needed, as it belongs to the running event loop. It is created
+        again when called from another event loop (e.g. a second `asyncio.run`).
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is not None and self._loop is not loop:
+            # The session of the old loop cannot be closed from this one: its connections are left to the garbage
+            # collector
+            self._session.detach()
+            self._session = None
+        if self._session is None or self._session.closed:
+            self._loop = loop
+            connector = self._aiohttp.TCPConnector(limit=self._pool_size)
+            self._session = self._aiohttp.ClientSession(connector=connector,
+                                                        timeout=self._timeout,
+                                                        headers={"User-Agent": "mindcraft"})
+        return self._session
+
+    async def _post(self, request: dict):
+        """
+        Sends a request, retrying it with exponential backoff if the server could not be reached or was unavailable
+        :param request: body of the request
+        :return: the aiohttp response
+        """
+        retry = 0
+        while True:
+            try:
+                response = await self._get_session().post(settings.FAST_INFERENCE_URL, json=request)
+                if response.status not in self.RETRY_STATUSES or retry >= self._retries:
+                    response.raise_for_status()
+                    return response
+                response.release()
+            except self._aiohttp.ClientConnectionError:
+                if retry >= self._retries:
+                    raise
+            retry += 1
+            await asyncio.sleep(self._backoff * 2 ** (retry - 1))
+
+    @staticmethod
+    def _parse(chunk: bytes) -> list[str]:
+        """ Texts of the choices of a chunk of the response"""
+        data = json.loads(chunk.decode("utf-8"))
+        if 'choices' not in data:
+            raise Exception(f"`choices` field not found in response. Response: {data}")
+        texts = []
+        for choice in data['choices']:
+            if 'text' not in choice:
+                raise Exception(f"`text` field not found in choice. Response: {data}")
+            texts.append(choice["text"])
+        return texts
+
+    async def agenerate(self,
+                        prompt: str,
+                        max_tokens: int = 100,
+                        do_sample: bool = True,
+                        streaming: bool = False) -> AsyncIterator[str]:
+        """
+        Sends a prompt to the LLM. You can specify the max. number of tokens to retrieve and if you do sampling when
+        generating the text.
+        :param prompt: the prompt to use
+        :param max_tokens: max tokens to receive
+        :param do_sample: apply stochastic selection of tokens to prevent always generating the same wording.
+        :param streaming: yield the text as it comes from the server, instead of the whole answer at the end
+        :return: an async iterator to the text of the answer
+        """
+        request = {
+            "model": self.llm_type.value['name'],
+            "prompt": prompt,
+            "stream": streaming,
+            "max_tokens": max_tokens,
+            "use_beam_search": not do_sample,
+            "temperature": self.temperature
+        }
+        start = time.perf_counter()
+        ttft = None
+        chunks = []
+        response = await self._post(request)
+        try:
+            # The chunks of the answer are delimited by `\0`, and may be split across several reads
+            buffer = b""
+            async for data in response.content.iter_any():
+                buffer += data
+                *complete, buffer = buffer.split(b"\0")
+                for chunk in complete:
+                    if not chunk:
+                        continue
+                    for output in self._parse(chunk):
+                        if streaming:
+                            if ttft is None:
+                                ttft = time.perf_counter() - start
+                            yield output
+                        else:
+                            chunks.append(output)
+            if buffer.strip():
+                for output in self._parse(buffer):
+                    if streaming:
+                        yield output
+                    else:
+                        chunks.append(output)
+        finally:
+            response.release()
+
+        elapsed = time.perf_counter() - start
+        self.latency_stats.record(ttft if ttft is not None else elapsed, elapsed)
+        if not streaming:
+            yield "".join(chunks)
+
+    async def aretrieve_answer(self,
+                               prompt: str,
+                               max_tokens: int = 100,
+                               do_sample: bool = True,
+                               prompt_template: PromptTemplate = PromptTemplate.ALPACA,
+                               streaming: bool = False) -> AsyncIterator[str]:
+        """
+        Sends a prompt to the LLM. You can specify the max. number of tokens to retrieve and if you do sampling when
+        generating the text.
+        :param prompt: the prompt to use
+        :param max_tokens: max tokens to receive
+        :param do_sample: apply stochastic selection of tokens to prevent always generating the same wording.
+        :param prompt_template: the answer usually comes inside the prompt itself, so we need to parse it, for which
+        we need the reference to the template used
+        :param streaming: yield the text as it comes from the server. The text is not cleaned then.
+        :return: an async iterator to the text of the answer
+        """
+        response_placeholder = prompt_template.value['response']
+        async for chunk in self.agenerate(prompt, max_tokens, do_sample, streaming):
+            yield chunk if streaming else self.clean(chunk, response_placeholder)
+
+    async def close(self):
+        """ Closes the connections to the server"""
+        if self._session is not None:
+            if self._loop is asyncio.get_running_loop():
+                await self._session.close()
+            self._session, self._loop = None, None
@@ -0,0 +1,61 @@
+import threading
+from collections import deque
+from typing import Optional
+
+import numpy as np
+
+from mindcraft.settings import LATENCY_STATS_WINDOW
+
+
+class LatencyStats:
+    def __init__(self, window: int = LATENCY_STATS_WINDOW):
+        """
+        Latencies of the last generations of an LLM: time to first token (TTFT), total time and number of tokens
+        generated.
+        :param window: number of generations kept to calculate the statistics
+        """
+        self._lock = threading.Lock()
+        self._ttft = deque(maxlen=max(window, 1))
+        self._total = deque(maxlen=max(window, 1))
+        self._tokens = deque(maxlen=max(window, 1))
+        self._count = 0
+
+    def record(self, ttft: float, total: float, tokens: Optional[int] = None):
+        """
+        Records a generation
+        :param ttft: seconds until the first chunk of text was available
+        :param total: seconds until the whole answer was available
+        :param tokens: number of tokens generated, if known
+        """
+        with self._lock:
+            self._ttft.append(ttft)
+            self._total.append(total)
+            if tokens is not None:
+                self._tokens.append((tokens, total))
+            self._count += 1
+
+    def __len__(self) -> int:
+        """ Number of generations recorded"""
+        with self._lock:
+            return self._count
+
+    def stats(self) -> dict:
+        """
+        Statistics of the last generations
+        :return: dictionary with the number of generations (`count`), the mean and p95 TTFT and total time, in
+        milliseconds, and the mean `tokens_per_second`
+        """
+        with self._lock:
+            ttft = np.asarray(self._ttft, dtype=np.float64) * 1000
+            total = np.asarray(self._total, dtype=np.float64) * 1000
+            tokens = list(self._tokens)
+            count = self._count
+        throughput = [n / t for n, t in tokens if t > 0]
+        return {
+            "count": count,
+            "ttft_mean_ms": float(np.mean(ttft)) if len(ttft) > 0 else 0.0,
+            "ttft_p95_ms": float(np.percentile(ttft, 95)) if len(ttft) > 0 else 0.0,
+            "total_mean_ms": float(np.mean(total)) if len(total) > 0 else 0.0,
+            "total_p95_ms": float(np.percentile(total, 95)) if len(total) > 0 else 0.0,
+            "tokens_per_second": float(np.mean(throughput)) if len(throughput) > 0 else 0.0
+        }
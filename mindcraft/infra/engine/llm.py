@@ -4,6 +4,7 @@ from typing import Union, Iterator
 import torch
 
 from mindcraft.infra.prompts.templates.prompt_template import PromptTemplate
+from mindcraft.infra.engine.latency_stats import LatencyStats
 from mindcraft.infra.engine.llm_types import LLMType
 
 
@@ -13,12 +14,13 @@ class LLM:
                  temperature: float = 0.8):
         """
         Large Language Model class, in charge of executing a prompt and retrieving an answer for the LLM. Used to
-        generate the answers of the NPCs.
+        generate the answers of the NPCs. The latencies of the generations are kept in `latency_stats`.
         :param llm_type: one of the LLMType engines to use.
         """
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.llm_type = llm_type
         self.temperature = temperature
+        self.latency_stats = LatencyStats()
 
     def __call__(self,
                  prompt: str,
@@ -56,6 +58,25 @@ class LLM:
         """
         raise NotImplementedError()
 
+    def retrieve_answers(self,
+                         prompts: list[str],
+                         max_tokens: Union[int, list[int]] = 100,
+                         do_sample: Union[bool, list[bool]] = True,
+                         prompt_template: PromptTemplate = PromptTemplate.ALPACA) -> list[str]:
+        """
+        Sends several prompts to the LLM. Engines which can batch them override this method, by default they are
+        sent one after another.
+        :param prompts: the prompts to use
+        :param max_tokens: max tokens to receive, for all the prompts or one per prompt
+        :param do_sample: apply stochastic selection of tokens, for all the prompts or one per prompt
+        :param prompt_template: the template used in the prompts, to parse the answers
+        :return: the answers, in the same order as the prompts
+        """
+        max_tokens = max_tokens if isinstance(max_tokens, list) else [max_tokens] * len(prompts)
+        do_sample = do_sample if isinstance(do_sample, list) else [do_sample] * len(prompts)
+        return ["".join(self.retrieve_answer(prompt, max_tokens[i], do_sample[i], prompt_template))
+                for i, prompt in enumerate(prompts)]
+
     @staticmethod
     def clean(answer: str, response_placeholder: str) -> str:
         """
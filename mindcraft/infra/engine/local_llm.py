@@ -1,28 +1,48 @@
+import threading
+import time
 from typing import Union, Iterator
 
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer, StoppingCriteria, \
+    StoppingCriteriaList
 
 from mindcraft.infra.prompts.templates.prompt_template import PromptTemplate
 from mindcraft.infra.engine.llm import LLM
 from mindcraft.infra.engine.llm_types import LLMType
+from mindcraft.infra.engine.serving.batch_scheduler import BatchScheduler
 
 import logging
 
-from mindcraft.settings import LOGGER_FORMAT, DATE_FORMAT
+from mindcraft.settings import LOGGER_FORMAT, DATE_FORMAT, LLM_MAX_BATCH_SIZE, LLM_MAX_WAIT
 
 logging.basicConfig(format=LOGGER_FORMAT, datefmt=DATE_FORMAT, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+class _StopOnEvent(StoppingCriteria):
+    def __init__(self, event: threading.Event):
+        """ Stops `generate` once `event` is set, e.g. when the consumer of a stream stopped reading it"""
+        self._event = event
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self._event.is_set()
+
+
 class LocalLLM(LLM):
     def __init__(self,
                  llm_type: LLMType = LLMType.ZEPHYR7B_AWQ,
-                 temperature: float = 0.8):
+                 temperature: float = 0.8,
+                 batching: bool = False,
+                 max_batch_size: int = LLM_MAX_BATCH_SIZE,
+                 max_wait: float = LLM_MAX_WAIT):
         """
         Large Language Model class, in charge of executing a prompt and retrieving an answer for the LLM. Used to
         generate the answers of the NPCs.
         :param llm_type: one of the LLMType engines to use.
         :param temperature: temperature to use in generation
+        :param batching: generate the answers of concurrent calls together, with continuous batching (see
+        `BatchScheduler`)
+        :param max_batch_size: max. number of answers generated at once when batching
+        :param max_wait: max. seconds to wait for more prompts before starting a new batch
         """
         super().__init__(llm_type, temperature)
         self.model = AutoModelForCausalLM.from_pretrained(llm_type.value['name'],
@@ -31,6 +51,7 @@ class LocalLLM(LLM):
         self.tokenizer = AutoTokenizer.from_pretrained(llm_type.value['name'],
                                                        device_map=self.device,
                                                        trust_remote_code=True)
+        self.scheduler = BatchScheduler(self, max_batch_size, max_wait) if batching else None
 
     def __call__(self,
                  prompt: str,
@@ -44,21 +65,70 @@ class LocalLLM(LLM):
         :param prompt: the prompt to use
         :param max_tokens: max tokens to receive
         :param do_sample: apply stochastic selection of tokens to prevent always generating the same wording.
-        :param streaming: apply streaming if available (a text iterator will be returned instead of the text)
-        Default: true
+        :param streaming: yield the generated text as it comes, while the model generates it in a worker thread.
+        The time to first token is logged and recorded in `latency_stats`.
         :return: an iterator to the text of the answer (streaming=True) or the answer (streaming=False)
         """
 
-        if streaming:
-            logging.info("Streaming was ignored as it's not available for non-fast LLM inference. Use `fast=True`.")
+        if self.scheduler is not None:
+            chunks = self.scheduler.submit(prompt, max_tokens, do_sample)
+            if streaming:
+                yield from chunks
+            else:
+                yield "".join(chunks)
+            return
 
+        start = time.perf_counter()
         model_inputs = self.tokenizer([prompt], return_tensors="pt").to(self.device)
         self.model.to(self.device)
 
-        generated_ids = self.model.generate(**model_inputs,
-                                            max_new_tokens=max_tokens,
-                                            do_sample=do_sample)
-        yield self.tokenizer.batch_decode(generated_ids)[0]
+        if not streaming:
+            generated_ids = self.model.generate(**model_inputs,
+                                                max_new_tokens=max_tokens,
+                                                do_sample=do_sample)
+            elapsed = time.perf_counter() - start
+            self.latency_stats.record(elapsed, elapsed, generated_ids.shape[1] - model_inputs["input_ids"].shape[1])
+            yield self.tokenizer.batch_decode(generated_ids)[0]
+            return
+
+        # `generate` runs in a worker thread, which feeds the decoded text to the streamer as tokens are generated
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        stop = threading.Event()
+        generation = {}
+
+        def generate():
+            try:
+                generation["ids"] = self.model.generate(**model_inputs,
+                                                        max_new_tokens=max_tokens,
+                                                        do_sample=do_sample,
+                                                        streamer=streamer,
+                                                        stopping_criteria=StoppingCriteriaList([_StopOnEvent(stop)]))
+            except Exception as e:
+                generation["error"] = e
+                # Unblocks the consumer
+                streamer.end()
+
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        try:
+            ttft = None
+            for text in streamer:
+                if len(text) == 0:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                    logger.info(f"Time to first token: {ttft * 1000:.0f} ms")
+                yield text
+            thread.join()
+        finally:
+            # If the consumer stops iterating, the worker stops generating at the next token
+            stop.set()
+        if "error" in generation:
+            raise generation["error"]
+
+        elapsed = time.perf_counter() - start
+        tokens = generation["ids"].shape[1] - model_inputs["input_ids"].shape[1]
+        self.latency_stats.record(ttft if ttft is not None else elapsed, elapsed, tokens)
 
     def retrieve_answer(self,
                         prompt: str,
@@ -78,6 +148,10 @@ class LocalLLM(LLM):
         :return: the answer
         """
         response_placeholder = self.llm_type.value['template'].value['response']
-        for chunk in self.__call__(prompt, max_tokens, do_sample):
-            yield self.clean(chunk, response_placeholder)
+        for chunk in self.__call__(prompt, max_tokens, do_sample, streaming=streaming):
+            if streaming:
+                # Only the generated text is streamed, without the prompt nor special tokens
+                yield chunk
+            else:
+                yield self.clean(chunk, response_placeholder)
 
@@ -29,7 +29,7 @@ class LocalVLLM(LLM):
             raise ImportError("`vllm` is required for Fast Inference. To install it, type:\n"
                               "`pip install vllm`")
 
-        self.sampling_params = SamplingParams(temperature=self.temperature)
+        self._sampling_params_type = SamplingParams
         self.llm = LLM(model=self.llm_type.value['name'],
                        trust_remote_code=True,
                        dtype='float16',
@@ -55,10 +55,44 @@ class LocalVLLM(LLM):
         if streaming:
             logging.info("To return the output in streaming with Fast Inference and vLLM, use `remote=True`.")
 
-        prompts = [prompt]
-        response = self.llm.generate(prompts, self.sampling_params)
+        yield self.generate_many([prompt], max_tokens, do_sample)[0]
 
-        yield response[0].outputs[0].text
+    def sampling_params_for(self, max_tokens: int = 100, do_sample: bool = True):
+        """
+        Sampling parameters of a request
+        :param max_tokens: max tokens to receive
+        :param do_sample: apply stochastic selection of tokens. If False, the most likely tokens are taken (greedy).
+        :return: vLLM SamplingParams
+        """
+        return self._sampling_params_type(temperature=self.temperature if do_sample else 0, max_tokens=max_tokens)
+
+    def generate_many(self,
+                      prompts: list[str],
+                      max_tokens: Union[int, list[int]] = 100,
+                      do_sample: Union[bool, list[bool]] = True) -> list[str]:
+        """
+        Sends several prompts to vLLM in one `generate` call, so that they are batched by the engine.
+        :param prompts: the prompts to use
+        :param max_tokens: max tokens to receive, for all the prompts or one per prompt
+        :param do_sample: apply stochastic selection of tokens, for all the prompts or one per prompt
+        :return: the answers (raw text), in the same order as the prompts
+        """
+        if len(prompts) == 0:
+            return []
+        max_tokens = max_tokens if isinstance(max_tokens, list) else [max_tokens] * len(prompts)
+        do_sample = do_sample if isinstance(do_sample, list) else [do_sample] * len(prompts)
+        if len(max_tokens) != len(prompts) or len(do_sample) != len(prompts):
+            raise Exception("`max_tokens` and `do_sample` should have one value per prompt")
+
+        settings = list(zip(max_tokens, do_sample))
+        if len(set(settings)) == 1:
+            sampling_params = self.sampling_params_for(*settings[0])
+        else:
+            sampling_params = [self.sampling_params_for(*x) for x in settings]
+        responses = self.llm.generate(prompts, sampling_params, use_tqdm=False)
+        # vLLM finishes the requests in any order: they are returned in the order they were submitted
+        responses = sorted(responses, key=lambda x: int(x.request_id))
+        return [x.outputs[0].text for x in responses]
 
     def retrieve_answer(self,
                         prompt: str,
@@ -80,3 +114,19 @@ class LocalVLLM(LLM):
         response_placeholder = self.llm_type.value['template'].value['response']
         for chunk in self.__call__(prompt, max_tokens, do_sample):
             yield self.clean(chunk, response_placeholder)
+
+    def retrieve_answers(self,
+                         prompts: list[str],
+                         max_tokens: Union[int, list[int]] = 100,
+                         do_sample: Union[bool, list[bool]] = True,
+                         prompt_template: PromptTemplate = PromptTemplate.ALPACA) -> list[str]:
+        """
+        Sends several prompts to the LLM at once, in a single vLLM batch.
+        :param prompts: the prompts to use
+        :param max_tokens: max tokens to receive, for all the prompts or one per prompt
+        :param do_sample: apply stochastic selection of tokens, for all the prompts or one per prompt
+        :param prompt_template: the template used in the prompts, to parse the answers
+        :return: the answers, in the same order as the prompts
+        """
+        response_placeholder = self.llm_type.value['template'].value['response']
+        return [self.clean(x, response_placeholder) for x in self.generate_many(prompts, max_tokens, do_sample)]
@@ -1,7 +1,10 @@
 import json
+import time
 from typing import Iterator, Union
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from mindcraft.infra.engine.llm import LLM
 from mindcraft import settings
@@ -10,7 +13,8 @@ from mindcraft.infra.engine.llm_types import LLMType
 
 import logging
 
-from mindcraft.settings import LOGGER_FORMAT, DATE_FORMAT
+from mindcraft.settings import LOGGER_FORMAT, DATE_FORMAT, FAST_INFERENCE_POOL_SIZE, FAST_INFERENCE_CONNECT_TIMEOUT, \
+    FAST_INFERENCE_READ_TIMEOUT, FAST_INFERENCE_RETRIES, FAST_INFERENCE_BACKOFF
 
 logging.basicConfig(format=LOGGER_FORMAT, datefmt=DATE_FORMAT, level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -19,14 +23,40 @@ logger = logging.getLogger(__name__)
 class RemoteVLLM(LLM):
     def __init__(self,
                  engine: LLMType = LLMType.ZEPHYR7B_AWQ,
-                 temperature: float = 0.8):
+                 temperature: float = 0.8,
+                 pool_size: int = FAST_INFERENCE_POOL_SIZE,
+                 connect_timeout: float = FAST_INFERENCE_CONNECT_TIMEOUT,
+                 read_timeout: float = FAST_INFERENCE_READ_TIMEOUT,
+                 retries: int = FAST_INFERENCE_RETRIES,
+                 backoff: float = FAST_INFERENCE_BACKOFF):
         """
         Large Language Model class, in charge of executing a prompt and retrieving an answer for the LLM. Used to
         generate the answers of the NPCs.
+        Requests go through a keep-alive session, so that the connections to the server are reused.
         :param engine: one of the LLMType engines to use.
         :param temperature: temperature to use in generation
+        :param pool_size: max. number of connections kept open to the server
+        :param connect_timeout: seconds to wait for the connection to the server
+        :param read_timeout: max. seconds to wait for the server between two chunks of the answer
+        :param retries: times a request is retried if the server could not be reached or was unavailable
+        (502, 503, 504). Requests are never retried once the server started answering.
+        :param backoff: backoff factor of the retries: they wait `backoff * 2 ** (retry - 1)` seconds
         """
         super().__init__(engine, temperature)
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(total=retries,
+                      connect=retries,
+                      read=0,
+                      status=retries,
+                      backoff_factor=backoff,
+                      status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(["POST"]),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers.update({"User-Agent": "mindcraft"})
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def __call__(self,
                  prompt: str,
@@ -43,7 +73,6 @@ class RemoteVLLM(LLM):
         Default: true
         :return: the answer
         """
-        headers = {"User-Agent": "mindcraft"}
         request = {
             "model": self.llm_type.value['name'],
             "prompt": prompt,
@@ -52,31 +81,45 @@ class RemoteVLLM(LLM):
             "use_beam_search": not do_sample,
             "temperature": self.temperature
         }
-        response = requests.post(settings.FAST_INFERENCE_URL,
-                                 headers=headers,
-                                 json=request,
-                                 stream=streaming)
-
+        start = time.perf_counter()
+        ttft = None
+        tokens = None
         chunks = []
-        for chunk in response.iter_lines(chunk_size=8192,
-                                         decode_unicode=False,
-                                         delimiter=b"\0"):
-            if chunk:
-                data = json.loads(chunk.decode("utf-8"))
-                if 'choices' not in data:
-                    raise Exception(f"`choices` field not found in response. Response: {data}")
-                for choice in data['choices']:
-                    if 'text' not in choice:
-                        raise Exception(f"`text` field not found in choice. Response: {data}")
-                    output = choice["text"]
-                    if streaming:
-                        yield output
-                    else:
-                        chunks.append(output)
+        # The response is closed even if the caller stops iterating, so that its connection goes back to the pool
+        with self.session.post(settings.FAST_INFERENCE_URL,
+                               json=request,
+                               stream=streaming,
+                               timeout=self.timeout) as response:
+            response.raise_for_status()
+            for chunk in response.iter_lines(chunk_size=8192,
+                                             decode_unicode=False,
+                                             delimiter=b"\0"):
+                if chunk:
+                    data = json.loads(chunk.decode("utf-8"))
+                    if 'choices' not in data:
+                        raise Exception(f"`choices` field not found in response. Response: {data}")
+                    if data.get('usage') is not None:
+                        tokens = data['usage'].get('completion_tokens', tokens)
+                    for choice in data['choices']:
+                        if 'text' not in choice:
+                            raise Exception(f"`text` field not found in choice. Response: {data}")
+                        output = choice["text"]
+                        if streaming:
+                            if ttft is None:
+                                ttft = time.perf_counter() - start
+                            yield output
+                        else:
+                            chunks.append(output)
 
+        elapsed = time.perf_counter() - start
+        self.latency_stats.record(ttft if ttft is not None else elapsed, elapsed, tokens)
         if not streaming:
             yield "".join(chunks)
 
+    def close(self):
+        """ Closes the connections to the server"""
+        self.session.close()
+
     def retrieve_answer(self,
                         prompt: str,
                         max_tokens: int = 100,
@@ -95,7 +138,7 @@ class RemoteVLLM(LLM):
         :return: an iterator to the text of the answer (streaming=True) or the answer (streaming=False)
         """
         response_placeholder = prompt_template.value['response']
-        for chunk in self.__call__(prompt, max_tokens, do_sample):
+        for chunk in self.__call__(prompt, max_tokens, do_sample, streaming):
             if streaming:
                 logger.info("Streaming disabled any post-processing cleaning task as the text is returned on the fly")
                 yield chunk
@@ -0,0 +1,268 @@
+import queue
+import threading
+import time
+from typing import Iterator, Optional
+
+import torch
+
+from mindcraft.settings import LLM_MAX_BATCH_SIZE, LLM_MAX_WAIT, LOGGER_FORMAT, DATE_FORMAT
+
+import logging
+
+logging.basicConfig(format=LOGGER_FORMAT, datefmt=DATE_FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class _Request:
+    _END = object()
+
+    def __init__(self, prompt: str, max_tokens: int, do_sample: bool, temperature: float):
+        """ A prompt submitted to the scheduler, with the queue where its text is streamed"""
+        self.prompt = prompt
+        self.max_tokens = max_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.tokens = []
+        self.text = ""
+        self.chunks = queue.Queue()
+        self.cancelled = threading.Event()
+        self.submitted = time.perf_counter()
+        self.first_token = None
+
+
+class BatchScheduler:
+    def __init__(self, llm, max_batch_size: int = LLM_MAX_BATCH_SIZE, max_wait: float = LLM_MAX_WAIT):
+        """
+        Continuous batching in front of a `LocalLLM`. A worker thread owns the model and decodes all the active
+        sequences at once, one token per step. Prompts submitted concurrently are prefilled together (left padded)
+        and admitted into the running batch between decoding steps, whose KV cache is padded to the same length.
+        Finished sequences leave the batch right away, so a long answer does not hold back the rest, and so do the
+        sequences whose answer is not iterated anymore. The tokenizer of the LLM is not modified: prompts are left
+        padded by the scheduler itself.
+        :param llm: the LocalLLM, with its `model` and `tokenizer`
+        :param max_batch_size: max. number of sequences decoded at once
+        :param max_wait: max. seconds to wait for more prompts before starting a batch from scratch
+        """
+        self._llm = llm
+        self._tokenizer = llm.tokenizer
+        self._max_batch_size = max(max_batch_size, 1)
+        self._max_wait = max_wait
+        self._pending = queue.Queue()
+        self._closed = threading.Event()
+        # State of the running batch, one row per active request
+        self._active = []
+        self._past = None
+        self._mask = None
+        self._positions = None
+        self._logits = None
+        self._thread = threading.Thread(target=self._run, daemon=True, name="batch-scheduler")
+        self._thread.start()
+
+    def submit(self,
+               prompt: str,
+               max_tokens: int = 100,
+               do_sample: bool = True,
+               temperature: Optional[float] = None) -> Iterator[str]:
+        """
+        Queues a prompt and streams back its answer
+        :param prompt: the prompt to use
+        :param max_tokens: max tokens to generate
+        :param do_sample: sample the tokens instead of taking the most likely one
+        :param temperature: temperature of the sampling. By default, the one of the LLM.
+        :return: an iterator to the text of the answer, as it is generated. Closing it (or stopping iterating it
+        before the end) cancels the request, which leaves the batch at the next decoding step.
+        """
+        if self._closed.is_set():
+            raise Exception("The batch scheduler is closed")
+        request = _Request(prompt, max_tokens, do_sample, temperature if temperature is not None
+                           else self._llm.temperature)
+        self._pending.put(request)
+        try:
+            while True:
+                chunk = request.chunks.get()
+                if chunk is _Request._END:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            request.cancelled.set()
+
+    def close(self):
+        """ Stops the worker thread once the active sequences are finished"""
+        self._closed.set()
+        self._pending.put(None)
+        self._thread.join()
+        while not self._pending.empty():
+            request = self._pending.get_nowait()
+            if request is not None:
+                request.chunks.put(Exception("The batch scheduler is closed"))
+
+    def _run(self):
+        """ Worker loop: admits pending requests, then decodes one token of every active sequence"""
+        while not (self._closed.is_set() and len(self._active) == 0):
+            admitted = [x for x in self._collect() if not x.cancelled.is_set()]
+            try:
+                with torch.inference_mode():
+                    if len(admitted) > 0:
+                        self._admit(admitted)
+                    if len(self._active) > 0:
+                        self._step()
+            except Exception as e:
+                logger.error(f"Batch generation failed: {e}")
+                for request in self._active + [x for x in admitted if x not in self._active]:
+                    request.chunks.put(e)
+                self._active, self._past, self._mask, self._positions, self._logits = [], None, None, None, None
+
+    def _collect(self) -> list[_Request]:
+        """
+        Takes the pending requests which fit in the batch. When nothing is running, it blocks until a request
+        arrives and then waits `max_wait` seconds for more.
+        """
+        free = self._max_batch_size - len(self._active)
+        admitted = []
+        if len(self._active) == 0:
+            request = self._pending.get()
+            if request is None:
+                return admitted
+            admitted.append(request)
+            deadline = time.perf_counter() + self._max_wait
+            while len(admitted) < free:
+                remaining = deadline - time.perf_counter()
+                try:
+                    request = self._pending.get(timeout=remaining) if remaining > 0 else self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not None:
+                    admitted.append(request)
+        else:
+            while len(admitted) < free:
+                try:
+                    request = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not None:
+                    admitted.append(request)
+        return admitted
+
+    @staticmethod
+    def _legacy(past) -> tuple:
+        """ KV cache as a tuple of (key, value) per layer, with shape [batch, heads, length, dim]"""
+        return past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+
+    def _tokenize(self, prompts: list[str]) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Tokenizes the prompts one by one and left pads them to the same length
+        :return: the input ids and the attention mask
+        """
+        ids = [self._tokenizer([x], return_tensors="pt")["input_ids"][0] for x in prompts]
+        length = max(len(x) for x in ids)
+        pad = self._tokenizer.pad_token_id if self._tokenizer.pad_token_id is not None \
+            else self._tokenizer.eos_token_id
+        input_ids = torch.full((len(ids), length), pad, dtype=torch.long)
+        mask = torch.zeros((len(ids), length), dtype=torch.long)
+        for i, x in enumerate(ids):
+            input_ids[i, length - len(x):] = x
+            mask[i, length - len(x):] = 1
+        return input_ids.to(self._llm.device), mask.to(self._llm.device)
+
+    @staticmethod
+    def _left_pad(past: tuple, mask: torch.Tensor, length: int) -> tuple[tuple, torch.Tensor]:
+        """ Left pads a KV cache and its attention mask up to `length` positions"""
+        pad = length - mask.shape[1]
+        if pad == 0:
+            return past, mask
+        mask = torch.nn.functional.pad(mask, (pad, 0), value=0)
+        past = tuple(tuple(torch.nn.functional.pad(x, (0, 0, pad, 0), value=0) for x in layer) for layer in past)
+        return past, mask
+
+    def _admit(self, requests: list[_Request]):
+        """ Prefills the prompts of new requests and merges them into the running batch"""
+        model = self._llm.model
+        input_ids, mask = self._tokenize([x.prompt for x in requests])
+        positions = (mask.cumsum(dim=1) - 1).clamp(min=0)
+        output = model(input_ids=input_ids, attention_mask=mask, position_ids=positions, use_cache=True)
+        past = self._legacy(output.past_key_values)
+        logits = output.logits[:, -1, :]
+        next_positions = positions[:, -1] + 1
+
+        if len(self._active) == 0:
+            self._past, self._mask, self._positions, self._logits = past, mask, next_positions, logits
+        else:
+            length = max(self._mask.shape[1], mask.shape[1])
+            self._past, self._mask = self._left_pad(self._past, self._mask, length)
+            past, mask = self._left_pad(past, mask, length)
+            self._past = tuple(tuple(torch.cat([a, b], dim=0) for a, b in zip(old, new))
+                               for old, new in zip(self._past, past))
+            self._mask = torch.cat([self._mask, mask], dim=0)
+            self._positions = torch.cat([self._positions, next_positions], dim=0)
+            self._logits = torch.cat([self._logits, logits], dim=0)
+        self._active.extend(requests)
+
+    def _sample(self) -> torch.Tensor:
+        """ Picks the next token of every active sequence from the last logits"""
+        logits = self._logits.float()
+        greedy = logits.argmax(dim=-1)
+        temperatures = torch.tensor([max(x.temperature, 1e-5) for x in self._active], device=logits.device)
+        probabilities = torch.softmax(logits / temperatures[:, None], dim=-1)
+        sampled = torch.multinomial(probabilities, num_samples=1).squeeze(1)
+        do_sample = torch.tensor([x.do_sample for x in self._active], device=logits.device)
+        return torch.where(do_sample, sampled, greedy)
+
+    def _step(self):
+        """ Streams one new token of every active sequence, removes the finished ones and runs the next forward"""
+        tokens = self._sample()
+        eos = self._tokenizer.eos_token_id
+        keep = []
+        for row, (request, token) in enumerate(zip(self._active, tokens.tolist())):
+            if request.cancelled.is_set():
+                # Nobody reads the answer anymore
+                continue
+            finished = token == eos
+            if not finished:
+                request.tokens.append(token)
+                # Decoding the whole answer keeps the characters split across several tokens right
+                text = self._tokenizer.decode(request.tokens, skip_special_tokens=True)
+                if len(text) > len(request.text):
+                    if request.first_token is None:
+                        request.first_token = time.perf_counter()
+                    request.chunks.put(text[len(request.text):])
+                    request.text = text
+                finished = len(request.tokens) >= request.max_tokens
+            if finished:
+                self._finish(request)
+            else:
+                keep.append(row)
+
+        if len(keep) < len(self._active):
+            self._active = [self._active[i] for i in keep]
+            if len(keep) == 0:
+                self._past, self._mask, self._positions, self._logits = None, None, None, None
+                return
+            index = torch.tensor(keep, device=tokens.device)
+            self._past = tuple(tuple(x.index_select(0, index) for x in layer) for layer in self._past)
+            self._mask = self._mask.index_select(0, index)
+            self._positions = self._positions.index_select(0, index)
+            tokens = tokens.index_select(0, index)
+            # Drops the columns which are padding for all the remaining sequences
+            start = int((self._mask.sum(dim=0) > 0).nonzero()[0])
+            if start > 0:
+                self._mask = self._mask[:, start:]
+                self._past = tuple(tuple(x[:, :, start:, :] for x in layer) for layer in self._past)
+
+        self._mask = torch.cat([self._mask, torch.ones_like(self._mask[:, :1])], dim=1)
+        output = self._llm.model(input_ids=tokens[:, None],
+                                 attention_mask=self._mask,
+                                 position_ids=self._positions[:, None],
+                                 past_key_values=self._past,
+                                 use_cache=True)
+        self._past = self._legacy(output.past_key_values)
+        self._logits = output.logits[:, -1, :]
+        self._positions = self._positions + 1
+
+    def _finish(self, request: _Request):
+        """ Ends the stream of a request and records its latencies"""
+        now = time.perf_counter()
+        first_token = request.first_token if request.first_token is not None else now
+        self._llm.latency_stats.record(first_token - request.submitted, now - request.submitted, len(request.tokens))
+        request.chunks.put(_Request._END)
@@ -1,3 +1,4 @@
+import hashlib
 from typing import List
 
 
@@ -20,3 +21,12 @@ class TextSplitter:
         :return: a list of chunks
         """
         raise NotImplementedError()
+
+    @staticmethod
+    def fingerprint(chunk: str) -> str:
+        """
+        Content fingerprint of a chunk, used to detect which chunks changed between two imports of the same text
+        :param chunk: a chunk returned by `split_text`
+        :return: hexadecimal digest of the chunk
+        """
+        return hashlib.blake2b(chunk.encode("utf-8"), digest_size=16).hexdigest()
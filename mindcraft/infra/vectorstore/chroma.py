@@ -1,88 +1,174 @@
+import os
+import threading
 from typing import Optional
 
-import chromadb
-from chromadb import Settings
-from chromadb.utils import embedding_functions
+import numpy as np
 
+from mindcraft.infra.vectorstore.chroma_client_pool import ChromaClientPool
+from mindcraft.infra.vectorstore.query_cache import QueryCache
 from mindcraft.infra.vectorstore.search_results import SearchResult
 from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
 from mindcraft.infra.vectorstore.store import Store
+from mindcraft.infra.vectorstore.visibility_index import VisibilityIndex
+from mindcraft.settings import EMBEDDINGS_BATCH_SIZE
 
 
 class Chroma(Store):
     def __init__(self, path: str, collection_name: str, embeddings: EmbeddingsTypes):
         """
-        ChromaDB manager, in charge of loading, persisting and query the character memories and interactions
+        ChromaDB manager, in charge of loading, persisting and query the character memories and interactions.
+        All the collections stored in the same `path` share one pooled client (see `ChromaClientPool`), which is
+        kept open until the store is shut down.
         :param collection_name: name of the collection
         :param path: path where to save in disk the collection
         :param embeddings: type of EmbeddingsType
         """
         super().__init__(path, collection_name, embeddings)
-        self.client = self.instantiate_client()
-        self.collection = self.create_or_get_collection()
+        # Collections persisted before clients were pooled have their own ChromaDB folder
+        self.root_path = self.path if os.path.exists(os.path.join(self.path, "chroma.sqlite3")) else path
+        self.joint_name = ''.join(word.capitalize() for word in self.collection_name.split())
+        self.visibility = VisibilityIndex(os.path.join(self.root_path, f"{self.joint_name}.characters.json"))
+        self._acquired = False
+        self._acquired_lock = threading.Lock()
 
     def instantiate_client(self):
         """
-        Creation of the ChromaDB client persisting data to disk.
+        Retrieves the pooled ChromaDB client persisting data to disk, opening it if needed. The store holds a
+        reference to the client from its first use until it is shut down.
         """
-        return chromadb.PersistentClient(path=self.path, settings=Settings(allow_reset=True))
+        with self._acquired_lock:
+            if not self._acquired:
+                self._acquired = True
+                return ChromaClientPool.acquire(self.root_path)
+        return ChromaClientPool.get_client(self.root_path)
+
+    @property
+    def client(self):
+        """ Getter of the `client` property"""
+        return self.instantiate_client()
+
+    @property
+    def collection(self):
+        """ Getter of the `collection` property"""
+        return self.create_or_get_collection()
 
     def shut_down(self):
         """
-        Shuts down Chroma DB
+        Releases the pooled ChromaDB client, which may be closed once no other store uses it. It will be lazily
+        acquired again if needed.
         """
-        self.client.reset()
+        with self._acquired_lock:
+            if not self._acquired:
+                return
+            self._acquired = False
+        ChromaClientPool.release(self.root_path)
+
+    def __del__(self):
+        try:
+            self.shut_down()
+        except Exception:
+            pass
 
     def create_or_get_collection(self):
         """
         ChromaDB abstraction to retrieve a collection if already exists, or create it otherwise.
         """
-        joint_name = ''.join(word.capitalize() for word in self.collection_name.split())
-        return self.client.get_or_create_collection(name=joint_name)
+        self.instantiate_client()
+        return ChromaClientPool.get_collection(self.root_path, self.joint_name)
 
-    def get_embeddings(self, text):
+    def with_visibility(self, metadata: Optional[dict]) -> Optional[dict]:
         """
-        Transforms text to embeddings using the EmbeddingsType you selected in the constructor
-        :param text: Text to calculate embeddings from
+        Adds to the metadata one `known_by_<id>` flag per character who knows the entry, so that ChromaDB can filter
+        by any of them (the `known_by` value may contain several characters joined by SEPARATOR)
+        :param metadata: metadata of the entry
+        :return: metadata including the flags
         """
-        sentence_transformer_ef = embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name=str(self.embeddings.value))
-        return sentence_transformer_ef([text])
+        if metadata is None or "known_by" not in metadata:
+            return metadata
+        return {**metadata, **self.visibility.flags(metadata["known_by"])}
 
     def add_to_collection(self,
                           text: str,
                           metadata: Optional[dict],
-                          text_id: str):
+                          text_id: str,
+                          use_embeddings_cache: bool = False):
         """
         Adds a text to a ChromaDB collection, after calculating its embeddings.
         It accepts metadata as well to filter the results during retrieval.
         :param text: Text to be transformed into embeddings and stored.
         :param metadata: Dictionary with any key:value pair you want to store, e.g `known_by`: `galadriel`
         :param text_id: A unique id of the text
+        :param use_embeddings_cache: Reuse the embeddings from the persistent `EmbeddingsDiskCache` if available
         """
-        text_embeddings = self.get_embeddings(text)
+        text_embeddings = self.get_batch_embeddings([text], use_embeddings_cache=use_embeddings_cache)
         self.collection.add(
             documents=[text],
-            embeddings=text_embeddings,
-            metadatas=[metadata] if metadata is not None else [],
+            embeddings=text_embeddings.tolist(),
+            metadatas=[self.with_visibility(metadata)] if metadata is not None else [],
             ids=[text_id]
         )
+        QueryCache.invalidate(self.path)
+
+    def add_many(self,
+                 texts: list[str],
+                 metadatas: Optional[list[dict]],
+                 ids: list[str],
+                 batch_size: int = EMBEDDINGS_BATCH_SIZE,
+                 use_embeddings_cache: bool = False):
+        """
+        Adds several texts to a ChromaDB collection, calculating the embeddings and inserting them in batches.
+        :param texts: Texts to be transformed into embeddings and stored.
+        :param metadatas: One dictionary of metadata per text (or None)
+        :param ids: One unique id per text
+        :param batch_size: Number of texts embedded and inserted at once
+        :param use_embeddings_cache: Reuse the embeddings from the persistent `EmbeddingsDiskCache` if available
+        """
+        if len(texts) != len(ids) or (metadatas is not None and len(metadatas) != len(texts)):
+            raise Exception("`texts`, `metadatas` and `ids` should have the same length")
+
+        for start in range(0, len(texts), batch_size):
+            end = start + batch_size
+            self.collection.add(
+                documents=texts[start:end],
+                embeddings=self.get_batch_embeddings(texts[start:end], batch_size, use_embeddings_cache).tolist(),
+                metadatas=[self.with_visibility(x) for x in metadatas[start:end]] if metadatas is not None else None,
+                ids=ids[start:end]
+            )
+        QueryCache.invalidate(self.path)
+
+    def add_embeddings(self,
+                       texts: list[str],
+                       embeddings: np.ndarray,
+                       metadatas: Optional[list[dict]],
+                       ids: list[str]):
+        """
+        Adds several texts to a ChromaDB collection whose embeddings were already calculated.
+        :param texts: Texts to be stored.
+        :param embeddings: matrix with the embeddings of the texts, one per row
+        :param metadatas: One dictionary of metadata per text (or None)
+        :param ids: One unique id per text
+        """
+        self.collection.add(
+            documents=texts,
+            embeddings=np.asarray(embeddings, dtype=np.float32).tolist(),
+            metadatas=[self.with_visibility(x) for x in metadatas] if metadatas is not None else None,
+            ids=ids
+        )
+        QueryCache.invalidate(self.path)
 
     def count(self) -> int:
         """
         Counts the number of items in a collection
         :return: integer with the number of items
         """
-        if self.collection is None:
-            return 0
         return self.collection.count()
 
-    def query(self,
-              text: str,
-              num_results: int,
-              known_by: list,
-              exact_match: str = None,
-              min_similarity: float = 0.85) -> SearchResult:
+    def _query(self,
+               text: str,
+               num_results: int,
+               known_by: list,
+               exact_match: str = None,
+               min_similarity: float = 0.85) -> SearchResult:
         """
         Implementation of ChromaDB of the retrieval function
         :param text: Text to retrieve similar entries from
@@ -93,12 +179,7 @@ class Chroma(Store):
         :param min_similarity: The minimum similarity the document should have compared to the topic
         :return: SearchResults class
         """
-        if len(known_by) == 1:
-            where = {"known_by": known_by[0]}
-        else:
-            where = {
-                "$or": [{"known_by": x} for x in known_by]
-            }
+        where = self.visibility.where(known_by)
         where_document = dict()
         if exact_match is not None:
             where_document = {"$contains": exact_match}
@@ -108,48 +189,154 @@ class Chroma(Store):
             where=where,
             where_document=where_document)
 
-        result = SearchResult()
-        if 'distances' in results:
-            if len(results['distances']) > 0:
-                for i, d in enumerate(results['distances'][0]):
-                    # In ChromaDB we retrieve distances not similarities
-                    # so we need to check that the distance is smaller than the min. similarity
-                    if d <= min_similarity:
-                        result.documents.append(results['documents'][0][i])
-                        result.distances.append(results['distances'][0][i])
-        return result
+        return self._to_search_result(results, 0, min_similarity)
+
+    def _query_many(self,
+                    texts: list[str],
+                    known_by_per_query: list[list],
+                    num_results: int,
+                    exact_match: str = None,
+                    min_similarity: float = 0.85) -> list[SearchResult]:
+        """
+        Implementation of ChromaDB of the retrieval for several texts at once. The texts are embedded in one batch,
+        and the texts sharing the same `known_by` filter are sent to ChromaDB in the same query.
+        :param texts: Texts to retrieve similar entries from
+        :param known_by_per_query: One `known_by` filter (list of characters) per text
+        :param num_results: Max. number of results per text
+        :param exact_match: Filter the entries by a text you want to appear explicitly
+        :param min_similarity: The minimum similarity the document should have compared to the topic
+        :return: one SearchResult per text
+        """
+        if len(texts) != len(known_by_per_query):
+            raise Exception("`texts` and `known_by_per_query` should have the same length")
+        embeddings = self.get_query_embeddings(texts)
+        groups = dict()
+        for i, known_by in enumerate(known_by_per_query):
+            groups.setdefault(tuple(known_by), []).append(i)
+
+        where_document = dict()
+        if exact_match is not None:
+            where_document = {"$contains": exact_match}
+        search_results = [SearchResult() for _ in texts]
+        for known_by, positions in groups.items():
+            results = self.collection.query(
+                query_embeddings=embeddings[positions].tolist(),
+                n_results=num_results,
+                where=self.visibility.where(list(known_by)),
+                where_document=where_document)
+            for i, position in enumerate(positions):
+                search_results[position] = self._to_search_result(results, i, min_similarity)
+        return search_results
+
+    def score(self, text: str, ids: list[str]) -> SearchResult:
+        """
+        Implementation of ChromaDB of the calculation of the distance of a text to some entries of the collection.
+        Distances are squared L2, as in `query`.
+        :param text: Text to compare the entries with
+        :param ids: ids of the entries
+        :return: SearchResult with the entries found, from the closest to the furthest
+        """
+        if len(ids) == 0:
+            return SearchResult()
+        results = self.collection.get(ids=ids, include=["documents", "metadatas", "embeddings"])
+        if len(results['ids']) == 0:
+            return SearchResult()
+        embeddings = np.asarray(results['embeddings'], dtype=np.float32)
+        distances = np.sum((embeddings - self.get_query_embeddings([text])[0]) ** 2, axis=1)
+        order = np.argsort(distances, kind="stable")
+        metadatas = self._without_visibility(results['metadatas'])
+        return SearchResult([results['documents'][i] for i in order],
+                            distances[order],
+                            [results['ids'][i] for i in order],
+                            [metadatas[i] for i in order])
 
-    def get(self, where: dict) -> SearchResult:
+    def _to_search_result(self, results: dict, i: int, min_similarity: float) -> SearchResult:
+        """
+        Converts the results of the `i`-th query embedding of a ChromaDB query to a SearchResult
+        :param results: results returned by ChromaDB
+        :param i: position of the query embedding
+        :param min_similarity: The minimum similarity the document should have compared to the topic
+        :return: SearchResults class
+        """
+        if results.get('distances') is None or len(results['distances']) <= i:
+            return SearchResult()
+        # In ChromaDB we retrieve distances not similarities
+        # so we need to check that the distance is smaller than the min. similarity
+        return SearchResult.from_arrays(results['documents'][i],
+                                        results['distances'][i],
+                                        results['ids'][i],
+                                        self._without_visibility(results['metadatas'][i])
+                                        if results.get('metadatas') is not None else None,
+                                        min_similarity=min_similarity)
+
+    @staticmethod
+    def _embeddings_matrix(results: dict) -> np.ndarray:
+        """ Embeddings of a ChromaDB `get` as a float32 matrix, with one row per entry"""
+        return np.asarray(results['embeddings'], dtype=np.float32).reshape(len(results['ids']), -1)
+
+    def _without_visibility(self, metadatas: list[Optional[dict]]) -> list[dict]:
+        """ Removes the `known_by_<id>` flags added by `with_visibility` from the metadata"""
+        prefix = self.visibility.FLAG_PREFIX
+        return [{k: v for k, v in (x or {}).items() if not k.startswith(prefix)} for x in metadatas]
+
+    def _get(self,
+             where: dict,
+             limit: int = None,
+             include_embeddings: bool = False,
+             ids: list[str] = None) -> SearchResult:
         """
         ChromaDB `get` method that queries a collection using a `where` (dict) clause, that checks metadata.
         :param where: dictionary of key:values to be used when checking metadata to filter the results
+        :param limit: max. number of entries to retrieve. By default, all of them.
+        :param include_embeddings: retrieve the embeddings of the entries as well
+        :param ids: only retrieve the entries with these ids
         :return SearchResult
         """
-        results = self.collection.get(where=where)
-        result = SearchResult()
-        if 'documents' in results:
-            if len(results['documents']) > 0:
-                for d in results['documents']:
-                    result.documents.append(d)
-        return result
+        if ids is not None and len(ids) == 0:
+            return SearchResult(metadatas=[],
+                                embeddings=np.empty((0, 0), dtype=np.float32) if include_embeddings else None)
+        include = ["documents", "metadatas", "embeddings"] if include_embeddings else ["documents", "metadatas"]
+        results = self.collection.get(ids=ids, where=where, limit=limit, include=include)
+        return SearchResult(documents=results['documents'] or [],
+                            ids=results['ids'],
+                            metadatas=self._without_visibility(results['metadatas'] or []),
+                            embeddings=self._embeddings_matrix(results) if include_embeddings else None)
 
-    def get_last(self, n: int = 5) -> SearchResult:
+    def get_last(self, n: int = 5, include_embeddings: bool = False) -> SearchResult:
         """
         ChromaDB `get` method modified to get last `n` entries
         :param n: number of entries
+        :param include_embeddings: retrieve the embeddings of the entries as well
         :return SearchResult
         """
         total = self.collection.count()
         offset = max(total - n, 0)
-        results = self.collection.get(offset=offset, limit=total)
-        result = SearchResult()
-        if 'documents' in results:
-            if len(results['documents']) > 0:
-                for d in results['documents']:
-                    result.documents.append(d)
-        return result
+        include = ["documents", "metadatas", "embeddings"] if include_embeddings else ["documents", "metadatas"]
+        results = self.collection.get(offset=offset, limit=total, include=include)
+        return SearchResult(documents=results['documents'] or [],
+                            ids=results['ids'],
+                            metadatas=self._without_visibility(results['metadatas'] or []),
+                            embeddings=self._embeddings_matrix(results) if include_embeddings else None)
+
+    def get_ids(self, where: dict = None) -> list[str]:
+        """
+        ChromaDB `get` method which only retrieves the ids of the entries, optionally filtered by metadata.
+        :param where: dictionary of key:values to be used when checking metadata to filter the results
+        :return list of ids
+        """
+        return self.collection.get(where=where, include=[])['ids']
+
+    def delete(self, ids: list[str]):
+        """
+        Deletes entries from a ChromaDB collection
+        :param ids: ids of the entries to delete
+        """
+        if len(ids) > 0:
+            self.collection.delete(ids=ids)
+            QueryCache.invalidate(self.path)
 
     def delete_collection(self):
         """ deletes a vector store from disk"""
-        self.client.delete_collection(self.collection_name)
-        self.client.reset()
+        ChromaClientPool.forget_collection(self.root_path, self.joint_name)
+        self.client.delete_collection(self.joint_name)
+        QueryCache.invalidate(self.path)
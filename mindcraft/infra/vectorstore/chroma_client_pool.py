@@ -0,0 +1,147 @@
+import os
+import threading
+from collections import OrderedDict
+
+import chromadb
+from chromadb import Settings
+from chromadb.api.client import SharedSystemClient
+
+from mindcraft.settings import CHROMA_MAX_CLIENTS
+
+
+class ChromaClientPool:
+    """
+    Pool of ChromaDB persistent clients, one per data root (LTM, styles, world...). All the characters stored in the
+    same root share the client, each of them in its own collection. Clients are opened lazily and reference counted:
+    every `Chroma` store using a client holds a reference until it is shut down. When more than `max_clients` are
+    open, the least recently used idle clients (without references) are closed. Clients in use are never closed.
+    Closing a client stops its ChromaDB system (sqlite connection and background threads) and removes it from the
+    cache of systems of ChromaDB, so that at most `max_clients` idle handles stay open.
+    """
+    _clients = OrderedDict()
+    _references = dict()
+    _collections = dict()
+    _lock = threading.RLock()
+    _stats = {"opened": 0, "closed": 0}
+    max_clients = CHROMA_MAX_CLIENTS
+
+    @classmethod
+    def get_client(cls, path: str):
+        """
+        Returns the client of a data root, opening it if needed. It does not take a reference (see `acquire`).
+        :param path: data root of the client
+        :return: ChromaDB client
+        """
+        key = os.path.realpath(path)
+        with cls._lock:
+            if key in cls._clients:
+                cls._clients.move_to_end(key)
+                return cls._clients[key]
+
+            client = chromadb.PersistentClient(path=key, settings=Settings(allow_reset=True))
+            cls._clients[key] = client
+            cls._stats["opened"] += 1
+            cls._evict()
+            return client
+
+    @classmethod
+    def acquire(cls, path: str):
+        """
+        Returns the client of a data root, opening it if needed, and takes a reference to it so it is not closed
+        while in use
+        :param path: data root of the client
+        :return: ChromaDB client
+        """
+        key = os.path.realpath(path)
+        with cls._lock:
+            cls._references[key] = cls._references.get(key, 0) + 1
+            return cls.get_client(path)
+
+    @classmethod
+    def release(cls, path: str):
+        """
+        Gives back a reference taken with `acquire`. Once idle, the client may be closed if the pool is full.
+        :param path: data root of the client
+        """
+        key = os.path.realpath(path)
+        with cls._lock:
+            references = cls._references.get(key, 0) - 1
+            if references > 0:
+                cls._references[key] = references
+            else:
+                cls._references.pop(key, None)
+            cls._evict()
+
+    @classmethod
+    def references(cls, path: str) -> int:
+        """
+        :param path: data root of the client
+        :return: number of references to the client of a data root
+        """
+        with cls._lock:
+            return cls._references.get(os.path.realpath(path), 0)
+
+    @classmethod
+    def _evict(cls):
+        """ Closes the least recently used idle clients while more than `max_clients` are open"""
+        idle = [x for x in cls._clients if cls._references.get(x, 0) == 0]
+        while len(cls._clients) > max(cls.max_clients, 1) and len(idle) > 0:
+            cls._close(idle.pop(0))
+
+    @classmethod
+    def _close(cls, key: str):
+        """ Stops the ChromaDB system of a client and forgets it and its collections"""
+        client = cls._clients.pop(key, None)
+        if client is None:
+            return
+        for collection_key in [x for x in cls._collections if x[0] == key]:
+            del cls._collections[collection_key]
+        # ChromaDB caches one system per path: it is removed, so that opening the client again starts a new one
+        system = SharedSystemClient._identifer_to_system.pop(client._identifier, None)
+        if system is not None:
+            system.stop()
+        cls._stats["closed"] += 1
+
+    @classmethod
+    def get_collection(cls, path: str, collection_name: str):
+        """
+        Returns a collection of the client of a data root, creating it if it does not exist
+        :param path: data root of the client
+        :param collection_name: name of the collection
+        :return: ChromaDB collection
+        """
+        key = (os.path.realpath(path), collection_name)
+        with cls._lock:
+            client = cls.get_client(path)
+            if key not in cls._collections:
+                cls._collections[key] = client.get_or_create_collection(name=collection_name)
+            return cls._collections[key]
+
+    @classmethod
+    def forget_collection(cls, path: str, collection_name: str):
+        """
+        Removes a collection handle from the pool (for example, after deleting the collection)
+        :param path: data root of the client
+        :param collection_name: name of the collection
+        """
+        with cls._lock:
+            cls._collections.pop((os.path.realpath(path), collection_name), None)
+
+    @classmethod
+    def close_idle(cls):
+        """ Closes all the clients without references. They will be opened again the next time they are needed."""
+        with cls._lock:
+            for key in [x for x in cls._clients if cls._references.get(x, 0) == 0]:
+                cls._close(key)
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        Statistics of the pool
+        :return: dictionary with the number of clients `opened`, `closed`, currently `open` and `in_use`
+        """
+        with cls._lock:
+            stats = dict(cls._stats)
+            stats["open"] = len(cls._clients)
+            stats["in_use"] = len(cls._references)
+            return stats
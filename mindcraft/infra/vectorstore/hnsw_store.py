@@ -0,0 +1,205 @@
+import os
+import time
+
+import numpy as np
+
+from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
+from mindcraft.infra.vectorstore.numpy_store import NumpyStore
+from mindcraft.infra.vectorstore.query_cache import QueryCache
+from mindcraft.settings import HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF, HNSW_SAVE_EVERY, ALL
+
+
+class HNSWStore(NumpyStore):
+    INDEX_FILE = "hnsw.bin"
+
+    def __init__(self,
+                 path: str,
+                 collection_name: str,
+                 embeddings: EmbeddingsTypes,
+                 m: int = HNSW_M,
+                 ef_construction: int = HNSW_EF_CONSTRUCTION,
+                 ef: int = HNSW_EF):
+        """
+        Approximate nearest neighbour store for very large worlds. Vectors, documents and metadata are kept as in
+        `NumpyStore`, and an HNSW graph (`hnswlib`) built over the rows answers the queries, so latency does not grow
+        linearly with the number of chunks.
+        :param collection_name: name of the collection
+        :param path: path where to save in disk the collection
+        :param embeddings: type of EmbeddingsType
+        :param m: number of bi-directional links of each node of the graph. Higher is more accurate but bigger.
+        :param ef_construction: size of the dynamic candidate list when building the graph
+        :param ef: size of the dynamic candidate list when querying. Higher is more accurate but slower.
+        """
+        try:
+            import hnswlib
+        except ImportError:
+            raise Exception(f"To use `hnswlib` as your vector store, please install it first using pip:\n"
+                            f"`pip install \"hnswlib>=0.7\"` (or `pip install \"chroma-hnswlib>=0.7\"` if you also use "
+                            f"`chromadb`)")
+        self._hnswlib = hnswlib
+        self._m = m
+        self._ef_construction = ef_construction
+        self._ef = ef
+        self._index = None
+        self._unsaved = 0
+        super().__init__(path, collection_name, embeddings)
+
+    @property
+    def ef(self) -> int:
+        """ Getter of the `ef` property"""
+        return self._ef
+
+    @ef.setter
+    def ef(self, value: int):
+        """ Setter of the `ef` property"""
+        self._ef = value
+
+    def instantiate_client(self):
+        """
+        Loads the collection and the HNSW graph from disk. Rows stored after the graph was last saved are inserted.
+        Nodes of rows which were lost when loading the collection (an interrupted write) are marked as deleted, so
+        they are never returned. They are replaced when those rows are written again.
+        """
+        super().instantiate_client()
+        self._index = None
+        self._unsaved = 0
+        if self._vectors is None:
+            return None
+
+        index_path = os.path.join(self.path, self.INDEX_FILE)
+        self._index = self._hnswlib.Index(space='ip', dim=self._vectors.shape[1])
+        if os.path.exists(index_path):
+            self._index.load_index(index_path, max_elements=self._vectors.shape[0])
+            for label in range(self._size, self._index.get_current_count()):
+                try:
+                    self._index.mark_deleted(label)
+                except RuntimeError:
+                    # Already deleted when the collection was loaded before
+                    pass
+        else:
+            self._index.init_index(max_elements=self._vectors.shape[0], ef_construction=self._ef_construction,
+                                   M=self._m)
+        self._index_rows(self._index.get_current_count(), self._size)
+        return None
+
+    def _index_rows(self, start: int, end: int):
+        """ Inserts the rows [start, end) of the matrix into the graph. The label of each node is its row."""
+        if end <= start:
+            return
+        if self._index is None:
+            self._index = self._hnswlib.Index(space='ip', dim=self._vectors.shape[1])
+            self._index.init_index(max_elements=self._vectors.shape[0], ef_construction=self._ef_construction,
+                                   M=self._m)
+        if end > self._index.get_max_elements():
+            self._index.resize_index(self._vectors.shape[0])
+        self._index.add_items(np.asarray(self._vectors[start:end]), np.arange(start, end))
+        self._unsaved += end - start
+        if self._unsaved >= HNSW_SAVE_EVERY:
+            self.save_index()
+
+    def _write(self, texts: list[str], metadatas, ids: list[str], vectors: np.ndarray):
+        """ Appends the rows as `NumpyStore` does and inserts them incrementally into the graph"""
+        with self._lock:
+            start = self._size
+            super()._write(texts, metadatas, ids, vectors)
+            self._index_rows(start, self._size)
+        # The rows are searchable through the graph only now
+        QueryCache.invalidate(self.path)
+
+    def save_index(self):
+        """ Persists the HNSW graph to disk"""
+        with self._lock:
+            if self._index is not None:
+                self._index.save_index(os.path.join(self.path, self.INDEX_FILE))
+                self._unsaved = 0
+
+    def shut_down(self):
+        """
+        Flushes the vectors and the graph to disk
+        """
+        super().shut_down()
+        self.save_index()
+
+    def _search(self, query: np.ndarray, candidates: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Approximate top-k using the HNSW graph. Metadata filters are applied while traversing the graph, so only
+        candidate rows are returned. If there are few candidates, the exact search is cheaper.
+        :param query: normalized query vector
+        :param candidates: rows which can be returned
+        :param k: number of results
+        :return: the top-k rows and their similarities, from most to least similar
+        """
+        k = min(k, len(candidates))
+        if self._index is None or len(candidates) <= max(self._ef, k):
+            return super()._search(query, candidates, k)
+
+        if len(candidates) == self._size:
+            # Every row can be returned: no need to filter the nodes of the graph
+            allowed = None
+        else:
+            allowed = np.zeros(self._size, dtype=bool)
+            allowed[candidates] = True
+        self._index.set_ef(max(self._ef, k))
+        try:
+            labels, distances = self._index.knn_query(query, k=k, num_threads=1,
+                                                      filter=(lambda label: bool(allowed[label]))
+                                                      if allowed is not None else None)
+        except RuntimeError:
+            # The graph traversal could not find `k` candidates (very restrictive filters)
+            return super()._search(query, candidates, k)
+        # `ip` distance in hnswlib is 1 - inner product
+        return labels[0].astype(np.int64), 1 - distances[0]
+
+    def _search_many(self, queries: np.ndarray, candidates: np.ndarray, k: int) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        Top-k of several queries among the same candidate rows. Uses a single matrix product when there are few
+        candidates and the HNSW graph otherwise.
+        :param queries: matrix of normalized query vectors, one per row
+        :param candidates: rows which can be returned
+        :param k: number of results
+        :return: per query, the top-k rows and their similarities, from most to least similar
+        """
+        if self._index is None or len(candidates) <= max(self._ef, min(k, len(candidates))):
+            return super()._search_many(queries, candidates, k)
+        return [self._search(query, candidates, k) for query in queries]
+
+    def benchmark(self, queries: list[str], num_results: int = 10, known_by: list = None) -> dict:
+        """
+        Compares the HNSW graph against the exact (brute force) search
+        :param queries: texts to use as queries
+        :param num_results: `k` of the top-k
+        :param known_by: characters used to filter the lore. By default, lore known by all.
+        :return: dictionary with the `recall` at `num_results` and the mean and p95 latency in milliseconds
+        of both searches
+        """
+        known_by = known_by if known_by is not None else [ALL]
+        vectors = self.get_query_embeddings(queries)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        hnsw_latencies, exact_latencies, recalls = [], [], []
+        with self._lock:
+            candidates = self._candidates(known_by)
+            for query in vectors:
+                start = time.perf_counter()
+                approximate, _ = self._search(query, candidates, num_results)
+                hnsw_latencies.append((time.perf_counter() - start) * 1000)
+
+                start = time.perf_counter()
+                exact, _ = super()._search(query, candidates, num_results)
+                exact_latencies.append((time.perf_counter() - start) * 1000)
+
+                if len(exact) > 0:
+                    recalls.append(len(set(approximate.tolist()).intersection(exact.tolist())) / len(exact))
+
+        return {
+            "recall": float(np.mean(recalls)) if len(recalls) > 0 else 1.0,
+            "hnsw_mean_ms": float(np.mean(hnsw_latencies)) if len(queries) > 0 else 0.0,
+            "hnsw_p95_ms": float(np.percentile(hnsw_latencies, 95)) if len(queries) > 0 else 0.0,
+            "exact_mean_ms": float(np.mean(exact_latencies)) if len(queries) > 0 else 0.0,
+            "exact_p95_ms": float(np.percentile(exact_latencies, 95)) if len(queries) > 0 else 0.0
+        }
+
+    def delete_collection(self):
+        """ deletes a vector store from disk"""
+        with self._lock:
+            self._index = None
+            super().delete_collection()
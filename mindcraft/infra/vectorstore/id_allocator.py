@@ -0,0 +1,81 @@
+import os
+import threading
+from typing import Callable, Optional
+
+from mindcraft.settings import ID_BLOCK_SIZE
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows. Ids are still unique within the process.
+    fcntl = None
+
+
+class IdAllocator:
+    def __init__(self, path: str, seed: Optional[Callable[[], int]] = None, block_size: int = ID_BLOCK_SIZE):
+        """
+        Persistent, monotonic sequence of ids for the entries of a collection. Ids are reserved from disk in blocks
+        of `block_size` (hi/lo), so that minting an id is usually an in-memory increment. The reservation is done under
+        a file lock, so that several processes writing to the same collection never get the same id. Ids left unused
+        in a block when the process ends are skipped.
+        :param path: file where the next id to reserve is persisted
+        :param seed: called the first time, when the file does not exist yet, to get the first id (e.g. for
+        collections created before the allocator existed)
+        :param block_size: number of ids reserved at once
+        """
+        self._path = path
+        self._seed = seed
+        self._block_size = max(block_size, 1)
+        self._lock = threading.Lock()
+        self._next = 0
+        self._limit = 0
+
+    @classmethod
+    def for_store(cls, store, block_size: int = ID_BLOCK_SIZE) -> "IdAllocator":
+        """
+        Allocator of a Store, persisted next to the collection and seeded after the numeric ids already stored
+        :param store: the Store
+        :param block_size: number of ids reserved at once
+        :return: IdAllocator
+        """
+        def seed() -> int:
+            ids = [int(x) for x in store.get_ids() if x.isdigit()]
+            return max(max(ids) + 1 if len(ids) > 0 else 0, store.count())
+
+        return cls(f"{store.path}.sequence", seed, block_size)
+
+    def next_id(self) -> str:
+        """
+        Mints a new id
+        :return: the id, as a string
+        """
+        with self._lock:
+            if self._next >= self._limit:
+                self._next = self._reserve()
+                self._limit = self._next + self._block_size
+            text_id = self._next
+            self._next += 1
+            return str(text_id)
+
+    def _reserve(self) -> int:
+        """
+        Reserves a new block of ids on disk
+        :return: the first id of the block
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        with open(f"{self._path}.lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self._path):
+                    with open(self._path, "r", encoding="utf-8") as f:
+                        start = int(f.read().strip() or 0)
+                else:
+                    start = self._seed() if self._seed is not None else 0
+                with open(f"{self._path}.tmp", "w", encoding="utf-8") as f:
+                    f.write(str(start + self._block_size))
+                os.replace(f"{self._path}.tmp", self._path)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        return start
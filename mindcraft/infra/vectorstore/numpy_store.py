@@ -0,0 +1,438 @@
+import json
+import os
+import shutil
+import threading
+from typing import Optional
+
+import numpy as np
+
+from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
+from mindcraft.infra.vectorstore.query_cache import QueryCache
+from mindcraft.infra.vectorstore.search_results import SearchResult
+from mindcraft.infra.vectorstore.store import Store
+from mindcraft.infra.vectorstore.visibility_index import VisibilityIndex
+from mindcraft.settings import EMBEDDINGS_BATCH_SIZE
+
+
+class NumpyStore(Store):
+    INITIAL_CAPACITY = 1024
+    VECTORS_FILE = "vectors.npy"
+    METADATA_FILE = "metadata.jsonl"
+
+    def __init__(self, path: str, collection_name: str, embeddings: EmbeddingsTypes):
+        """
+        In-process vector store backed by a contiguous float32 matrix. Vectors are appended to a memory-mapped `.npy`
+        file and documents, ids and metadata to a `.jsonl` sidecar. Retrieval is a vectorized cosine top-k, which is
+        faster and lighter than a database client for small collections as the LTM or styles of an NPC.
+        :param collection_name: name of the collection
+        :param path: path where to save in disk the collection
+        :param embeddings: type of EmbeddingsType
+        """
+        super().__init__(path, collection_name, embeddings)
+        self._lock = threading.RLock()
+        self._vectors = None
+        self._size = 0
+        self._ids = []
+        self._documents = []
+        self._metadatas = []
+        self._alive = []
+        self._rows = dict()
+        self._visibility = VisibilityIndex()
+        self.client = self.instantiate_client()
+
+    def instantiate_client(self):
+        """
+        Loads the collection from disk. There is no client, the collection is read into the process memory.
+        """
+        self._vectors = None
+        self._size = 0
+        self._ids, self._documents, self._metadatas, self._alive = [], [], [], []
+        self._rows = dict()
+        self._visibility = VisibilityIndex()
+
+        metadata_path = os.path.join(self.path, self.METADATA_FILE)
+        if os.path.exists(metadata_path):
+            valid = 0
+            with open(metadata_path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Interrupted write
+                        break
+                    try:
+                        entry = json.loads(line.decode("utf-8"))
+                    except ValueError:
+                        break
+                    if "deleted" in entry:
+                        self._remove_row(entry["deleted"])
+                    else:
+                        self._append_row(entry["id"], entry["document"], entry["metadata"])
+                    valid += len(line)
+            if valid < os.path.getsize(metadata_path):
+                # Drops the tail left by an interrupted write, so that the next entries start on a new line
+                with open(metadata_path, "r+b") as f:
+                    f.truncate(valid)
+
+        vectors_path = os.path.join(self.path, self.VECTORS_FILE)
+        if os.path.exists(vectors_path):
+            self._vectors = np.lib.format.open_memmap(vectors_path, mode="r+")
+        self._size = len(self._ids)
+        return None
+
+    def shut_down(self):
+        """
+        Flushes the vectors to disk
+        """
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+
+    def _append_row(self, text_id: str, text: str, metadata: Optional[dict]):
+        """ Registers the documents and metadata of a new row in memory"""
+        self._remove_row(text_id)
+        self._rows[text_id] = len(self._ids)
+        self._visibility.add(len(self._ids), metadata.get("known_by") if metadata is not None else None)
+        self._ids.append(text_id)
+        self._documents.append(text)
+        self._metadatas.append(metadata if metadata is not None else {})
+        self._alive.append(True)
+
+    def _remove_row(self, text_id: str):
+        """ Marks the row of `text_id` as deleted"""
+        row = self._rows.pop(text_id, None)
+        if row is not None:
+            self._alive[row] = False
+            self._visibility.remove(row)
+
+    def _reserve(self, rows: int, dimensions: int):
+        """
+        Makes sure the memory-mapped matrix has room for `rows` more vectors, doubling its capacity if needed.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        vectors_path = os.path.join(self.path, self.VECTORS_FILE)
+        needed = self._size + rows
+        if self._vectors is None:
+            capacity = max(self.INITIAL_CAPACITY, needed)
+            self._vectors = np.lib.format.open_memmap(vectors_path, mode="w+", dtype=np.float32,
+                                                      shape=(capacity, dimensions))
+        elif needed > self._vectors.shape[0]:
+            capacity = max(self._vectors.shape[0] * 2, needed)
+            tmp_path = f"{vectors_path}.tmp"
+            grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32,
+                                              shape=(capacity, self._vectors.shape[1]))
+            grown[:self._size] = self._vectors[:self._size]
+            grown.flush()
+            del grown
+            self._vectors = None
+            os.replace(tmp_path, vectors_path)
+            self._vectors = np.lib.format.open_memmap(vectors_path, mode="r+")
+
+    def _write(self, texts: list[str], metadatas: Optional[list[dict]], ids: list[str], vectors: np.ndarray):
+        """
+        Appends normalized vectors to the matrix and then the entries to the metadata sidecar, so that an interrupted
+        write never references a vector which was not stored.
+        """
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        with self._lock:
+            self._reserve(len(texts), vectors.shape[1])
+            self._vectors[self._size:self._size + len(texts)] = vectors
+            self._vectors.flush()
+            with open(os.path.join(self.path, self.METADATA_FILE), "a", encoding="utf-8") as f:
+                for i, text in enumerate(texts):
+                    metadata = metadatas[i] if metadatas is not None else None
+                    f.write(json.dumps({"id": ids[i], "document": text, "metadata": metadata}) + "\n")
+                    self._append_row(ids[i], text, metadata)
+            self._size = len(self._ids)
+        QueryCache.invalidate(self.path)
+
+    def add_to_collection(self,
+                          text: str,
+                          metadata: Optional[dict],
+                          text_id: str,
+                          use_embeddings_cache: bool = False):
+        """
+        Adds a text to the collection, after calculating its embeddings.
+        It accepts metadata as well to filter the results during retrieval.
+        :param text: Text to be transformed into embeddings and stored.
+        :param metadata: Dictionary with any key:value pair you want to store, e.g `known_by`: `galadriel`
+        :param text_id: A unique id of the text
+        :param use_embeddings_cache: Reuse the embeddings from the persistent `EmbeddingsDiskCache` if available
+        """
+        self._write([text],
+                    [metadata] if metadata is not None else None,
+                    [text_id],
+                    self.get_batch_embeddings([text], use_embeddings_cache=use_embeddings_cache))
+
+    def add_many(self,
+                 texts: list[str],
+                 metadatas: Optional[list[dict]],
+                 ids: list[str],
+                 batch_size: int = EMBEDDINGS_BATCH_SIZE,
+                 use_embeddings_cache: bool = False):
+        """
+        Adds several texts to the collection, calculating the embeddings and appending them in batches.
+        :param texts: Texts to be transformed into embeddings and stored.
+        :param metadatas: One dictionary of metadata per text (or None)
+        :param ids: One unique id per text
+        :param batch_size: Number of texts embedded and inserted at once
+        :param use_embeddings_cache: Reuse the embeddings from the persistent `EmbeddingsDiskCache` if available
+        """
+        if len(texts) != len(ids) or (metadatas is not None and len(metadatas) != len(texts)):
+            raise Exception("`texts`, `metadatas` and `ids` should have the same length")
+
+        for start in range(0, len(texts), batch_size):
+            end = start + batch_size
+            self._write(texts[start:end],
+                        metadatas[start:end] if metadatas is not None else None,
+                        ids[start:end],
+                        self.get_batch_embeddings(texts[start:end], batch_size, use_embeddings_cache))
+
+    def add_embeddings(self,
+                       texts: list[str],
+                       embeddings: np.ndarray,
+                       metadatas: Optional[list[dict]],
+                       ids: list[str]):
+        """
+        Adds several texts to the collection whose embeddings were already calculated.
+        :param texts: Texts to be stored.
+        :param embeddings: matrix with the embeddings of the texts, one per row
+        :param metadatas: One dictionary of metadata per text (or None)
+        :param ids: One unique id per text
+        """
+        self._write(texts, metadatas, ids, np.asarray(embeddings, dtype=np.float32))
+
+    def count(self) -> int:
+        """
+        Counts the number of items in a collection
+        :return: integer with the number of items
+        """
+        return len(self._rows)
+
+    def _matches(self, row: int, where: Optional[dict]) -> bool:
+        """ Checks if the metadata of a row has all the key:value pairs of `where`"""
+        if not self._alive[row]:
+            return False
+        if where is None:
+            return True
+        metadata = self._metadatas[row]
+        return all(metadata.get(k) == v for k, v in where.items())
+
+    def _query(self,
+               text: str,
+               num_results: int,
+               known_by: list,
+               exact_match: str = None,
+               min_similarity: float = 0.85) -> SearchResult:
+        """
+        Vectorized cosine top-k retrieval
+        :param text: Text to retrieve similar entries from
+        :param num_results: Max. number of results
+        :param known_by: Filter the entries in the vector store by the character's id. use settings.`ALL` for pieces of
+        lore known to everyone
+        :param exact_match: Filter the entries by a text you want to appear explicitly
+        :param min_similarity: The minimum similarity the document should have compared to the topic
+        :return: SearchResults class
+        """
+        result = SearchResult()
+        with self._lock:
+            candidates = self._candidates(known_by, exact_match)
+            if len(candidates) == 0 or num_results < 1:
+                return result
+
+            query = self.get_query_embeddings([text])[0]
+            query = query / max(float(np.linalg.norm(query)), 1e-12)
+            rows, similarities = self._search(query, candidates, num_results)
+
+        return self._to_search_result(rows, similarities, min_similarity)
+
+    def _query_many(self,
+                    texts: list[str],
+                    known_by_per_query: list[list],
+                    num_results: int,
+                    exact_match: str = None,
+                    min_similarity: float = 0.85) -> list[SearchResult]:
+        """
+        Vectorized cosine top-k retrieval for several texts at once. The texts are embedded in one batch and the
+        texts sharing the same `known_by` filter are scored with a single matrix product.
+        :param texts: Texts to retrieve similar entries from
+        :param known_by_per_query: One `known_by` filter (list of characters) per text
+        :param num_results: Max. number of results per text
+        :param exact_match: Filter the entries by a text you want to appear explicitly
+        :param min_similarity: The minimum similarity the document should have compared to the topic
+        :return: one SearchResult per text
+        """
+        if len(texts) != len(known_by_per_query):
+            raise Exception("`texts` and `known_by_per_query` should have the same length")
+        results = [SearchResult() for _ in texts]
+        if len(texts) == 0 or num_results < 1:
+            return results
+
+        queries = self.get_query_embeddings(texts)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        groups = dict()
+        for i, known_by in enumerate(known_by_per_query):
+            groups.setdefault(tuple(known_by), []).append(i)
+
+        with self._lock:
+            for known_by, positions in groups.items():
+                candidates = self._candidates(list(known_by), exact_match)
+                if len(candidates) == 0:
+                    continue
+                found = self._search_many(queries[positions], candidates, num_results)
+                for position, (rows, similarities) in zip(positions, found):
+                    results[position] = self._to_search_result(rows, similarities, min_similarity)
+        return results
+
+    def score(self, text: str, ids: list[str]) -> SearchResult:
+        """
+        Calculates the distance of a text to some entries of the collection
+        :param text: Text to compare the entries with
+        :param ids: ids of the entries
+        :return: SearchResult with the entries found, from the closest to the furthest
+        """
+        with self._lock:
+            rows = np.array([self._rows[x] for x in ids if x in self._rows], dtype=np.int64)
+            if len(rows) == 0:
+                return SearchResult()
+            query = self.get_query_embeddings([text])[0]
+            query = query / max(float(np.linalg.norm(query)), 1e-12)
+            similarities = self._vectors[rows] @ query
+            order = np.argsort(-similarities, kind="stable")
+            return self._to_search_result(rows[order], similarities[order], float("inf"))
+
+    def _to_search_result(self, rows: np.ndarray, similarities: np.ndarray, min_similarity: float) -> SearchResult:
+        """
+        Converts the top-k rows of a query to a SearchResult. Distances are reported as squared L2 between normalized
+        vectors, as ChromaDB does, so that `min_similarity` means the same for every Store
+        """
+        distances = (2 - 2 * similarities).astype(np.float32)
+        keep = distances <= min_similarity
+        rows, distances = rows[keep], distances[keep]
+        return SearchResult([self._documents[i] for i in rows],
+                            distances,
+                            [self._ids[i] for i in rows],
+                            [self._metadatas[i] for i in rows])
+
+    def _candidates(self, known_by: list, exact_match: str = None) -> np.ndarray:
+        """
+        Rows which can be returned by a query: alive, known by any of the characters in `known_by` and containing
+        `exact_match`. The `VisibilityIndex` provides the rows known by the characters without scanning the metadata.
+        :return: sorted array of rows
+        """
+        candidates = self._visibility.candidates(known_by)
+        if exact_match is None:
+            return candidates
+        return np.fromiter((row for row in candidates if exact_match in self._documents[row]), dtype=np.int64)
+
+    def _search(self, query: np.ndarray, candidates: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Exact (brute force) top-k by cosine similarity among the candidate rows
+        :param query: normalized query vector
+        :param candidates: rows to score
+        :param k: number of results
+        :return: the top-k rows and their similarities, from most to least similar
+        """
+        similarities = self._vectors[candidates] @ query
+        k = min(k, len(candidates))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return candidates[top], similarities[top]
+
+    def _search_many(self, queries: np.ndarray, candidates: np.ndarray, k: int) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        Exact (brute force) top-k of several queries among the same candidate rows, with one matrix product
+        :param queries: matrix of normalized query vectors, one per row
+        :param candidates: rows to score
+        :param k: number of results
+        :return: per query, the top-k rows and their similarities, from most to least similar
+        """
+        similarities = self._vectors[candidates] @ queries.T
+        k = min(k, len(candidates))
+        top = np.argpartition(-similarities, k - 1, axis=0)[:k]
+        found = []
+        for i in range(queries.shape[0]):
+            column = top[:, i]
+            column = column[np.argsort(-similarities[column, i])]
+            found.append((candidates[column], similarities[column, i]))
+        return found
+
+    def _get(self,
+             where: dict,
+             limit: int = None,
+             include_embeddings: bool = False,
+             ids: list[str] = None) -> SearchResult:
+        """
+        Retrieves the entries of the collection whose metadata matches a `where` (dict) clause.
+        :param where: dictionary of key:values to be used when checking metadata to filter the results
+        :param limit: max. number of entries to retrieve. By default, all of them.
+        :param include_embeddings: retrieve the embeddings of the entries as well
+        :param ids: only retrieve the entries with these ids
+        :return SearchResult
+        """
+        with self._lock:
+            rows = []
+            for row in range(self._size) if ids is None else sorted(self._rows[x] for x in ids if x in self._rows):
+                if limit is not None and len(rows) >= limit:
+                    break
+                if self._matches(row, where):
+                    rows.append(row)
+            return self._rows_to_search_result(rows, include_embeddings)
+
+    def get_last(self, n: int = 5, include_embeddings: bool = False) -> SearchResult:
+        """
+        Retrieves the last `n` entries added to the collection
+        :param n: number of entries
+        :param include_embeddings: retrieve the embeddings of the entries as well
+        :return SearchResult
+        """
+        with self._lock:
+            rows = []
+            for row in range(self._size - 1, -1, -1):
+                if len(rows) >= n:
+                    break
+                if self._alive[row]:
+                    rows.append(row)
+            return self._rows_to_search_result(rows[::-1], include_embeddings)
+
+    def _rows_to_search_result(self, rows: list[int], include_embeddings: bool = False) -> SearchResult:
+        """ SearchResult with the documents, ids, metadata and (optionally) embeddings of some rows. No distances."""
+        embeddings = None
+        if include_embeddings:
+            embeddings = np.array(self._vectors[rows]) if self._vectors is not None and len(rows) > 0 \
+                else np.empty((0, 0), dtype=np.float32)
+        return SearchResult([self._documents[row] for row in rows],
+                            ids=[self._ids[row] for row in rows],
+                            metadatas=[self._metadatas[row] for row in rows],
+                            embeddings=embeddings)
+
+    def get_ids(self, where: dict = None) -> list[str]:
+        """
+        Retrieves the ids of the entries of a collection, optionally filtered by metadata.
+        :param where: dictionary of key:values to be used when checking metadata to filter the results
+        :return list of ids
+        """
+        with self._lock:
+            return [self._ids[row] for row in range(self._size) if self._matches(row, where)]
+
+    def delete(self, ids: list[str]):
+        """
+        Deletes entries from the collection. Rows are marked as deleted in the metadata sidecar.
+        :param ids: ids of the entries to delete
+        """
+        with self._lock:
+            ids = [x for x in ids if x in self._rows]
+            if len(ids) == 0:
+                return
+            with open(os.path.join(self.path, self.METADATA_FILE), "a", encoding="utf-8") as f:
+                for text_id in ids:
+                    f.write(json.dumps({"deleted": text_id}) + "\n")
+                    self._remove_row(text_id)
+        QueryCache.invalidate(self.path)
+
+    def delete_collection(self):
+        """ deletes a vector store from disk"""
+        with self._lock:
+            self._vectors = None
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.instantiate_client()
+        QueryCache.invalidate(self.path)
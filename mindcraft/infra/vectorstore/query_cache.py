@@ -0,0 +1,177 @@
+import json
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from mindcraft.infra.vectorstore.search_results import SearchResult
+from mindcraft.settings import QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_MAX_BYTES
+
+
+class QueryCache:
+    """
+    Process-wide LRU cache of the results of `Store.query` and `Store.get`, keyed by collection, arguments and the
+    write version of the collection. Every write to a collection bumps its version, so the results cached before
+    are never returned again and are evicted as the least recently used. Writes made by other processes are not
+    noticed.
+    The cache keeps its own copy of every result and returns a new copy on every hit, so callers may modify the
+    results they get. Only the embeddings matrix is shared, and it is read-only.
+    """
+    _entries = OrderedDict()
+    _versions = dict()
+    _lock = threading.Lock()
+    _bytes = 0
+    _stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+    _collection_stats = dict()
+    max_entries = QUERY_CACHE_MAX_ENTRIES
+    max_bytes = QUERY_CACHE_MAX_BYTES
+
+    @staticmethod
+    def normalize_known_by(known_by) -> Optional[tuple]:
+        """
+        Normalizes a `known_by` filter, which has the same meaning regardless of the order of the characters
+        :param known_by: None, a character or a list of characters
+        :return: None or a sorted tuple of characters
+        """
+        if known_by is None:
+            return None
+        if isinstance(known_by, str):
+            return (known_by,)
+        return tuple(sorted(set(str(x) for x in known_by)))
+
+    @staticmethod
+    def normalize_where(where: Optional[dict]) -> Optional[str]:
+        """
+        Normalizes a `where` clause
+        :param where: dictionary of key:values or None
+        :return: None or a canonical string
+        """
+        return json.dumps(where, sort_keys=True, default=str) if where is not None else None
+
+    @staticmethod
+    def _size(result: SearchResult) -> int:
+        """ Approximate number of bytes of a result"""
+        size = sum(len(x) for x in result.documents) + 8 * len(result.distances)
+        if result.embeddings is not None:
+            size += result.embeddings.nbytes
+        return size
+
+    @classmethod
+    def version(cls, collection: str) -> int:
+        """
+        :param collection: path of the collection
+        :return: the write version of the collection
+        """
+        with cls._lock:
+            return cls._versions.get(collection, 0)
+
+    @classmethod
+    def invalidate(cls, collection: str):
+        """
+        Bumps the write version of a collection, so that its cached results are not used anymore. Called by the
+        stores after every write.
+        :param collection: path of the collection
+        """
+        with cls._lock:
+            cls._versions[collection] = cls._versions.get(collection, 0) + 1
+            cls._stats["invalidations"] += 1
+
+    @classmethod
+    def key(cls, collection: str, *args) -> tuple:
+        """
+        Key of a result, with the current version of the collection
+        :param collection: path of the collection
+        :param args: normalized (hashable) arguments of the call
+        :return: the key
+        """
+        return (collection, cls.version(collection)) + args
+
+    @classmethod
+    def get(cls, key: tuple) -> Optional[SearchResult]:
+        """
+        Retrieves a cached result
+        :param key: key built with `key`
+        :return: a copy of the SearchResult or None
+        """
+        with cls._lock:
+            stats = cls._collection_stats.setdefault(key[0], {"hits": 0, "misses": 0})
+            result = cls._entries.get(key)
+            if result is None:
+                cls._stats["misses"] += 1
+                stats["misses"] += 1
+                return None
+            cls._entries.move_to_end(key)
+            cls._stats["hits"] += 1
+            stats["hits"] += 1
+            result = result[0]
+        return result.copy()
+
+    @classmethod
+    def put(cls, key: tuple, result: SearchResult):
+        """
+        Caches a copy of a result, evicting the least recently used ones if the cache is full. Results bigger than
+        `max_bytes` are not cached.
+        :param key: key built with `key`
+        :param result: the SearchResult
+        """
+        size = cls._size(result)
+        if cls.max_entries < 1 or size > cls.max_bytes:
+            return
+        if result.embeddings is not None:
+            result.embeddings.setflags(write=False)
+        result = result.copy()
+        with cls._lock:
+            previous = cls._entries.pop(key, None)
+            if previous is not None:
+                cls._bytes -= previous[1]
+            cls._entries[key] = (result, size)
+            cls._bytes += size
+            while len(cls._entries) > 0 and (len(cls._entries) > cls.max_entries or cls._bytes > cls.max_bytes):
+                _, (_, evicted) = cls._entries.popitem(last=False)
+                cls._bytes -= evicted
+                cls._stats["evictions"] += 1
+
+    @classmethod
+    def cached(cls, collection: str, args: tuple, compute: Callable[[], SearchResult]) -> SearchResult:
+        """
+        Returns the cached result of a call, computing and caching it if needed
+        :param collection: path of the collection
+        :param args: normalized (hashable) arguments of the call
+        :param compute: calculates the result
+        :return: the SearchResult
+        """
+        if cls.max_entries < 1:
+            return compute()
+        # The version is read before computing: if a write happens meanwhile, the result is cached with the old
+        # version and never returned
+        key = cls.key(collection, *args)
+        result = cls.get(key)
+        if result is None:
+            result = compute()
+            cls.put(key, result)
+        return result
+
+    @classmethod
+    def clear(cls):
+        """ Empties the cache"""
+        with cls._lock:
+            cls._entries.clear()
+            cls._bytes = 0
+
+    @classmethod
+    def stats(cls, collection: str = None) -> dict:
+        """
+        Statistics of the cache
+        :param collection: if set, only the `hits`, `misses` and `hit_ratio` of this collection (path)
+        :return: dictionary with `hits`, `misses`, `hit_ratio`, `evictions`, `invalidations`, number of `entries` and
+        `bytes` used
+        """
+        with cls._lock:
+            if collection is not None:
+                stats = dict(cls._collection_stats.get(collection, {"hits": 0, "misses": 0}))
+            else:
+                stats = dict(cls._stats)
+                stats["entries"] = len(cls._entries)
+                stats["bytes"] = cls._bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups > 0 else 0.0
+        return stats
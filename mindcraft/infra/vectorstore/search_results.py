@@ -1,7 +1,117 @@
-from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
 
 
-@dataclass
 class SearchResult:
-    documents: list[str] = field(default_factory=list)
-    distances: list[float] = field(default_factory=list)
+    __slots__ = ("documents", "distances", "ids", "metadatas", "embeddings")
+
+    def __init__(self,
+                 documents: Optional[list[str]] = None,
+                 distances=None,
+                 ids: Optional[list[str]] = None,
+                 metadatas: Optional[list[dict]] = None,
+                 embeddings: Optional[np.ndarray] = None):
+        """
+        Columnar result of a retrieval: one position per entry in every column.
+        :param documents: texts of the entries
+        :param distances: distance of each entry to the query (lower is more similar), as a list of floats with
+        float32 precision. Empty when the entries were not retrieved by similarity (`get`, `get_last`). `scores` has
+        them as a float32 array.
+        :param ids: ids of the entries
+        :param metadatas: metadata of the entries, if retrieved
+        :param embeddings: matrix with the embeddings of the entries, if retrieved
+        """
+        self.documents = documents if documents is not None else []
+        self.distances = np.asarray(distances, dtype=np.float32).tolist() if distances is not None else []
+        self.ids = ids if ids is not None else []
+        self.metadatas = metadatas
+        self.embeddings = embeddings
+
+    @classmethod
+    def from_arrays(cls,
+                    documents: list[str],
+                    distances,
+                    ids: Optional[list[str]] = None,
+                    metadatas: Optional[list[dict]] = None,
+                    embeddings=None,
+                    min_similarity: Optional[float] = None) -> "SearchResult":
+        """
+        Builds a result from the columns returned by a store, without copying the embeddings if they are already a
+        float32 array.
+        :param documents: texts of the entries
+        :param distances: distances of the entries to the query
+        :param ids: ids of the entries
+        :param metadatas: metadata of the entries
+        :param embeddings: embeddings of the entries
+        :param min_similarity: if set, only the entries with a distance lower or equal than it are kept
+        :return: SearchResult
+        """
+        result = cls(documents,
+                     distances,
+                     ids,
+                     metadatas,
+                     np.asarray(embeddings, dtype=np.float32) if embeddings is not None else None)
+        return result.threshold(min_similarity) if min_similarity is not None else result
+
+    @property
+    def scores(self) -> np.ndarray:
+        """ `distances` as a float32 array"""
+        return np.asarray(self.distances, dtype=np.float32)
+
+    def threshold(self, min_similarity: float) -> "SearchResult":
+        """
+        Keeps the entries whose distance is lower or equal than `min_similarity`. As stores return distances and not
+        similarities, `min_similarity` is the max. distance allowed.
+        :param min_similarity: max. distance allowed
+        :return: SearchResult with the selected entries
+        """
+        keep = np.flatnonzero(self.scores <= min_similarity)
+        if len(keep) == len(self.distances):
+            return self
+        return self.take(keep)
+
+    def take(self, positions) -> "SearchResult":
+        """
+        Selects some entries of the result
+        :param positions: positions of the entries to keep, in the order to keep them
+        :return: SearchResult with the selected entries
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        return SearchResult([self.documents[i] for i in positions],
+                            [self.distances[i] for i in positions] if len(self.distances) > 0 else None,
+                            [self.ids[i] for i in positions] if len(self.ids) > 0 else [],
+                            [self.metadatas[i] for i in positions] if self.metadatas is not None else None,
+                            self.embeddings[positions] if self.embeddings is not None else None)
+
+    def head(self, n: int) -> "SearchResult":
+        """
+        :param n: number of entries
+        :return: SearchResult with the first `n` entries
+        """
+        return self if n >= len(self) else self.take(range(max(n, 0)))
+
+    def copy(self) -> "SearchResult":
+        """
+        Shallow copy: the lists of every column (and the metadata dictionaries) are new, while the embeddings matrix is
+        shared
+        :return: SearchResult
+        """
+        result = SearchResult.__new__(SearchResult)
+        result.documents = list(self.documents)
+        result.distances = list(self.distances)
+        result.ids = list(self.ids)
+        result.metadatas = [dict(x) for x in self.metadatas] if self.metadatas is not None else None
+        result.embeddings = self.embeddings
+        return result
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, SearchResult):
+            return NotImplemented
+        return self.documents == other.documents and self.ids == other.ids and self.distances == other.distances
+
+    def __repr__(self) -> str:
+        return f"SearchResult(documents={self.documents}, distances={self.distances}, ids={self.ids})"
@@ -0,0 +1,355 @@
+import json
+import os
+import struct
+from typing import Optional
+
+import numpy as np
+
+from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
+from mindcraft.infra.vectorstore.search_results import SearchResult
+from mindcraft.infra.vectorstore.store import Store
+from mindcraft.infra.vectorstore.visibility_index import VisibilityIndex
+from mindcraft.settings import EMBEDDINGS_BATCH_SIZE
+
+
+class SnapshotStore(Store):
+    MAGIC = b"MINDSNAP"
+    VERSION = 1
+    ALIGNMENT = 64
+
+    def __init__(self, path: str):
+        """
+        Read-only store over a single snapshot file, written with `SnapshotStore.write`. The file is memory-mapped,
+        so opening it does not read the vectors nor the documents, and several worker processes loading the same
+        snapshot share the pages of the OS cache. The layout is:
+            - `MAGIC` and the length of the header (little-endian uint64)
+            - a JSON header with the counts, dtype, embeddings and the offsets of the sections
+            - the normalized vectors, a (count, dimensions) float16/float32 block
+            - the offsets of each entry in the records section (count + 1 uint64)
+            - the records: one JSON `{"id", "document", "metadata"}` per entry
+            - the posting lists: the rows known by each character (int64)
+        Every section starts at a multiple of `ALIGNMENT` bytes.
+        :param path: path of the snapshot file
+        """
+        self.header = self.read_header(path)
+        super().__init__(os.path.dirname(path), os.path.basename(path),
+                         EmbeddingsTypes[self.header["embeddings"]])
+        self.path = path
+        self._count = self.header["count"]
+        self._vectors = None
+        self._offsets = None
+        self._records = None
+        self._postings = dict()
+        self._rows = None
+        self.client = self.instantiate_client()
+
+    @classmethod
+    def read_header(cls, path: str) -> dict:
+        """
+        Reads the header of a snapshot file
+        :param path: path of the snapshot file
+        :return: dictionary with the header
+        """
+        with open(path, "rb") as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise Exception(f"{path} is not a snapshot")
+            length = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(length).decode("utf-8"))
+        if header["version"] > cls.VERSION:
+            raise Exception(f"{path} was written by a newer version (v{header['version']})")
+        header["data_offset"] = cls._align(len(cls.MAGIC) + 8 + length)
+        return header
+
+    @classmethod
+    def write(cls,
+              path: str,
+              ids: list[str],
+              documents: list[str],
+              metadatas: list[dict],
+              vectors: np.ndarray,
+              embeddings: EmbeddingsTypes,
+              dtype: str = "float16",
+              name: str = None):
+        """
+        Writes a snapshot file. The file is written to a temporary path and renamed, so a snapshot being loaded is
+        never partially written.
+        :param path: path of the snapshot file
+        :param ids: ids of the entries
+        :param documents: texts of the entries
+        :param metadatas: metadata of the entries. `known_by` is used to build the posting lists.
+        :param vectors: embeddings of the entries, one per row
+        :param embeddings: type of EmbeddingsType used to calculate the vectors
+        :param dtype: `float16` (half the size) or `float32`
+        :param name: name of the collection, stored in the header
+        """
+        if dtype not in ("float16", "float32"):
+            raise Exception("`dtype` should be `float16` or `float32`")
+        if not len(ids) == len(documents) == len(metadatas) == len(vectors):
+            raise Exception("`ids`, `documents`, `metadatas` and `vectors` should have the same length")
+
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = (vectors / np.where(norms == 0, 1, norms)).astype(dtype)
+
+        records = [json.dumps({"id": ids[i], "document": documents[i], "metadata": metadatas[i]}).encode("utf-8")
+                   for i in range(len(ids))]
+        offsets = np.zeros(len(records) + 1, dtype=np.uint64)
+        offsets[1:] = np.cumsum([len(x) for x in records])
+
+        postings = dict()
+        for row, metadata in enumerate(metadatas):
+            for character in VisibilityIndex.parse((metadata or {}).get("known_by")):
+                postings.setdefault(character, []).append(row)
+
+        # Offsets in the header are relative to the first aligned position after the header
+        sections = [vectors.tobytes(), offsets.tobytes(), b"".join(records)] + \
+                   [np.asarray(x, dtype=np.int64).tobytes() for x in postings.values()]
+        positions = []
+        position = 0
+        for section in sections:
+            positions.append(position)
+            position = cls._align(position + len(section))
+        header = {
+            "version": cls.VERSION,
+            "name": name,
+            "embeddings": embeddings.name,
+            "count": len(ids),
+            "dimensions": int(vectors.shape[1]) if len(ids) > 0 else 0,
+            "dtype": dtype,
+            "vectors_offset": positions[0],
+            "offsets_offset": positions[1],
+            "records_offset": positions[2],
+            "postings": {character: [positions[3 + i], len(rows)]
+                         for i, (character, rows) in enumerate(postings.items())}
+        }
+        encoded = json.dumps(header).encode("utf-8")
+        start = cls._align(len(cls.MAGIC) + 8 + len(encoded))
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(cls.MAGIC)
+            f.write(struct.pack("<Q", len(encoded)))
+            f.write(encoded)
+            for section, section_position in zip(sections, positions):
+                f.seek(start + section_position)
+                f.write(section)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def _align(cls, position: int) -> int:
+        """ Next multiple of `ALIGNMENT`"""
+        return -(-position // cls.ALIGNMENT) * cls.ALIGNMENT
+
+    def instantiate_client(self):
+        """
+        Memory-maps the sections of the snapshot. Nothing is read until it is used.
+        """
+        header = self.header
+        base = header["data_offset"]
+        if self._count > 0:
+            self._vectors = np.memmap(self.path, dtype=header["dtype"], mode="r",
+                                      offset=base + header["vectors_offset"],
+                                      shape=(self._count, header["dimensions"]))
+            self._offsets = np.memmap(self.path, dtype=np.uint64, mode="r", offset=base + header["offsets_offset"],
+                                      shape=(self._count + 1,))
+            if int(self._offsets[-1]) > 0:
+                self._records = np.memmap(self.path, dtype=np.uint8, mode="r", offset=base + header["records_offset"],
+                                          shape=(int(self._offsets[-1]),))
+        for character, (offset, count) in header["postings"].items():
+            self._postings[character] = np.memmap(self.path, dtype=np.int64, mode="r", offset=base + offset,
+                                                  shape=(count,)) if count > 0 else np.empty(0, dtype=np.int64)
+        return None
+
+    def _record(self, row: int) -> dict:
+        """ Decodes the record of a row"""
+        return json.loads(self._records[int(self._offsets[row]):int(self._offsets[row + 1])].tobytes())
+
+    def _rows_to_search_result(self,
+                               rows,
+                               distances: Optional[np.ndarray] = None,
+                               include_embeddings: bool = False) -> SearchResult:
+        """ SearchResult with the entries of some rows"""
+        records = [self._record(row) for row in rows]
+        embeddings = None
+        if include_embeddings:
+            embeddings = np.asarray(self._vectors[np.asarray(rows, dtype=np.int64)], dtype=np.float32) \
+                if len(records) > 0 else np.empty((0, 0), dtype=np.float32)
+        return SearchResult([x["document"] for x in records],
+                            distances,
+                            [x["id"] for x in records],
+                            [x["metadata"] or {} for x in records],
+                            embeddings)
+
+    def _candidates(self, known_by: list, exact_match: str = None) -> np.ndarray:
+        """ Rows known by any of the characters in `known_by` and containing `exact_match`"""
+        postings = [self._postings[x] for x in VisibilityIndex.parse(known_by) if x in self._postings]
+        if len(postings) == 0:
+            return np.empty(0, dtype=np.int64)
+        candidates = np.asarray(postings[0]) if len(postings) == 1 else np.unique(np.concatenate(postings))
+        if exact_match is None:
+            return candidates
+        return np.fromiter((x for x in candidates if exact_match in self._record(x)["document"]), dtype=np.int64)
+
+    def _top(self, queries: np.ndarray, candidates: np.ndarray, k: int) -> list[tuple[np.ndarray, np.ndarray]]:
+        """ Exact top-k of several normalized queries among the candidate rows, with one matrix product"""
+        similarities = np.asarray(self._vectors[candidates], dtype=np.float32) @ queries.T
+        k = min(k, len(candidates))
+        top = np.argpartition(-similarities, k - 1, axis=0)[:k]
+        found = []
+        for i in range(queries.shape[0]):
+            column = top[:, i]
+            column = column[np.argsort(-similarities[column, i])]
+            found.append((candidates[column], similarities[column, i]))
+        return found
+
+    def _normalized_queries(self, texts: list[str]) -> np.ndarray:
+        """ Embeddings of the queries, normalized"""
+        queries = self.get_query_embeddings(texts)
+        return queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+    def _query(self,
+               text: str,
+               num_results: int,
+               known_by: list,
+               exact_match: str = None,
+               min_similarity: float = 0.85) -> SearchResult:
+        """
+        Cosine top-k retrieval over the memory-mapped vectors
+        :param text: Text to retrieve similar entries from
+        :param num_results: Max. number of results
+        :param known_by: Filter the entries in the vector store by the character's id. use settings.`ALL` for pieces of
+        lore known to everyone
+        :param exact_match: Filter the entries by a text you want to appear explicitly
+        :param min_similarity: The minimum similarity the document should have compared to the topic
+        :return: SearchResults class
+        """
+        return self._query_many([text], [known_by], num_results, exact_match, min_similarity)[0]
+
+    def _query_many(self,
+                    texts: list[str],
+                    known_by_per_query: list[list],
+                    num_results: int,
+                    exact_match: str = None,
+                    min_similarity: float = 0.85) -> list[SearchResult]:
+        """
+        Cosine top-k retrieval for several texts at once, scoring the texts sharing the same `known_by` filter with
+        a single matrix product
+        :param texts: Texts to retrieve similar entries from
+        :param known_by_per_query: One `known_by` filter (list of characters) per text
+        :param num_results: Max. number of results per text
+        :param exact_match: Filter the entries by a text you want to appear explicitly
+        :param min_similarity: The minimum similarity the document should have compared to the topic
+        :return: one SearchResult per text
+        """
+        if len(texts) != len(known_by_per_query):
+            raise Exception("`texts` and `known_by_per_query` should have the same length")
+        results = [SearchResult() for _ in texts]
+        if len(texts) == 0 or num_results < 1:
+            return results
+
+        queries = self._normalized_queries(texts)
+        groups = dict()
+        for i, known_by in enumerate(known_by_per_query):
+            groups.setdefault(tuple(known_by), []).append(i)
+        for known_by, positions in groups.items():
+            candidates = self._candidates(list(known_by), exact_match)
+            if len(candidates) == 0:
+                continue
+            for position, (rows, similarities) in zip(positions, self._top(queries[positions], candidates,
+                                                                            num_results)):
+                # Squared L2 between normalized vectors, as the other stores
+                distances = (2 - 2 * similarities).astype(np.float32)
+                keep = distances <= min_similarity
+                results[position] = self._rows_to_search_result(rows[keep], distances[keep])
+        return results
+
+    def score(self, text: str, ids: list[str]) -> SearchResult:
+        """
+        Calculates the distance of a text to some entries of the snapshot
+        :param text: Text to compare the entries with
+        :param ids: ids of the entries
+        :return: SearchResult with the entries found, from the closest to the furthest
+        """
+        rows = np.array([self._row_of(x) for x in ids if self._row_of(x) is not None], dtype=np.int64)
+        if len(rows) == 0:
+            return SearchResult()
+        similarities = np.asarray(self._vectors[rows], dtype=np.float32) @ self._normalized_queries([text])[0]
+        order = np.argsort(-similarities, kind="stable")
+        return self._rows_to_search_result(rows[order], (2 - 2 * similarities[order]).astype(np.float32))
+
+    def _row_of(self, text_id: str) -> Optional[int]:
+        """ Row of an id. The map of ids is built the first time it is needed."""
+        if self._rows is None:
+            self._rows = {x: i for i, x in enumerate(self.get_ids())}
+        return self._rows.get(text_id)
+
+    def count(self) -> int:
+        """
+        Counts the number of items in the snapshot
+        :return: integer with the number of items
+        """
+        return self._count
+
+    def _get(self,
+             where: dict,
+             limit: int = None,
+             include_embeddings: bool = False,
+             ids: list[str] = None) -> SearchResult:
+        """
+        Retrieves the entries of the snapshot whose metadata matches a `where` (dict) clause.
+        :param where: dictionary of key:values to be used when checking metadata to filter the results
+        :param limit: max. number of entries to retrieve. By default, all of them.
+        :param include_embeddings: retrieve the embeddings of the entries as well
+        :param ids: only retrieve the entries with these ids
+        :return SearchResult
+        """
+        rows = []
+        selected = range(self._count) if ids is None else \
+            sorted(row for row in (self._row_of(x) for x in ids) if row is not None)
+        for row in selected:
+            if limit is not None and len(rows) >= limit:
+                break
+            if where is None or all((self._record(row)["metadata"] or {}).get(k) == v for k, v in where.items()):
+                rows.append(row)
+        return self._rows_to_search_result(rows, include_embeddings=include_embeddings)
+
+    def get_last(self, n: int = 5, include_embeddings: bool = False) -> SearchResult:
+        """
+        Retrieves the last `n` entries of the snapshot
+        :param n: number of entries
+        :param include_embeddings: retrieve the embeddings of the entries as well
+        :return SearchResult
+        """
+        return self._rows_to_search_result(range(max(self._count - n, 0), self._count),
+                                           include_embeddings=include_embeddings)
+
+    def get_ids(self, where: dict = None) -> list[str]:
+        """
+        Retrieves the ids of the entries of the snapshot, optionally filtered by metadata.
+        :param where: dictionary of key:values to be used when checking metadata to filter the results
+        :return list of ids
+        """
+        return self.get(where).ids
+
+    def add_to_collection(self, text: str, metadata: Optional[dict], text_id: str,
+                          use_embeddings_cache: bool = False):
+        """ Snapshots are read-only"""
+        raise Exception("Snapshots are read-only. Load the world from its store to add lore.")
+
+    def add_many(self, texts: list[str], metadatas: Optional[list[dict]], ids: list[str],
+                 batch_size: int = EMBEDDINGS_BATCH_SIZE, use_embeddings_cache: bool = False):
+        """ Snapshots are read-only"""
+        raise Exception("Snapshots are read-only. Load the world from its store to add lore.")
+
+    def add_embeddings(self, texts: list[str], embeddings: np.ndarray, metadatas: Optional[list[dict]],
+                       ids: list[str]):
+        """ Snapshots are read-only"""
+        raise Exception("Snapshots are read-only. Load the world from its store to add lore.")
+
+    def delete(self, ids: list[str]):
+        """ Snapshots are read-only"""
+        raise Exception("Snapshots are read-only. Load the world from its store to delete lore.")
+
+    def delete_collection(self):
+        """ Snapshots are read-only"""
+        raise Exception("Snapshots are read-only. Delete the file instead.")
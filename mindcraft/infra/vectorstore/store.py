@@ -1,7 +1,15 @@
+import os
 from typing import Optional
 
+import numpy as np
+
+from mindcraft.infra.embeddings.embeddings_cache import EmbeddingsCache
+from mindcraft.infra.embeddings.embeddings_disk_cache import EmbeddingsDiskCache
+from mindcraft.infra.embeddings.embeddings_registry import EmbeddingsRegistry
+from mindcraft.infra.vectorstore.query_cache import QueryCache
 from mindcraft.infra.vectorstore.search_results import SearchResult
 from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
+from mindcraft.settings import EMBEDDINGS_BATCH_SIZE
 
 
 class Store:
@@ -24,10 +32,38 @@ class Store:
 
     def get_embeddings(self, text):
         """
-        Transforms text to embeddings using the EmbeddingsType you selected in the constructor
+        Transforms text to embeddings using the EmbeddingsType you selected in the constructor. The model is loaded
+        once per process and shared by all the stores (see `EmbeddingsRegistry`). Used for queries, so the result is
+        kept in the `EmbeddingsCache` shared by all the stores.
         :param text: Text to calculate embeddings from
         """
-        raise NotImplementedError()
+        return self.get_query_embeddings([text]).tolist()
+
+    def get_query_embeddings(self, texts: list[str]) -> np.ndarray:
+        """
+        Transforms the texts of queries to embeddings, reusing those cached in the `EmbeddingsCache`
+        :param texts: Texts to calculate embeddings from
+        :return: a float32 matrix with one row per text
+        """
+        return EmbeddingsCache.encode(self.embeddings, texts)
+
+    def get_batch_embeddings(self,
+                             texts: list[str],
+                             batch_size: int = EMBEDDINGS_BATCH_SIZE,
+                             use_embeddings_cache: bool = False) -> np.ndarray:
+        """
+        Transforms a list of texts to embeddings in batches of `batch_size`
+        :param texts: Texts to calculate embeddings from
+        :param batch_size: Number of texts sent to the model at once
+        :param use_embeddings_cache: Look up the texts in the persistent `EmbeddingsDiskCache` first, and persist
+        the new embeddings there. The cache is kept in the `embeddings` folder next to the collection, so it is
+        shared by the collections stored in the same path.
+        :return: a float32 matrix with one row per text
+        """
+        if use_embeddings_cache:
+            cache_path = os.path.join(os.path.dirname(self.path), "embeddings")
+            return EmbeddingsDiskCache.get_instance(self.embeddings, cache_path).encode(texts, batch_size)
+        return EmbeddingsRegistry.encode(self.embeddings, texts, batch_size)
 
     def query(self,
               text: str,
@@ -36,7 +72,7 @@ class Store:
               exact_match: str = None,
               min_similarity: float = 0.85) -> SearchResult:
         """
-        Implementation of the retrieval function
+        Retrieval function. Results are cached in the `QueryCache` until the collection is written.
         :param text: Text to retrieve similar entries from
         :param num_results: Max. number of results
         :param known_by: Filter the entries in the vector store by the character's id. use settings.`ALL` for pieces of
@@ -45,18 +81,125 @@ class Store:
         :param min_similarity: The minimum similarity the document should have compared to the topic
         :return SearchResult
         """
+        return QueryCache.cached(self.path,
+                                 self._query_key(text, num_results, known_by, exact_match, min_similarity),
+                                 lambda: self._query(text, num_results, known_by, exact_match, min_similarity))
+
+    @staticmethod
+    def _query_key(text: str, num_results: int, known_by, exact_match: Optional[str], min_similarity: float) -> tuple:
+        """ Normalized arguments of a query, used as key of the `QueryCache`"""
+        return "query", text, num_results, QueryCache.normalize_known_by(known_by), exact_match, float(min_similarity)
+
+    def _query(self,
+               text: str,
+               num_results: int,
+               known_by: list,
+               exact_match: str = None,
+               min_similarity: float = 0.85) -> SearchResult:
+        """
+        Implementation of the retrieval function, without cache. See `query`.
+        """
+        raise NotImplementedError()
+
+    def query_many(self,
+                   texts: list[str],
+                   known_by_per_query: list[list],
+                   num_results: int,
+                   exact_match: str = None,
+                   min_similarity: float = 0.85) -> list[SearchResult]:
+        """
+        Retrieval for several texts at once. Only the queries which are not in the `QueryCache` are run.
+        :param texts: Texts to retrieve similar entries from
+        :param known_by_per_query: One `known_by` filter (list of characters) per text
+        :param num_results: Max. number of results per text
+        :param exact_match: Filter the entries by a text you want to appear explicitly
+        :param min_similarity: The minimum similarity the document should have compared to the topic
+        :return: one SearchResult per text
+        """
+        if len(texts) != len(known_by_per_query):
+            raise Exception("`texts` and `known_by_per_query` should have the same length")
+        keys = [QueryCache.key(self.path, *self._query_key(text, num_results, known_by, exact_match, min_similarity))
+                for text, known_by in zip(texts, known_by_per_query)]
+        results = [QueryCache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if len(missing) > 0:
+            computed = self._query_many([texts[i] for i in missing],
+                                        [known_by_per_query[i] for i in missing],
+                                        num_results,
+                                        exact_match,
+                                        min_similarity)
+            for i, result in zip(missing, computed):
+                QueryCache.put(keys[i], result)
+                results[i] = result
+        return results
+
+    def _query_many(self,
+                    texts: list[str],
+                    known_by_per_query: list[list],
+                    num_results: int,
+                    exact_match: str = None,
+                    min_similarity: float = 0.85) -> list[SearchResult]:
+        """
+        Retrieval for several texts at once, without cache. The queries are embedded in a single batch. Stores which
+        can search for all the queries at once override this method.
+        """
+        # Embeds all the queries in one batch. `_query` will find them in the `EmbeddingsCache`.
+        self.get_query_embeddings(texts)
+        return [self._query(text, num_results, known_by, exact_match, min_similarity)
+                for text, known_by in zip(texts, known_by_per_query)]
+
+    def score(self, text: str, ids: list[str]) -> SearchResult:
+        """
+        Calculates the distance of a text to some entries of the collection, for example those selected by a
+        lexical index.
+        :param text: Text to compare the entries with
+        :param ids: ids of the entries
+        :return: SearchResult with the entries found, from the closest to the furthest
+        """
         raise NotImplementedError()
 
     def add_to_collection(self,
                           text_id: str,
                           text: str,
-                          metadata: Optional[dict]):
+                          metadata: Optional[dict],
+                          use_embeddings_cache: bool = False):
         """
         Adds a text to a collection, after calculating its embeddings.
         It accepts metadata as well to filter the results during retrieval.
         :param text: Text to be transformed into embeddings and stored.
         :param metadata: Dictionary with any key:value pair you want to store, e.g `known_by`: `galadriel`
         :param text_id: A unique id of the text
+        :param use_embeddings_cache: Reuse the embeddings from the persistent `EmbeddingsDiskCache` if available
+        """
+        raise NotImplementedError()
+
+    def add_many(self,
+                 texts: list[str],
+                 metadatas: Optional[list[dict]],
+                 ids: list[str],
+                 batch_size: int = EMBEDDINGS_BATCH_SIZE,
+                 use_embeddings_cache: bool = False):
+        """
+        Adds several texts to a collection at once. Embeddings are calculated and written in batches of `batch_size`.
+        :param texts: Texts to be transformed into embeddings and stored.
+        :param metadatas: One dictionary of metadata per text (or None)
+        :param ids: One unique id per text
+        :param batch_size: Number of texts embedded and inserted at once
+        :param use_embeddings_cache: Reuse the embeddings from the persistent `EmbeddingsDiskCache` if available
+        """
+        raise NotImplementedError()
+
+    def add_embeddings(self,
+                       texts: list[str],
+                       embeddings: np.ndarray,
+                       metadatas: Optional[list[dict]],
+                       ids: list[str]):
+        """
+        Adds several texts to a collection whose embeddings were already calculated.
+        :param texts: Texts to be stored.
+        :param embeddings: matrix with the embeddings of the texts, one per row
+        :param metadatas: One dictionary of metadata per text (or None)
+        :param ids: One unique id per text
         """
         raise NotImplementedError()
 
@@ -67,14 +210,62 @@ class Store:
         """
         raise NotImplementedError()
 
-    def get(self, where: dict) -> SearchResult:
+    def get(self,
+            where: dict,
+            limit: int = None,
+            include_embeddings: bool = False,
+            ids: list[str] = None) -> SearchResult:
         """
-        `get` method that queries a collection using a `where` (dict) clause, that checks metadata.
+        `get` method that queries a collection using a `where` (dict) clause, that checks metadata. Results are
+        cached in the `QueryCache` until the collection is written, except full dumps of the collection (no `where`,
+        `limit` nor `ids`).
         :param where: dictionary of key:values to be used when checking metadata to filter the results
+        :param limit: max. number of entries to retrieve. By default, all of them.
+        :param include_embeddings: retrieve the embeddings of the entries as well
+        :param ids: only retrieve the entries with these ids
+        :return SearchResult
+        """
+        if where is None and limit is None and ids is None:
+            return self._get(where, limit, include_embeddings, ids)
+        return QueryCache.cached(self.path,
+                                 ("get", QueryCache.normalize_where(where), limit, include_embeddings,
+                                  tuple(ids) if ids is not None else None),
+                                 lambda: self._get(where, limit, include_embeddings, ids))
+
+    def _get(self,
+             where: dict,
+             limit: int = None,
+             include_embeddings: bool = False,
+             ids: list[str] = None) -> SearchResult:
+        """
+        Implementation of `get`, without cache. See `get`.
+        """
+        raise NotImplementedError()
+
+    def get_last(self, n: int = 5, include_embeddings: bool = False) -> SearchResult:
+        """
+        `get` method modified to get last `n` entries
+        :param n: number of entries
+        :param include_embeddings: retrieve the embeddings of the entries as well
         :return SearchResult
         """
         raise NotImplementedError()
 
+    def get_ids(self, where: dict = None) -> list[str]:
+        """
+        Retrieves the ids of the entries of a collection, optionally filtered by metadata.
+        :param where: dictionary of key:values to be used when checking metadata to filter the results
+        :return list of ids
+        """
+        raise NotImplementedError()
+
+    def delete(self, ids: list[str]):
+        """
+        Deletes entries from a collection
+        :param ids: ids of the entries to delete
+        """
+        raise NotImplementedError()
+
     def delete_collection(self):
         """ deletes a vector store from disk"""
         raise NotImplementedError()
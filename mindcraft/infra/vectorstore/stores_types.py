@@ -3,4 +3,7 @@ from enum import Enum
 
 class StoresTypes(Enum):
     CHROMA = 0
+    NUMPY = 1
+    HNSW = 2
+    SNAPSHOT = 3
 
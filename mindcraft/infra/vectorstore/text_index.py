@@ -0,0 +1,230 @@
+import math
+import re
+import threading
+from typing import Optional, Union
+
+from mindcraft.infra.vectorstore.visibility_index import VisibilityIndex
+
+
+class TextIndex:
+    TOKEN_PATTERN = re.compile(r"\w+")
+    GRAM_SIZE = 3
+    # Marks the start and end of a token in its n-grams. They cannot be part of a token.
+    START, END = "^", "$"
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        """
+        Token-level inverted index of the documents of a collection, used to select the candidates of literal
+        (`exact_match`) lookups and for lexical (BM25) retrieval. The tokens of the vocabulary are also indexed by
+        their character n-grams, to find the partial tokens a literal may start or end with. It only lives in memory
+        and keeps no texts: it is built from the store the first time it is needed, and the texts are read from the
+        store.
+        :param k1: BM25 term frequency saturation
+        :param b: BM25 length normalization
+        """
+        self._k1 = k1
+        self._b = b
+        self._lock = threading.RLock()
+        self._tokens = dict()
+        self._known_by = dict()
+        self._lengths = dict()
+        self._order = dict()
+        self._postings = dict()
+        self._grams = dict()
+        self._total_length = 0
+        self._sequence = 0
+
+    @classmethod
+    def tokenize(cls, text: str) -> list[str]:
+        """
+        Splits a text into lowercase tokens
+        :param text: the text
+        :return: list of tokens
+        """
+        return cls.TOKEN_PATTERN.findall(text.lower())
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    @classmethod
+    def grams(cls, token: str) -> set[str]:
+        """
+        Character n-grams of a token (or part of a token) marked with `START` and `END`, of `GRAM_SIZE` characters
+        or the whole text if it is shorter. The n-grams of a token are indexed with all the shorter ones, so that
+        short parts of tokens can be looked up too.
+        :param token: the token, which may include the markers
+        :return: set of n-grams
+        """
+        if len(token) <= cls.GRAM_SIZE:
+            return {token}
+        return {token[i:i + cls.GRAM_SIZE] for i in range(len(token) - cls.GRAM_SIZE + 1)}
+
+    def _add_token(self, token: str):
+        """ Indexes a new token of the vocabulary by its n-grams"""
+        marked = f"{self.START}{token}{self.END}"
+        for size in range(1, self.GRAM_SIZE + 1):
+            for i in range(len(marked) - size + 1):
+                self._grams.setdefault(marked[i:i + size], set()).add(token)
+
+    def _remove_token(self, token: str):
+        """ Removes a token which is not in the vocabulary anymore from the n-grams index"""
+        marked = f"{self.START}{token}{self.END}"
+        for size in range(1, self.GRAM_SIZE + 1):
+            for i in range(len(marked) - size + 1):
+                tokens = self._grams.get(marked[i:i + size])
+                if tokens is not None:
+                    tokens.discard(token)
+                    if len(tokens) == 0:
+                        del self._grams[marked[i:i + size]]
+
+    def _matching_tokens(self, part: str) -> set[str]:
+        """
+        Tokens of the vocabulary which contain a part of a token
+        :param part: the part, with `START` if the token has to start with it and `END` if it has to end with it
+        :return: set of tokens
+        """
+        if part.startswith(self.START) and part.endswith(self.END):
+            token = part[1:-1]
+            return {token} if token in self._postings else set()
+        matching = None
+        for gram in sorted(self.grams(part), key=lambda x: len(self._grams.get(x, ()))):
+            tokens = self._grams.get(gram)
+            if tokens is None:
+                return set()
+            matching = set(tokens) if matching is None else matching.intersection(tokens)
+            if len(matching) == 0:
+                return matching
+        if len(part) <= self.GRAM_SIZE:
+            return matching
+        return {x for x in matching if part in f"{self.START}{x}{self.END}"}
+
+    def _add(self, doc_id: str, text: str, known_by: Union[str, list, None]):
+        """ Indexes a document"""
+        self._remove(doc_id)
+        tokens = self.tokenize(text)
+        self._tokens[doc_id] = tuple(set(tokens))
+        self._known_by[doc_id] = frozenset(VisibilityIndex.parse(known_by))
+        self._lengths[doc_id] = len(tokens)
+        self._order[doc_id] = self._sequence
+        self._sequence += 1
+        self._total_length += len(tokens)
+        for token in tokens:
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = dict()
+                self._add_token(token)
+            postings[doc_id] = postings.get(doc_id, 0) + 1
+
+    def _remove(self, doc_id: str):
+        """ Removes a document"""
+        tokens = self._tokens.pop(doc_id, None)
+        if tokens is None:
+            return
+        self._known_by.pop(doc_id)
+        self._order.pop(doc_id)
+        self._total_length -= self._lengths.pop(doc_id)
+        for token in tokens:
+            postings = self._postings.get(token)
+            if postings is not None:
+                postings.pop(doc_id, None)
+                if len(postings) == 0:
+                    del self._postings[token]
+                    self._remove_token(token)
+
+    def add_many(self, ids: list[str], texts: list[str], known_by: list[Union[str, list, None]]):
+        """
+        Indexes several documents. Documents already indexed with the same id are replaced.
+        :param ids: ids of the documents
+        :param texts: texts of the documents
+        :param known_by: characters who know each document (list or string joined by `SEPARATOR`)
+        """
+        with self._lock:
+            for i in range(len(ids)):
+                self._add(ids[i], texts[i], known_by[i])
+
+    def add(self, doc_id: str, text: str, known_by: Union[str, list, None]):
+        """
+        Indexes a document. A document already indexed with the same id is replaced.
+        :param doc_id: id of the document
+        :param text: text of the document
+        :param known_by: characters who know the document (list or string joined by `SEPARATOR`)
+        """
+        self.add_many([doc_id], [text], [known_by])
+
+    def delete(self, ids: list[str]):
+        """
+        Removes documents from the index
+        :param ids: ids of the documents
+        """
+        with self._lock:
+            for doc_id in ids:
+                self._remove(doc_id)
+
+    def clear(self):
+        """ Removes all the documents"""
+        with self._lock:
+            self._tokens, self._known_by, self._lengths, self._order = dict(), dict(), dict(), dict()
+            self._postings, self._grams = dict(), dict()
+            self._total_length = 0
+
+    def _is_known(self, doc_id: str, known_by: Optional[set]) -> bool:
+        """ Checks if any of the characters know a document. If `known_by` is None, every document is known."""
+        return known_by is None or not self._known_by[doc_id].isdisjoint(known_by)
+
+    def candidates(self, phrase: str, known_by: Optional[list] = None) -> list[str]:
+        """
+        Documents which may contain a phrase as a substring, as ChromaDB `$contains` does. The tokens inside the
+        phrase are whole tokens of the document, and are looked up in the postings. The first one may be the end of a
+        token of the document and the last one its start, so they are looked up in the n-grams index. The caller
+        checks the literal phrase.
+        :param phrase: the literal text to find
+        :param known_by: only documents known by any of these characters. If None, all documents.
+        :return: ids of the candidate documents, in the order they were indexed
+        """
+        known_by = set(known_by) if known_by is not None else None
+        phrase = phrase.lower()
+        with self._lock:
+            parts = set()
+            for match in self.TOKEN_PATTERN.finditer(phrase):
+                parts.add(f"{self.START if match.start() > 0 else ''}{match.group()}"
+                          f"{self.END if match.end() < len(phrase) else ''}")
+            if len(parts) == 0:
+                return [x for x in self._tokens if self._is_known(x, known_by)]
+
+            candidates = None
+            # Whole tokens first, as they are the cheapest to look up and usually the most selective
+            for part in sorted(parts, key=lambda x: (not (x.startswith(self.START) and x.endswith(self.END)), -len(x))):
+                matching = set()
+                for token in self._matching_tokens(part):
+                    matching.update(self._postings[token])
+                candidates = matching if candidates is None else candidates.intersection(matching)
+                if len(candidates) == 0:
+                    break
+            return sorted((x for x in candidates if self._is_known(x, known_by)), key=self._order.get)
+
+    def search(self, query: str, num_results: int, known_by: Optional[list] = None) -> list[tuple[str, float]]:
+        """
+        BM25 retrieval
+        :param query: text of the query
+        :param num_results: max. number of results
+        :param known_by: only documents known by any of these characters. If None, all documents.
+        :return: list of (id, score), from the highest to the lowest score
+        """
+        known_by = set(known_by) if known_by is not None else None
+        with self._lock:
+            if len(self._tokens) == 0:
+                return []
+            n = len(self._tokens)
+            average_length = self._total_length / n
+            scores = dict()
+            for token in set(self.tokenize(query)):
+                postings = self._postings.get(token)
+                if postings is None:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    if not self._is_known(doc_id, known_by):
+                        continue
+                    norm = self._k1 * (1 - self._b + self._b * self._lengths[doc_id] / max(average_length, 1e-12))
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self._k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda x: -x[1])[:num_results]
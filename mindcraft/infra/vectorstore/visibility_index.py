@@ -0,0 +1,200 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Optional, Union
+
+import numpy as np
+
+from mindcraft.settings import SEPARATOR
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows. Ids are then only consistent within the process.
+    fcntl = None
+
+
+class VisibilityIndex:
+    FLAG_PREFIX = "known_by_"
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        Index of which characters know each entry of a store. Every character gets an integer id, every entry a
+        bitset of the ids of the characters who know it, and every character a posting list of the entries they know.
+        Queries use the posting lists to pre-filter the candidates before calculating any similarity.
+        :param path: json file where to persist the ids of the characters, so that they are stable across processes.
+        New ids are assigned under a file lock, so that several processes (or stores) sharing the file never give the
+        same id to different characters. If None, ids only live in memory.
+        """
+        self._path = path
+        self._lock = threading.RLock()
+        self._ids = dict()
+        self._masks = []
+        self._postings = []
+        self._cache = dict()
+        self._load()
+
+    @staticmethod
+    def parse(known_by: Union[str, list, None]) -> list[str]:
+        """
+        Normalizes the `known_by` of an entry or a query
+        :param known_by: list of characters or string of characters joined by `SEPARATOR`
+        :return: list of characters
+        """
+        if known_by is None:
+            return []
+        if isinstance(known_by, str):
+            return [x for x in known_by.split(SEPARATOR) if len(x) > 0]
+        return list(known_by)
+
+    @contextmanager
+    def _file_lock(self):
+        """ Exclusive lock on the file of ids, shared by all the processes using it"""
+        if self._path is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        with open(f"{self._path}.lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        """ Reads the ids of the characters from disk"""
+        if self._path is None or not os.path.exists(self._path):
+            return
+        with open(self._path, "r", encoding="utf-8") as f:
+            for name in json.load(f):
+                if name not in self._ids:
+                    self._ids[name] = len(self._ids)
+                    self._postings.append([])
+
+    def _save(self):
+        """ Writes the ids of the characters to disk. Called under `_file_lock`."""
+        if self._path is None:
+            return
+        names = sorted(self._ids, key=self._ids.get)
+        with open(f"{self._path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(names, f)
+        os.replace(f"{self._path}.tmp", self._path)
+
+    def character_id(self, name: str, create: bool = True) -> Optional[int]:
+        """
+        Integer id of a character
+        :param name: the name of the character
+        :param create: assign a new id if the character does not have one yet
+        :return: the id, or None if the character has no id and `create` is False
+        """
+        with self._lock:
+            if name not in self._ids and create:
+                with self._file_lock():
+                    # Another process may have registered characters in the meantime
+                    self._load()
+                    if name not in self._ids:
+                        self._ids[name] = len(self._ids)
+                        self._postings.append([])
+                        self._save()
+            return self._ids.get(name)
+
+    def mask(self, known_by: Union[str, list, None], create: bool = False) -> int:
+        """
+        Bitset of a list of characters
+        :param known_by: list of characters or string of characters joined by `SEPARATOR`
+        :param create: assign ids to the characters which do not have one yet
+        :return: integer with the bit of every character set
+        """
+        mask = 0
+        for name in self.parse(known_by):
+            character_id = self.character_id(name, create)
+            if character_id is not None:
+                mask |= 1 << character_id
+        return mask
+
+    def add(self, row: int, known_by: Union[str, list, None]):
+        """
+        Indexes the characters who know an entry
+        :param row: position of the entry in the store
+        :param known_by: list of characters or string of characters joined by `SEPARATOR`
+        """
+        with self._lock:
+            mask = self.mask(known_by, create=True)
+            if row >= len(self._masks):
+                self._masks.extend([0] * (row + 1 - len(self._masks)))
+            self._masks[row] = mask
+            for character_id in range(mask.bit_length()):
+                if mask >> character_id & 1:
+                    self._postings[character_id].append(row)
+                    self._cache.pop(character_id, None)
+
+    def remove(self, row: int):
+        """
+        Removes an entry from the index
+        :param row: position of the entry in the store
+        """
+        with self._lock:
+            if row < len(self._masks):
+                mask = self._masks[row]
+                self._masks[row] = 0
+                for character_id in range(mask.bit_length()):
+                    if mask >> character_id & 1:
+                        self._cache.pop(character_id, None)
+
+    def knows(self, row: int, known_by: Union[str, list, None]) -> bool:
+        """
+        Checks if any of the characters know an entry
+        :param row: position of the entry in the store
+        :param known_by: list of characters or string of characters joined by `SEPARATOR`
+        """
+        return row < len(self._masks) and self._masks[row] & self.mask(known_by) != 0
+
+    def candidates(self, known_by: Union[str, list, None]) -> np.ndarray:
+        """
+        Entries known by any of the characters
+        :param known_by: list of characters or string of characters joined by `SEPARATOR`
+        :return: sorted array of rows
+        """
+        with self._lock:
+            postings = []
+            for name in self.parse(known_by):
+                character_id = self._ids.get(name)
+                if character_id is None:
+                    continue
+                if character_id not in self._cache:
+                    bit = 1 << character_id
+                    rows = [x for x in self._postings[character_id] if self._masks[x] & bit]
+                    self._postings[character_id] = rows
+                    self._cache[character_id] = np.array(rows, dtype=np.int64)
+                postings.append(self._cache[character_id])
+        if len(postings) == 0:
+            return np.empty(0, dtype=np.int64)
+        if len(postings) == 1:
+            return postings[0]
+        return np.unique(np.concatenate(postings))
+
+    def flags(self, known_by: Union[str, list, None]) -> dict:
+        """
+        Metadata flags with the characters who know an entry, for stores which filter by metadata themselves
+        :param known_by: list of characters or string of characters joined by `SEPARATOR`
+        :return: dictionary with a `known_by_<id>` key set to 1 per character
+        """
+        return {f"{self.FLAG_PREFIX}{self.character_id(name)}": 1 for name in self.parse(known_by)}
+
+    def where(self, known_by: Union[str, list, None]) -> dict:
+        """
+        Metadata clause matching the entries known by any of the characters. Entries stored without flags are
+        matched by their `known_by` value.
+        :param known_by: list of characters or string of characters joined by `SEPARATOR`
+        :return: dictionary with the where clause
+        """
+        clauses = []
+        for name in self.parse(known_by):
+            character_id = self.character_id(name, create=False)
+            if character_id is not None:
+                clauses.append({f"{self.FLAG_PREFIX}{character_id}": 1})
+            clauses.append({"known_by": name})
+        return clauses[0] if len(clauses) == 1 else {"$or": clauses}
@@ -0,0 +1,185 @@
+import atexit
+import logging
+import threading
+import time
+import weakref
+from typing import Callable, Optional
+
+import numpy as np
+
+from mindcraft.infra.vectorstore.store import Store
+from mindcraft.settings import WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_MAX_DELAY, LOGGER_FORMAT, DATE_FORMAT
+
+logging.basicConfig(format=LOGGER_FORMAT, datefmt=DATE_FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Queues which are still open, flushed when the interpreter exits
+_open_queues = weakref.WeakSet()
+
+
+@atexit.register
+def _close_open_queues():
+    """ Flushes the pending writes of every open queue"""
+    for queue in list(_open_queues):
+        try:
+            queue.close()
+        except Exception as e:
+            logger.error(f"Unable to flush the write-behind queue of `{queue.collection_name}`: {e}")
+
+
+class WriteBehindQueue:
+    def __init__(self,
+                 store: Store,
+                 batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+                 max_delay: float = WRITE_BEHIND_MAX_DELAY,
+                 on_write: Optional[Callable[[list[str], list[str], np.ndarray], None]] = None):
+        """
+        Buffers writes to a store and performs them in a background thread: the texts are embedded in one batch and
+        stored with `Store.add_embeddings`. Pending writes are flushed when `batch_size` of them are queued, when
+        the oldest has waited `max_delay` seconds, when `flush` is called and when the interpreter exits.
+        The background thread only holds a weak reference to the queue, so a queue which is not used anymore (for
+        example, the one of a discarded NPC) is garbage collected: its pending writes are stored then, and the thread
+        ends.
+        :param store: the store to write to
+        :param batch_size: number of pending writes which triggers a flush
+        :param max_delay: max. seconds a write waits before being flushed
+        :param on_write: called after every flush with the ids, texts and embeddings written
+        """
+        self._store = store
+        self._batch_size = max(batch_size, 1)
+        self._max_delay = max_delay
+        self._on_write = on_write
+        self._pending = []
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._closed = False
+        self._error = None
+        self._thread = threading.Thread(target=WriteBehindQueue._run,
+                                        args=(weakref.ref(self), self._condition),
+                                        daemon=True,
+                                        name=f"write-behind-{store.collection_name}")
+        self._thread.start()
+        self._finalizer = weakref.finalize(self, WriteBehindQueue._finalize, store, self._pending, self._condition)
+        _open_queues.add(self)
+
+    @property
+    def collection_name(self) -> str:
+        """ Name of the collection written"""
+        return self._store.collection_name
+
+    def __len__(self) -> int:
+        """ Number of pending writes"""
+        with self._condition:
+            return len(self._pending)
+
+    def put(self, text: str, metadata: Optional[dict], text_id: str):
+        """
+        Queues a write
+        :param text: text to be embedded and stored
+        :param metadata: metadata of the text
+        :param text_id: unique id of the text
+        """
+        with self._condition:
+            if self._closed:
+                raise Exception("The write-behind queue is closed")
+            self._pending.append((text, metadata, text_id))
+            if len(self._pending) == 1 or len(self._pending) >= self._batch_size:
+                # Starts the timer of the first write or flushes a full batch
+                self._condition.notify()
+
+    @staticmethod
+    def _run(ref: weakref.ref, condition: threading.Condition):
+        """
+        Background worker: flushes the pending writes when the batch is full or the oldest one is too old. It only
+        holds the queue while checking or writing it, and ends when the queue is closed or garbage collected.
+        """
+        deadline = None
+        while True:
+            with condition:
+                queue = ref()
+                if queue is None or queue._closed:
+                    return
+                if len(queue._pending) == 0:
+                    deadline, timeout = None, None
+                else:
+                    deadline = deadline if deadline is not None else time.monotonic() + queue._max_delay
+                    timeout = deadline - time.monotonic()
+                if len(queue._pending) < queue._batch_size and (timeout is None or timeout > 0):
+                    queue = None
+                    condition.wait(timeout)
+                    continue
+            deadline = None
+            try:
+                queue._write()
+            except Exception as e:
+                # Raised by the next `flush` or `close`, so that readers notice the lost writes
+                with condition:
+                    queue._error = e
+            queue = None
+
+    @staticmethod
+    def _finalize(store: Store, pending: list, condition: threading.Condition):
+        """ Called when a queue is garbage collected: stores its pending writes and wakes up its thread to end"""
+        with condition:
+            batch = list(pending)
+            pending.clear()
+            condition.notify()
+        if len(batch) > 0:
+            try:
+                store.add_embeddings([x[0] for x in batch],
+                                     store.get_batch_embeddings([x[0] for x in batch]),
+                                     [x[1] for x in batch],
+                                     [x[2] for x in batch])
+            except Exception as e:
+                logger.error(f"Unable to write {len(batch)} texts to `{store.collection_name}`, they are lost: {e}")
+
+    def _write(self):
+        """ Embeds the pending texts in one batch and stores them"""
+        with self._write_lock:
+            with self._condition:
+                # The list is kept, as the finalizer holds it
+                batch = list(self._pending)
+                self._pending.clear()
+            if len(batch) == 0:
+                return
+            texts = [x[0] for x in batch]
+            metadatas = [x[1] for x in batch]
+            ids = [x[2] for x in batch]
+            try:
+                embeddings = self._store.get_batch_embeddings(texts)
+                self._store.add_embeddings(texts, embeddings, metadatas, ids)
+            except Exception as e:
+                logger.error(f"Unable to write {len(batch)} texts to `{self.collection_name}`, they are lost: {e}")
+                raise
+            if self._on_write is not None:
+                self._on_write(ids, texts, embeddings)
+
+    def flush(self):
+        """
+        Writes all the pending texts to the store. When it returns, every text queued before the call is stored
+        (read-your-writes). If a background write failed since the last call, its error is raised.
+        """
+        with self._condition:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+        self._write()
+
+    def close(self):
+        """
+        Flushes the pending writes and stops the background thread. If a background write failed since the last
+        `flush`, its error is raised once the rest of the writes are stored.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        _open_queues.discard(self)
+        self._finalizer.detach()
+        self._write()
+        with self._condition:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
@@ -0,0 +1,8 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class IngestionReport:
+    added: int = 0
+    kept: int = 0
+    removed: int = 0
@@ -1,20 +1,28 @@
-from typing import Type, Union, Iterator, List
+import asyncio
+import os
+import threading
+from typing import Type, Union, Iterator, List, AsyncIterator, Callable
 
 from mindcraft.infra.prompts.prompt import Prompt
 from mindcraft import settings
 from mindcraft.infra.engine.llm import LLM
+from mindcraft.lore.ingestion_report import IngestionReport
+from mindcraft.infra.vectorstore.query_cache import QueryCache
 from mindcraft.infra.vectorstore.search_results import SearchResult
 from mindcraft.infra.splitters.sentence_text_splitter import SentenceTextSplitter
 from mindcraft.infra.splitters.token_text_splitter import TokenTextSplitter
 from mindcraft.infra.splitters.text_splitters_types import TextSplitterTypes
 from mindcraft.infra.vectorstore.stores_types import StoresTypes
 from mindcraft.infra.vectorstore.store import Store
+from mindcraft.infra.vectorstore.text_index import TextIndex
 from mindcraft.infra.engine.local_llm import LocalLLM
 from mindcraft.infra.engine.llm_types import LLMType
 from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
 from mindcraft.infra.engine.remote_vllm import RemoteVLLM
+from mindcraft.infra.engine.async_remote_vllm import AsyncRemoteVLLM
 from mindcraft.infra.engine.local_vllm import LocalVLLM
-from mindcraft.settings import SEPARATOR, LOGGER_FORMAT, WORLD_DATA_PATH, ALL, FAST_INFERENCE_URL
+from mindcraft.settings import SEPARATOR, LOGGER_FORMAT, WORLD_DATA_PATH, ALL, FAST_INFERENCE_URL, \
+    EMBEDDINGS_BATCH_SIZE
 
 import logging
 
@@ -38,6 +46,10 @@ class World:
         :param fast: use vLLM fast inference (requires vLLM running in docker)
         :param fast: use vLLM fast inference in cases vLLM is not in local but served in an external server.
          In this case, an HTTP connection will be established
+        :param streaming: yield the answers of the LLM as they are generated. Available with `remote=True` and with
+         the local LLM (`fast=False`)
+        :param batching: generate the answers of concurrent conversations together, with continuous batching.
+         Available with the local LLM (`fast=False`)
         """
         if 'world_name' not in kwargs:
             raise Exception("To instantiate a world, please add the name of the world in `world_name`")
@@ -58,6 +70,9 @@ class World:
         if 'streaming' in kwargs and not isinstance(kwargs.get('streaming'), bool):
             raise Exception("The value for `streaming` param should be True or False")
 
+        if 'batching' in kwargs and not isinstance(kwargs.get('batching'), bool):
+            raise Exception("The value for `batching` param should be True or False")
+
         if 'llm_type' not in kwargs:
             logger.warning(f"`llm_type` not found in World() initializer. Initializing to {LLMType.ZEPHYR7B_AWQ}")
         elif not isinstance(kwargs.get('llm_type'), LLMType):
@@ -84,9 +99,13 @@ class World:
             cls._instance._world_data_path = kwargs.get('path') if 'path' in kwargs else WORLD_DATA_PATH
             cls._instance._fast = kwargs.get('fast') if 'fast' in kwargs else False
             cls._instance._remote = kwargs.get('remote') if cls._instance._fast and 'remote' in kwargs else False
+            # Streaming is available with the remote vLLM server and the local (non-fast) LLM
             cls._instance._streaming = kwargs.get('streaming') \
-                if cls._instance._remote and 'streaming' in kwargs else False
+                if (cls._instance._remote or not cls._instance._fast) and 'streaming' in kwargs else False
+            cls._instance._batching = kwargs.get('batching') if not cls._instance._fast and 'batching' in kwargs \
+                else False
             cls._instance._llm = None
+            cls._instance._async_llm = None
             cls._instance._npcs = dict()
 
             match cls._instance._store_type.value:
@@ -100,9 +119,30 @@ class World:
                     cls._instance._store = Chroma(cls._instance._world_data_path,
                                                   cls._instance._world_name,
                                                   cls._instance._embeddings)
+                case StoresTypes.NUMPY.value:
+                    from mindcraft.infra.vectorstore.numpy_store import NumpyStore
+
+                    cls._instance._store = NumpyStore(cls._instance._world_data_path,
+                                                      cls._instance._world_name,
+                                                      cls._instance._embeddings)
+                case StoresTypes.HNSW.value:
+                    from mindcraft.infra.vectorstore.hnsw_store import HNSWStore
+
+                    cls._instance._store = HNSWStore(cls._instance._world_data_path,
+                                                     cls._instance._world_name,
+                                                     cls._instance._embeddings)
+                case StoresTypes.SNAPSHOT.value:
+                    from mindcraft.infra.vectorstore.snapshot_store import SnapshotStore
+
+                    # `path` is the snapshot file, see `load_snapshot`
+                    cls._instance._store = SnapshotStore(cls._instance._world_data_path)
                 case _:
                     raise NotImplementedError(f"{kwargs.get('store_type')} not implemented")
 
+            # The text index is built from the store the first time it is needed
+            cls._instance._text_index = None
+            cls._instance._text_index_lock = threading.Lock()
+
             if cls._instance._remote:
                 print("Client for the Remote server configured. Please start your server running:\n"
                       f"`python -m vllm.entrypoints.openai.api_server "
@@ -239,6 +279,16 @@ class World:
             return
         self._instance._store = value
 
+    @property
+    def text_index(self):
+        """ Getter for the text_index property"""
+        if self._instance is None:
+            return None
+        with self._instance._text_index_lock:
+            if self._instance._text_index is None:
+                self._instance._text_index = self._index_lore(TextIndex())
+            return self._instance._text_index
+
     @property
     def store_type(self):
         """ Getter for the store_type property"""
@@ -258,6 +308,71 @@ class World:
         """:return Returns true if the Singleton instance of the World is already created. False otherwise"""
         return cls._instance is not None
 
+    @classmethod
+    def _index_lore(cls, text_index: TextIndex) -> TextIndex:
+        """
+        Adds all the lore in the store to a text index
+        :param text_index: the TextIndex
+        :return: the TextIndex
+        """
+        logger.info(f"Building the text index of {cls._instance._world_name}")
+        lore = cls._instance._store.get(where=None)
+        text_index.add_many(lore.ids, lore.documents, [x.get("known_by") for x in lore.metadatas])
+        return text_index
+
+    @classmethod
+    def _update_text_index(cls, update: Callable[[TextIndex], None]):
+        """
+        Applies a change of the lore to the text index, if it was already built. Otherwise, the change is read from
+        the store when it is built.
+        :param update: function applying the change to the TextIndex
+        """
+        with cls._instance._text_index_lock:
+            if cls._instance._text_index is not None:
+                update(cls._instance._text_index)
+
+    @classmethod
+    def export_snapshot(cls, path: str, dtype: str = "float16"):
+        """
+        Exports the lore of the world (documents, metadata and embeddings) to a single snapshot file, which can be
+        loaded with `load_snapshot` without opening the Vector Store.
+        :param path: path of the snapshot file
+        :param dtype: `float16` (half the size) or `float32` to store the embeddings
+        """
+        from mindcraft.infra.vectorstore.snapshot_store import SnapshotStore
+
+        lore = cls._instance.store.get(where=None, include_embeddings=True)
+        SnapshotStore.write(path,
+                            lore.ids,
+                            lore.documents,
+                            lore.metadatas,
+                            lore.embeddings,
+                            cls._instance.embeddings,
+                            dtype,
+                            cls._instance.world_name)
+        logger.info(f"{len(lore.ids)} pieces of lore of {cls._instance.world_name} exported to {path}")
+
+    @classmethod
+    def load_snapshot(cls, path: str, **kwargs):
+        """
+        Creates the world from a snapshot file written by `export_snapshot`. The snapshot is memory-mapped read-only,
+        so loading is almost instant and worker processes loading the same file share its memory. The lore can be
+        retrieved but not modified.
+        :param path: path of the snapshot file
+        :param kwargs: any other parameter of the World initializer (`llm_type`, `fast`, `remote`...). `world_name`
+        defaults to the name stored in the snapshot.
+        :return: the World
+        """
+        from mindcraft.infra.vectorstore.snapshot_store import SnapshotStore
+
+        header = SnapshotStore.read_header(path)
+        kwargs.setdefault('world_name', header["name"])
+        kwargs['store_type'] = StoresTypes.SNAPSHOT
+        kwargs['embeddings'] = EmbeddingsTypes[header["embeddings"]]
+        kwargs['path'] = path
+        kwargs['recreate'] = True
+        return cls(**kwargs)
+
     @classmethod
     def get_lore(cls,
                  topic: str,
@@ -281,6 +396,20 @@ class World:
         if known_by is not None and known_by != settings.ALL:
             all_known_by.append(known_by)
 
+        if exact_match is not None:
+            # The text index finds the pieces of lore which may include the literal expression, and only those are
+            # compared with the topic
+            def exact_query() -> SearchResult:
+                ids = cls._instance.text_index.candidates(exact_match, all_known_by)
+                scored = cls._instance.store.score(topic, ids)
+                scored = scored.take([i for i, x in enumerate(scored.documents) if exact_match in x])
+                return scored.threshold(min_similarity).head(num_results)
+
+            # Cached as the queries of the store, until the collection is written
+            key = ("exact_match", topic, num_results, QueryCache.normalize_known_by(all_known_by), exact_match,
+                   float(min_similarity))
+            return QueryCache.cached(cls._instance.store.path, key, exact_query)
+
         return cls._instance.store.query(
             topic,
             num_results,
@@ -288,23 +417,133 @@ class World:
             exact_match,
             min_similarity)
 
+    @classmethod
+    def search_lore(cls,
+                    topic: str,
+                    num_results: int = 5,
+                    known_by: str = None,
+                    min_similarity: float = 0.85,
+                    rrf_k: int = 60) -> SearchResult:
+        """
+        Hybrid retrieval of lore: combines the semantic search of the Vector Store with the lexical (BM25) search of
+        the text index using Reciprocal Rank Fusion, so that names and rare words found literally in the lore are
+        not missed.
+        :param topic: the topic you are looking for
+        :param num_results: the max. number of results to retrieve
+        :param known_by: filters by who know about this piece of lore. By default, (None) will look for commonly known
+        by all NPCs.
+        :param min_similarity: The minimum similarity the documents found by the Vector Store should have compared to
+        the topic
+        :param rrf_k: constant of the Reciprocal Rank Fusion. Higher values give more weight to lower ranks.
+        :return SearchResult, with the distance of each piece of lore to the topic
+        """
+        all_known_by = [settings.ALL]
+        if known_by is not None and known_by != settings.ALL:
+            all_known_by.append(known_by)
+
+        semantic = cls._instance.store.query(topic, num_results * 2, all_known_by, None, min_similarity)
+        lexical = cls._instance.text_index.search(topic, num_results * 2, all_known_by)
+        fused = dict()
+        for rank, lore_id in enumerate(semantic.ids):
+            fused[lore_id] = fused.get(lore_id, 0.0) + 1 / (rrf_k + rank + 1)
+        for rank, (lore_id, _) in enumerate(lexical):
+            fused[lore_id] = fused.get(lore_id, 0.0) + 1 / (rrf_k + rank + 1)
+        ids = sorted(fused, key=lambda x: -fused[x])[:num_results]
+
+        scored = cls._instance.store.score(topic, ids)
+        order = {lore_id: i for i, lore_id in enumerate(ids)}
+        return scored.take(sorted(range(len(scored.ids)), key=lambda i: order[scored.ids[i]]))
+
+    @classmethod
+    def get_lore_many(cls,
+                      topics: list[str],
+                      num_results: int = 5,
+                      known_by: list[str] = None,
+                      exact_match: str = None,
+                      min_similarity: float = 0.85) -> list[SearchResult]:
+        """
+        Gets the lore relevant to several topics at once, for example when several NPCs react to the same event.
+        All the topics are embedded in one batch and searched together.
+        :param topics: the topics you are looking for in the Vector Store
+        :param num_results: the max. number of results to retrieve per topic
+        :param known_by: one character per topic, filtering by who know about the lore. By default, (None) will look
+        for commonly known by all NPCs.
+        :param exact_match: Only returns documents which include literal expressions
+        :param min_similarity: The minimum similarity the document should have compared to the topic
+        :return: one SearchResult per topic
+        """
+        known_by = known_by if known_by is not None else [None] * len(topics)
+        if len(known_by) != len(topics):
+            raise Exception("`topics` and `known_by` should have the same length")
+
+        if exact_match is not None:
+            return [cls.get_lore(topic, num_results, character, exact_match, min_similarity)
+                    for topic, character in zip(topics, known_by)]
+
+        known_by_per_query = []
+        for character in known_by:
+            all_known_by = [settings.ALL]
+            if character is not None and character != settings.ALL:
+                all_known_by.append(character)
+            known_by_per_query.append(all_known_by)
+
+        return cls._instance.store.query_many(
+            topics,
+            known_by_per_query,
+            num_results,
+            exact_match,
+            min_similarity)
+
     @classmethod
     def add_lore(cls,
                  lore_text: str,
                  lore_id: str,
-                 known_by: list[str]):
+                 known_by: list[str],
+                 use_embeddings_cache: bool = True):
         """
             Stores a piece of lore which happened in a world.
         :param lore_text: chronicle to be stored
         :param lore_id: the id of the piece of lore
         :param known_by: list of character_ids who know the chronicle
+        :param use_embeddings_cache: reuse the embeddings of the same text from the persistent embeddings cache,
+        kept in the data path of the world
         """
         logger.info(f"Processing {lore_id} [{lore_text[:10]}...]")
         cls._instance.store.add_to_collection(
             text=lore_text,
             metadata={"known_by": SEPARATOR.join(known_by)},
-            text_id=lore_id
+            text_id=lore_id,
+            use_embeddings_cache=use_embeddings_cache
+        )
+        cls._update_text_index(lambda x: x.add(lore_id, lore_text, known_by))
+
+    @classmethod
+    def add_lore_many(cls,
+                      lore_texts: list[str],
+                      lore_ids: list[str],
+                      known_by: list[str],
+                      batch_size: int = EMBEDDINGS_BATCH_SIZE,
+                      use_embeddings_cache: bool = True,
+                      metadatas: list[dict] = None):
+        """
+            Stores several pieces of lore at once, embedding and inserting them in batches.
+        :param lore_texts: chronicles to be stored
+        :param lore_ids: the ids of the pieces of lore
+        :param known_by: list of character_ids who know the chronicles
+        :param batch_size: number of chronicles embedded and inserted at once
+        :param use_embeddings_cache: reuse the embeddings of the same texts from the persistent embeddings cache
+        :param metadatas: additional metadata to store with each piece of lore
+        """
+        logger.info(f"Processing {len(lore_texts)} pieces of lore")
+        cls._instance.store.add_many(
+            texts=lore_texts,
+            metadatas=[{"known_by": SEPARATOR.join(known_by), **(metadatas[i] if metadatas is not None else {})}
+                       for i in range(len(lore_texts))],
+            ids=lore_ids,
+            batch_size=batch_size,
+            use_embeddings_cache=use_embeddings_cache
         )
+        cls._update_text_index(lambda x: x.add_many(lore_ids, lore_texts, [known_by] * len(lore_texts)))
 
     @classmethod
     def book_to_world(
@@ -314,7 +553,11 @@ class World:
             max_units: int,
             overlap: int,
             known_by: list[str] = None,
-            encoding='utf-8'):
+            encoding='utf-8',
+            batch_size: int = EMBEDDINGS_BATCH_SIZE,
+            use_embeddings_cache: bool = True,
+            incremental: bool = False,
+            source: str = None) -> IngestionReport:
         """
         Reads a file describing a world (a book, for example). Splits the text into small chunks and stores them
         in the world. You can use any of the text splitters available in TextSplitterTypes.
@@ -324,6 +567,15 @@ class World:
         :param overlap: number of units (tokens, sentences) to overlap with previous/next chunks
         :param max_units: number of units (tokens, sentences) to accumulate in a chunk
         :param encoding: encoding of the books
+        :param batch_size: number of chunks embedded and inserted in the vector store at once
+        :param use_embeddings_cache: only calculate the embeddings of chunks which are not in the persistent embeddings
+        cache, so re-importing an unchanged or slightly edited book is almost instant
+        :param incremental: identify each chunk by its fingerprint, so that re-importing the book only inserts the new
+        chunks and deletes those which are not in the book anymore
+        :param source: id of the book, which scopes the chunks that an incremental import keeps or deletes. By
+        default, the normalized full path of the book, so that books with the same name in different folders do not
+        replace each other's chunks. Set it to keep the chunks when the book is moved.
+        :return IngestionReport with the number of chunks added, kept and removed
         """
         with open(book_path, 'r', encoding=encoding) as f:
             book = f.read()
@@ -342,14 +594,51 @@ class World:
                 case _:
                     raise NotImplementedError(f"{str(text_splitter)} not implemented")
 
+            known_by = known_by if known_by is not None else [ALL]
+            source = source if source is not None else os.path.realpath(book_path)
+            report = IngestionReport()
+            existing = set(cls._instance.store.get_ids(where={"source": source})) if incremental else set()
+            seen = set()
+            occurrences = dict()
+
             loading = ['|', '/', '-', '\\']
+            chunks, chunk_ids, chunk_metadatas = [], [], []
             for i, chunk in enumerate(text_splitter.split_text(book)):
                 print(f"\r{loading[i % len(loading)]}", end="")
-                cls.add_lore(chunk,
-                             str(i),
-                             known_by if known_by is not None else [ALL])
+                if incremental:
+                    fingerprint = text_splitter.fingerprint(chunk)
+                    occurrences[fingerprint] = occurrences.get(fingerprint, -1) + 1
+                    chunk_id = text_splitter.fingerprint(SEPARATOR.join([source, *known_by, fingerprint])) + \
+                        f"-{occurrences[fingerprint]}"
+                    seen.add(chunk_id)
+                    if chunk_id in existing:
+                        report.kept += 1
+                        continue
+                    chunk_metadatas.append({"fingerprint": fingerprint, "source": source})
+                else:
+                    chunk_id = str(i)
+                chunks.append(chunk)
+                chunk_ids.append(chunk_id)
+                if len(chunks) >= batch_size:
+                    cls.add_lore_many(chunks, chunk_ids, known_by, batch_size, use_embeddings_cache,
+                                      chunk_metadatas if incremental else None)
+                    report.added += len(chunks)
+                    chunks, chunk_ids, chunk_metadatas = [], [], []
+            if len(chunks) > 0:
+                cls.add_lore_many(chunks, chunk_ids, known_by, batch_size, use_embeddings_cache,
+                                  chunk_metadatas if incremental else None)
+                report.added += len(chunks)
             print()
 
+            removed = list(existing - seen)
+            cls._instance.store.delete(removed)
+            cls._update_text_index(lambda x: x.delete(removed))
+            report.removed = len(removed)
+
+            logger.info(f"{source} imported: {report.added} chunks added, {report.kept} kept, "
+                        f"{report.removed} removed")
+            return report
+
     @classmethod
     def retrieve_answer_from_llm(cls,
                                  prompt: str,
@@ -365,22 +654,107 @@ class World:
         :param temperature: temperature or how creative the answer should be
         :return: an iterator to the text of the answer (streaming=True) or the answer (streaming=False)
         """
-        if cls._instance.fast:
-            if cls._instance.llm is None:
+        # `yield from` closes the answer of the LLM if this iterator is closed, so that the engine stops generating
+        yield from cls._load_llm(temperature).retrieve_answer(prompt,
+                                                              max_tokens,
+                                                              do_sample,
+                                                              cls._instance.llm_type.value['template'],
+                                                              cls._instance.streaming)
+
+    @classmethod
+    async def aretrieve_answer_from_llm(cls,
+                                        prompt: str,
+                                        max_tokens: int = 100,
+                                        do_sample: bool = True,
+                                        temperature: float = 0.8) -> AsyncIterator[str]:
+        """
+        Asyncio version of `retrieve_answer_from_llm`. With a remote server (`fast=True`, `remote=True`), the answer
+        is requested with an asyncio client (see `AsyncRemoteVLLM`), whose connections are closed with `aclose`. Other
+        engines are blocking, so their chunks are generated in a worker thread, without blocking the event loop. If the
+        iterator is closed or cancelled before the end, the blocking answer is closed too, so the engine stops
+        generating.
+        :param prompt: the prompt to use
+        :param max_tokens: max tokens to receive
+        :param do_sample: apply stochastic selection of tokens to prevent always generating the same wording.
+        :param temperature: temperature or how creative the answer should be
+        :return: an async iterator to the text of the answer
+        """
+        if cls._instance.fast and cls._instance.remote:
+            if cls._instance._async_llm is None:
+                cls._instance._async_llm = AsyncRemoteVLLM(cls._instance.llm_type, temperature)
+            async for chunk in cls._instance._async_llm.aretrieve_answer(prompt,
+                                                                         max_tokens,
+                                                                         do_sample,
+                                                                         cls._instance.llm_type.value['template'],
+                                                                         cls._instance.streaming):
+                yield chunk
+            return
+
+        chunks = cls.retrieve_answer_from_llm(prompt, max_tokens, do_sample, temperature)
+        end = object()
+        # A cancelled `to_thread` does not stop its thread: the lock makes `close` wait for the chunk being generated
+        lock = threading.Lock()
+
+        def next_chunk():
+            with lock:
+                return next(chunks, end)
+
+        def close():
+            with lock:
+                chunks.close()
+
+        try:
+            while True:
+                chunk = await asyncio.to_thread(next_chunk)
+                if chunk is end:
+                    break
+                yield chunk
+        finally:
+            await asyncio.to_thread(close)
+
+    @classmethod
+    async def aclose(cls):
+        """ Closes the connections of the asyncio client used by `aretrieve_answer_from_llm`, if any"""
+        if cls._instance is not None and cls._instance._async_llm is not None:
+            await cls._instance._async_llm.close()
+            cls._instance._async_llm = None
+
+    @classmethod
+    def retrieve_answers_from_llm(cls,
+                                  prompts: list[str],
+                                  max_tokens: Union[int, list[int]] = 100,
+                                  do_sample: Union[bool, list[bool]] = True,
+                                  temperature: float = 0.8) -> list[str]:
+        """
+        Sends several prompts to the LLM at once. With local fast inference (vLLM), they are generated in a single
+        batch.
+        :param prompts: the prompts to use
+        :param max_tokens: max tokens to receive, for all the prompts or one per prompt
+        :param do_sample: apply stochastic selection of tokens, for all the prompts or one per prompt
+        :param temperature: temperature or how creative the answers should be
+        :return: the answers, in the same order as the prompts
+        """
+        return cls._load_llm(temperature).retrieve_answers(prompts,
+                                                          max_tokens,
+                                                          do_sample,
+                                                          cls._instance.llm_type.value['template'])
+
+    @classmethod
+    def _load_llm(cls, temperature: float) -> LLM:
+        """
+        Instantiates the LLM the first time it is needed
+        :param temperature: temperature or how creative the answers should be
+        :return: the LLM
+        """
+        if cls._instance.llm is None:
+            if cls._instance.fast:
                 if cls._instance.remote:
                     cls._instance.llm = RemoteVLLM(cls._instance.llm_type, temperature)
                 else:
                     cls._instance.llm = LocalVLLM(cls._instance.llm_type, temperature)
-        else:
-            if cls._instance.llm is None:
-                cls._instance.llm = LocalLLM(cls._instance.llm_type, temperature)
-
-        for chunk in cls._instance.llm.retrieve_answer(prompt,
-                                                       max_tokens,
-                                                       do_sample,
-                                                       cls._instance.llm_type.value['template'],
-                                                       cls._instance.streaming):
-            yield chunk
+            else:
+                cls._instance.llm = LocalLLM(cls._instance.llm_type, temperature, cls._instance._batching)
+        return cls._instance.llm
 
     @classmethod
     def get_instance(cls):
@@ -400,8 +774,12 @@ class World:
                     raise Exception(f"To use `chromadb` as your vector store, please install it first using pip:\n"
                                     f"`pip install chromadb`")
                 cls._instance.store.delete_collection()
+            case StoresTypes.NUMPY.value | StoresTypes.HNSW.value | StoresTypes.SNAPSHOT.value:
+                cls._instance.store.delete_collection()
             case _:
                 raise NotImplementedError(f"{cls._instance.store_type} not implemented")
+        with cls._instance._text_index_lock:
+            cls._instance._text_index = None
 
     @classmethod
     def create_prompt(cls,
@@ -0,0 +1,8 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class ConsolidationReport:
+    merged: int = 0
+    evicted: int = 0
+    kept: int = 0
@@ -0,0 +1,6 @@
+from enum import Enum
+
+
+class EvictionPolicyTypes(Enum):
+    AGE = "age"
+    FREQUENCY = "frequency"
@@ -0,0 +1,115 @@
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from mindcraft.infra.vectorstore.search_results import SearchResult
+
+
+class HotTier:
+    def __init__(self, capacity: int):
+        """
+        Small in-memory vector tier of the LTM, with the recent and frequently remembered memories of a character.
+        Vectors are kept normalized in a preallocated float32 matrix, one slot per memory. When the tier is full,
+        the memory remembered the fewest times (and, among them, the least recently) is demoted: it is removed from
+        the tier, but it is still in the persistent store.
+        :param capacity: max. number of memories in the tier
+        """
+        self._capacity = max(capacity, 0)
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._slots = dict()
+        self._ids = [None] * self._capacity
+        self._documents = [None] * self._capacity
+        self._hits = np.zeros(self._capacity, dtype=np.int64)
+        self._last_access = np.zeros(self._capacity, dtype=np.float64)
+        self._free = list(range(self._capacity - 1, -1, -1))
+
+    @property
+    def capacity(self) -> int:
+        """ Getter of the capacity property"""
+        return self._capacity
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, text_id: str) -> bool:
+        return text_id in self._slots
+
+    def add(self, text_id: str, text: str, vector: np.ndarray) -> Optional[str]:
+        """
+        Adds (promotes) a memory to the tier, demoting another one if the tier is full
+        :param text_id: id of the memory
+        :param text: text of the memory
+        :param vector: embeddings of the memory
+        :return: the id of the demoted memory, if any
+        """
+        if self._capacity == 0:
+            return None
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+        demoted = None
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self._capacity, vector.shape[0]), dtype=np.float32)
+            slot = self._slots.get(text_id)
+            if slot is None:
+                if len(self._free) == 0:
+                    slots = np.fromiter(self._slots.values(), dtype=np.int64)
+                    victim = slots[np.lexsort((self._last_access[slots], self._hits[slots]))[0]]
+                    demoted = self._ids[victim]
+                    self._release(demoted)
+                slot = self._free.pop()
+                self._slots[text_id] = slot
+                self._hits[slot] = 0
+            self._vectors[slot] = vector
+            self._ids[slot] = text_id
+            self._documents[slot] = text
+            self._last_access[slot] = time.time()
+        return demoted
+
+    def _release(self, text_id: str):
+        """ Frees the slot of a memory"""
+        slot = self._slots.pop(text_id)
+        self._ids[slot] = None
+        self._documents[slot] = None
+        self._free.append(slot)
+
+    def remove(self, ids: list[str]):
+        """
+        Removes memories from the tier
+        :param ids: ids of the memories
+        """
+        with self._lock:
+            for text_id in ids:
+                if text_id in self._slots:
+                    self._release(text_id)
+
+    def query(self, query: np.ndarray, num_results: int, min_similarity: float) -> SearchResult:
+        """
+        Cosine top-k among the memories of the tier. The memories returned count as remembered.
+        :param query: embeddings of the query
+        :param num_results: Max. number of results
+        :param min_similarity: max. distance (squared L2 of normalized embeddings) of the results
+        :return: SearchResult with the memories, from the closest to the furthest
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        with self._lock:
+            if len(self._slots) == 0 or num_results < 1:
+                return SearchResult()
+            slots = np.fromiter(self._slots.values(), dtype=np.int64)
+            similarities = self._vectors[slots] @ query
+            k = min(num_results, len(slots))
+            top = np.argpartition(-similarities, k - 1)[:k]
+            top = top[np.argsort(-similarities[top])]
+            distances = (2 - 2 * similarities[top]).astype(np.float32)
+            top = top[distances <= min_similarity]
+            distances = distances[distances <= min_similarity]
+            selected = slots[top]
+            self._hits[selected] += 1
+            self._last_access[selected] = time.time()
+            return SearchResult([self._documents[x] for x in selected],
+                                distances,
+                                [self._ids[x] for x in selected])
@@ -1,20 +1,55 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from mindcraft.infra.vectorstore.id_allocator import IdAllocator
 from mindcraft.infra.vectorstore.search_results import SearchResult
+from mindcraft.infra.vectorstore.write_behind_queue import WriteBehindQueue
 from mindcraft.features.mood import Mood
 from mindcraft.infra.vectorstore.stores_types import StoresTypes
 from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
-from mindcraft.settings import LTM_DATA_PATH, ALL
+from mindcraft.memory.consolidation_report import ConsolidationReport
+from mindcraft.memory.eviction_policy_types import EvictionPolicyTypes
+from mindcraft.memory.hot_tier import HotTier
+from mindcraft.settings import LTM_DATA_PATH, ALL, LTM_RECENT_CAPACITY, LTM_CAPACITY, LTM_DUPLICATE_DISTANCE, \
+    LTM_CONSOLIDATION_INTERVAL, LTM_HOT_CAPACITY, LTM_HOT_DISTANCE, LTM_PROMOTE_AFTER, LOGGER_FORMAT, DATE_FORMAT
+
+logging.basicConfig(format=LOGGER_FORMAT, datefmt=DATE_FORMAT, level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 
 class LTM:
     def __init__(self,
                  store_type: StoresTypes,
                  character_name: str,
-                 ltm_embeddings: EmbeddingsTypes = EmbeddingsTypes.MINILM):
+                 ltm_embeddings: EmbeddingsTypes = EmbeddingsTypes.MINILM,
+                 recent_capacity: int = LTM_RECENT_CAPACITY,
+                 hot_capacity: int = LTM_HOT_CAPACITY,
+                 hot_distance: float = LTM_HOT_DISTANCE,
+                 promote_after: int = LTM_PROMOTE_AFTER,
+                 write_behind: bool = False):
         """
         Long-term memory. It stores everything that happened to a character.
-        They are kept in the vector store, so the retrieval is slower than the STM.
+        They are kept in the vector store (cold tier), so the retrieval is slower than the STM.
+        The newest `recent_capacity` memories are also kept in memory, ordered by time, to serve the last interactions.
+        New and frequently remembered memories are kept as well in an in-memory vector tier (hot tier). Its results are
+        merged with those of the vector store, unless `hot_distance` is set: then the hot tier answers `remember_about`
+        alone when it finds good enough results.
         :param character_name: the unique `id` of the character
         :param ltm_embeddings: Embeddings to use in LTM in the VectorS Store.
+        :param recent_capacity: number of recent memories kept in memory
+        :param hot_capacity: number of memories in the hot tier. Set to 0 to disable it.
+        :param hot_distance: if the hot tier finds `num_results` memories closer than this distance, the vector
+        store is not queried. A closer memory of the vector store may be missed then. By default (0), the vector store
+        is always queried.
+        :param promote_after: times a memory of the vector store has to be remembered to be promoted to the hot tier
+        :param write_behind: memorize in a background thread, in batches (see `WriteBehindQueue`). Memories are
+        written before they are remembered.
         """
         match store_type.value:
             case StoresTypes.CHROMA.value:
@@ -26,11 +61,78 @@ class LTM:
 
                 self._store = Chroma(LTM_DATA_PATH, character_name, ltm_embeddings)
 
+            case StoresTypes.NUMPY.value:
+                from mindcraft.infra.vectorstore.numpy_store import NumpyStore
+
+                self._store = NumpyStore(LTM_DATA_PATH, character_name, ltm_embeddings)
+
             case _:
                 raise NotImplementedError(f"{store_type} not implemented")
 
         self._embeddings = ltm_embeddings
         self._character_id = character_name
+        self._id_allocator = IdAllocator.for_store(self._store)
+        self._recent = deque(maxlen=max(recent_capacity, 0))
+        self._lock = threading.RLock()
+        self._consolidation_lock = threading.Lock()
+        self._hits_path = f"{self._store.path}.hits.json"
+        self._hits = self._load_hits()
+        self._consolidation_thread = None
+        self._consolidation_stop = threading.Event()
+        self._hot = HotTier(hot_capacity) if hot_capacity > 0 else None
+        self._hot_distance = hot_distance
+        self._promote_after = max(promote_after, 1)
+        self._tier_stats = {"queries": 0, "hot_answered": 0, "hot_results": 0, "cold_results": 0,
+                            "promotions": 0, "demotions": 0}
+        self._load_recent()
+        self._writes = WriteBehindQueue(self._store, on_write=self._on_write) if write_behind else None
+
+    @staticmethod
+    def _chronological(stored: SearchResult) -> list[int]:
+        """
+        Sorts memories by their `timestamp`. Memories stored without timestamp are considered older, in the order of
+        their ids.
+        :param stored: memories retrieved from the store
+        :return: positions of the memories, from the oldest to the newest
+        """
+        def key(i: int):
+            metadata = stored.metadatas[i] if stored.metadatas is not None else {}
+            text_id = stored.ids[i] if i < len(stored.ids) else str(i)
+            return float(metadata.get('timestamp', 0)), int(text_id) if text_id.isdigit() else i
+
+        return sorted(range(len(stored.documents)), key=key)
+
+    def _load_recent(self):
+        """
+        Rehydrates the ring of recent memories and the hot tier from the store. Only the last memories stored are
+        read, and sorted by their `timestamp`.
+        """
+        hot_capacity = self._hot.capacity if self._hot is not None else 0
+        if max(self._recent.maxlen, hot_capacity) == 0 or self._store.count() == 0:
+            return
+        stored = self._store.get_last(max(self._recent.maxlen, hot_capacity), include_embeddings=hot_capacity > 0)
+        order = self._chronological(stored)
+        if self._recent.maxlen > 0:
+            for i in order[-self._recent.maxlen:]:
+                metadata = stored.metadatas[i] if stored.metadatas is not None else {}
+                self._recent.append((float(metadata.get('timestamp', 0)), stored.ids[i], stored.documents[i]))
+        if hot_capacity > 0:
+            for i in order[-hot_capacity:]:
+                self._hot.add(stored.ids[i], stored.documents[i], stored.embeddings[i])
+
+    def _load_hits(self) -> dict:
+        """ Reads from disk how many times each memory was remembered"""
+        if not os.path.exists(self._hits_path):
+            return dict()
+        with open(self._hits_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save_hits(self):
+        """ Writes to disk how many times each memory was remembered"""
+        os.makedirs(os.path.dirname(os.path.abspath(self._hits_path)), exist_ok=True)
+        with open(f"{self._hits_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(self._hits, f)
+        os.replace(f"{self._hits_path}.tmp", self._hits_path)
 
     def memorize(self, text: str, mood: Mood):
         """
@@ -38,10 +140,39 @@ class LTM:
         :param text: last interaction happened to store in LTM.
         :param mood: current Mood of the character
         """
-        self._store.add_to_collection(
-            text=text,
-            metadata={'mood': mood.feature if mood is not None else Mood.DEFAULT},
-            text_id=str(self._store.count()))
+        timestamp = time.time()
+        text_id = self._id_allocator.next_id()
+        metadata = {'mood': mood.feature if mood is not None else Mood.DEFAULT,
+                    'known_by': self._character_id,
+                    'timestamp': timestamp}
+        if self._writes is not None:
+            self._writes.put(text, metadata, text_id)
+        elif self._hot is None:
+            self._store.add_to_collection(text=text, metadata=metadata, text_id=text_id)
+        else:
+            # The embeddings are calculated once, for both tiers
+            embeddings = self._store.get_batch_embeddings([text])
+            self._store.add_embeddings([text], embeddings, [metadata], [text_id])
+            self._promote(text_id, text, embeddings[0])
+        with self._lock:
+            self._recent.append((timestamp, text_id, text))
+
+    def _on_write(self, ids: list[str], texts: list[str], embeddings: np.ndarray):
+        """ Promotes to the hot tier the memories written by the write-behind queue"""
+        if self._hot is not None:
+            for i, text_id in enumerate(ids):
+                self._promote(text_id, texts[i], embeddings[i])
+
+    def flush(self):
+        """ Writes the memories pending in the write-behind queue, if any"""
+        if self._writes is not None:
+            self._writes.flush()
+
+    def close(self):
+        """ Writes the pending memories and stops the background threads"""
+        self.stop_consolidation()
+        if self._writes is not None:
+            self._writes.close()
 
     def remember_about(self,
                        topic: str,
@@ -53,15 +184,202 @@ class LTM:
         :param num_results: Max. num of results
         :param min_similarity: min. similarity to filter out irrelevant memories
         """
-        return self._store.query(
+        self.flush()
+        hot = SearchResult()
+        if self._hot is not None and len(self._hot) > 0:
+            hot = self._hot.query(self._store.get_query_embeddings([topic])[0], num_results, min_similarity)
+            if self._hot_distance > 0 and len(hot) >= num_results and hot.distances[-1] <= self._hot_distance:
+                self._count_hits(hot, hot_answered=True)
+                return hot
+
+        cold = self._store.query(
                 text=topic,
                 num_results=num_results,
                 known_by=[ALL, self._character_id],
                 min_similarity=min_similarity
         )
+        if self._hot is None:
+            self._count_hits(cold)
+            return cold
+
+        # Single top-k over both tiers. Memories may be in both, so they are deduplicated by id.
+        in_hot = set(hot.ids)
+        cold_only = [i for i, text_id in enumerate(cold.ids) if text_id not in in_hot]
+        distances = np.concatenate([hot.scores, cold.scores[cold_only]])
+        top = np.argsort(distances, kind="stable")[:num_results]
+        documents = hot.documents + [cold.documents[i] for i in cold_only]
+        ids = hot.ids + [cold.ids[i] for i in cold_only]
+        result = SearchResult([documents[i] for i in top], distances[top], [ids[i] for i in top])
+        self._count_hits(result, cold_ids=set(cold.ids[i] for i in cold_only))
+        return result
+
+    def _count_hits(self, result: SearchResult, hot_answered: bool = False, cold_ids: set = None):
+        """
+        Updates the statistics of the tiers and the times each memory was remembered, and promotes to the hot tier
+        the memories of the vector store remembered at least `promote_after` times
+        :param result: the memories remembered
+        :param hot_answered: the hot tier answered without querying the vector store
+        :param cold_ids: ids of the memories which came from the vector store
+        """
+        cold_ids = cold_ids if cold_ids is not None else set()
+        promote = []
+        with self._lock:
+            self._tier_stats["queries"] += 1
+            self._tier_stats["hot_answered"] += 1 if hot_answered else 0
+            for text_id in result.ids:
+                self._hits[text_id] = self._hits.get(text_id, 0) + 1
+                if text_id in cold_ids:
+                    self._tier_stats["cold_results"] += 1
+                    if self._hot is not None and self._hits[text_id] >= self._promote_after:
+                        promote.append(text_id)
+                else:
+                    self._tier_stats["hot_results" if self._hot is not None else "cold_results"] += 1
+        if len(promote) > 0:
+            promoted = self._store.get(where=None, include_embeddings=True, ids=promote)
+            for i, text_id in enumerate(promoted.ids):
+                self._promote(text_id, promoted.documents[i], promoted.embeddings[i])
+
+    def _promote(self, text_id: str, text: str, embeddings: np.ndarray):
+        """ Adds a memory to the hot tier, demoting another one if it is full"""
+        demoted = self._hot.add(text_id, text, embeddings)
+        with self._lock:
+            self._tier_stats["promotions"] += 1
+            self._tier_stats["demotions"] += 1 if demoted is not None else 0
+
+    def tier_stats(self) -> dict:
+        """
+        Statistics of the tiers of the LTM
+        :return: dictionary with the number of `queries`, those answered only by the hot tier (`hot_answered`) and
+        its `hot_hit_rate`, the number of memories returned by each tier (`hot_results`, `cold_results`), the
+        `promotions` and `demotions` and the number of memories in the hot tier (`hot_size`)
+        """
+        with self._lock:
+            stats = dict(self._tier_stats)
+        stats["hot_hit_rate"] = stats["hot_answered"] / stats["queries"] if stats["queries"] > 0 else 0.0
+        stats["hot_size"] = len(self._hot) if self._hot is not None else 0
+        return stats
 
     def get_last_interactions(self, n: int = 5) -> SearchResult:
-        """ Retrieves last `n` interactions from the LTM
+        """ Retrieves last `n` interactions from the LTM, from the oldest to the newest. They are served from the ring
+        of recent memories, unless more than `recent_capacity` are requested.
         :param n: number of interactions
         """
-        return self._store.get_last(n)
+        if n > self._recent.maxlen:
+            return self._store.get_last(n)
+        with self._lock:
+            recent = list(self._recent)[-n:] if n > 0 else []
+        return SearchResult(documents=[text for _, _, text in recent],
+                            ids=[text_id for _, text_id, _ in recent])
+
+    def consolidate(self,
+                    duplicate_distance: float = LTM_DUPLICATE_DISTANCE,
+                    capacity: int = LTM_CAPACITY,
+                    policy: EvictionPolicyTypes = EvictionPolicyTypes.AGE) -> ConsolidationReport:
+        """
+        Consolidates the memories of the character:
+            - Near-duplicate memories (closer than `duplicate_distance`) are merged into the newest one, which
+            inherits the times they were remembered.
+            - If more than `capacity` memories remain, the exceeding ones are evicted following `policy`: the oldest
+            ones (`AGE`) or the least remembered ones, and the oldest among them (`FREQUENCY`).
+        :param duplicate_distance: max. distance (squared L2 of normalized embeddings, as `min_similarity`) between
+        two memories to consider them duplicates. Set to 0 to disable merging.
+        :param capacity: max. number of memories to keep. Set to 0 for no limit.
+        :param policy: one of EvictionPolicyTypes
+        :return: ConsolidationReport with the number of memories merged, evicted and kept
+        """
+        self.flush()
+        with self._consolidation_lock:
+            stored = self._store.get(where=None, include_embeddings=duplicate_distance > 0)
+            report = ConsolidationReport()
+            if len(stored.documents) == 0:
+                return report
+            with self._lock:
+                hits = dict(self._hits)
+
+            # Newest first, so that the newest memory of a cluster represents it
+            order = self._chronological(stored)[::-1]
+            kept = []
+            merged = dict()
+            if duplicate_distance > 0:
+                embeddings = np.asarray(stored.embeddings, dtype=np.float32)
+                embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+                min_cosine = 1 - duplicate_distance / 2
+                for i in order:
+                    if len(kept) > 0:
+                        similarities = embeddings[kept] @ embeddings[i]
+                        closest = int(np.argmax(similarities))
+                        if similarities[closest] >= min_cosine:
+                            representative = stored.ids[kept[closest]]
+                            merged[stored.ids[i]] = representative
+                            hits[representative] = hits.get(representative, 0) + hits.get(stored.ids[i], 0)
+                            continue
+                    kept.append(i)
+            else:
+                kept = order
+
+            evicted = []
+            if 0 < capacity < len(kept):
+                # `kept` goes from the newest to the oldest
+                match policy:
+                    case EvictionPolicyTypes.AGE:
+                        ranked = list(range(len(kept)))
+                    case EvictionPolicyTypes.FREQUENCY:
+                        ranked = sorted(range(len(kept)), key=lambda x: (-hits.get(stored.ids[kept[x]], 0), x))
+                    case _:
+                        raise NotImplementedError(f"{policy} not implemented")
+                evicted = [stored.ids[kept[x]] for x in ranked[capacity:]]
+                kept = [kept[x] for x in sorted(ranked[:capacity])]
+
+            removed = set(merged).union(evicted)
+            self._store.delete(list(removed))
+            if self._hot is not None:
+                self._hot.remove(list(removed))
+            with self._lock:
+                for text_id, representative in merged.items():
+                    self._hits[representative] = self._hits.get(representative, 0) + self._hits.pop(text_id, 0)
+                for text_id in evicted:
+                    self._hits.pop(text_id, None)
+                recent = [x for x in self._recent if x[1] not in removed]
+                self._recent.clear()
+                self._recent.extend(recent)
+                self._save_hits()
+            report.merged, report.evicted, report.kept = len(merged), len(evicted), len(kept)
+
+        logger.info(f"LTM of {self._character_id} consolidated: {report.merged} merged, {report.evicted} evicted, "
+                    f"{report.kept} kept")
+        return report
+
+    def start_consolidation(self,
+                            interval: float = LTM_CONSOLIDATION_INTERVAL,
+                            duplicate_distance: float = LTM_DUPLICATE_DISTANCE,
+                            capacity: int = LTM_CAPACITY,
+                            policy: EvictionPolicyTypes = EvictionPolicyTypes.AGE):
+        """
+        Runs `consolidate` every `interval` seconds in a background thread, until `stop_consolidation` is called.
+        :param interval: seconds between consolidations
+        :param duplicate_distance: see `consolidate`
+        :param capacity: see `consolidate`
+        :param policy: see `consolidate`
+        """
+        if self._consolidation_thread is not None and self._consolidation_thread.is_alive():
+            return
+
+        def run():
+            while not self._consolidation_stop.wait(interval):
+                try:
+                    self.consolidate(duplicate_distance, capacity, policy)
+                except Exception as e:
+                    logger.error(f"Error consolidating the LTM of {self._character_id}: {e}")
+
+        self._consolidation_stop.clear()
+        self._consolidation_thread = threading.Thread(target=run,
+                                                      name=f"ltm-consolidation-{self._character_id}",
+                                                      daemon=True)
+        self._consolidation_thread.start()
+
+    def stop_consolidation(self):
+        """ Stops the background consolidation, waiting for a running one to finish"""
+        self._consolidation_stop.set()
+        if self._consolidation_thread is not None:
+            self._consolidation_thread.join()
+            self._consolidation_thread = None
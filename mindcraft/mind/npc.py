@@ -1,3 +1,6 @@
+import asyncio
+from typing import AsyncIterator
+
 from mindcraft.memory.summarizer_types import SummarizerTypes
 from mindcraft.memory.stm import STM
 from mindcraft.infra.vectorstore.stores_types import StoresTypes
@@ -30,7 +33,10 @@ class NPC:
                  stm_capacity: int = 5,
                  stm_summarizer: SummarizerTypes = SummarizerTypes.T5_SMALL,
                  stm_max_summary_length: int = 230,
-                 stm_min_summary_length: int = 30):
+                 stm_min_summary_length: int = 30,
+                 semantic_styles: bool = False,
+                 ltm_consolidation_interval: float = None,
+                 write_behind: bool = False):
         """
         A class managing the Non-player Character, including short-term, long-term memory, backgrounds, motivations
         to create the answer.
@@ -46,15 +52,26 @@ class NPC:
         :param stm_summarizer: One of `SummarizerTypes` to use for including the summary of last interactions
         :param stm_max_summary_length: max length of the summary
         :param stm_min_summary_length: min length of the summary
+        :param semantic_styles: use as conversational style the examples of the mood closest to the interaction,
+        instead of the first ones stored
+        :param ltm_consolidation_interval: if set, seconds between background consolidations of the long-term memory
+        (merging near-duplicate memories and enforcing `LTM_CAPACITY`). See `LTM.consolidate`.
+        :param write_behind: store the answers in the long-term memory and the conversational styles in a background
+        thread, in batches, so that `react_to` finishes right after the last chunk. They are written before being
+        retrieved again.
         """
         self._character_name = character_name
         self._description = description
-        self._ltm = LTM(store_type, character_name, ltm_embeddings)
+        self._ltm = LTM(store_type, character_name, ltm_embeddings, write_behind=write_behind)
+        if ltm_consolidation_interval is not None:
+            self._ltm.start_consolidation(ltm_consolidation_interval)
         self._stm = STM(self._ltm, stm_capacity, stm_summarizer, stm_max_summary_length, stm_min_summary_length)
         self._personalities = personalities
         self._motivations = motivations
         self._mood = mood
-        self._conversational_style = ConversationalStyle(store_type, character_name, ltm_embeddings)
+        self._conversational_style = ConversationalStyle(store_type, character_name, ltm_embeddings,
+                                                         write_behind=write_behind)
+        self._semantic_styles = semantic_styles
         self._last_interaction = ""
         self._last_answer = ""
 
@@ -151,6 +168,69 @@ class NPC:
         and provide feedback to the model, for training future npc-based LLMs.
         """
 
+        prompt = self._create_prompt(interaction, min_similarity, ltm_num_results, world_num_results)
+
+        chunks = []
+        for chunk in World.retrieve_answer_from_llm(prompt,
+                                                    max_tokens=max_tokens,
+                                                    do_sample=True,
+                                                    temperature=temperature):
+            yield chunk
+            chunks.append(chunk)
+
+        self._last_answer = "".join(chunks)
+        self._ltm.memorize(self._last_answer, self._mood)
+
+    async def areact_to(self,
+                        interaction: str,
+                        min_similarity: float = 0.85,
+                        ltm_num_results: int = 3,
+                        world_num_results: int = 10,
+                        max_tokens: int = 250,
+                        temperature: float = 0.8) -> AsyncIterator[str]:
+        """
+        Asyncio version of `react_to`, to be used with `async for`. The retrieval from the memories, the lore and the
+        conversational styles, and the memorization of the answer, run in a worker thread, so that the event loop
+        keeps serving other conversations. See `World.aretrieve_answer_from_llm` for the generation.
+        :param interaction: the interaction / question you tell/ask the NPC
+        :param min_similarity: minimum similarity score to filter out irrelevant information
+        :param ltm_num_results: max number of results to retrieve from Long-term memory
+        :param world_num_results: max number of results to retrieve from World Lore
+        :param max_tokens: max_tokens of the answer
+        :param temperature: temperature or how creative the answer should be
+        :return: an async iterator to the text of the answer
+        """
+        prompt = await asyncio.to_thread(self._create_prompt,
+                                         interaction,
+                                         min_similarity,
+                                         ltm_num_results,
+                                         world_num_results)
+
+        chunks = []
+        async for chunk in World.aretrieve_answer_from_llm(prompt,
+                                                           max_tokens=max_tokens,
+                                                           do_sample=True,
+                                                           temperature=temperature):
+            yield chunk
+            chunks.append(chunk)
+
+        self._last_answer = "".join(chunks)
+        await asyncio.to_thread(self._ltm.memorize, self._last_answer, self._mood)
+
+    def _create_prompt(self,
+                       interaction: str,
+                       min_similarity: float,
+                       ltm_num_results: int,
+                       world_num_results: int) -> str:
+        """
+        Retrieves the memories, the lore and the conversational style relevant to an interaction and creates the
+        prompt for the LLM
+        :param interaction: the interaction / question you tell/ask the NPC
+        :param min_similarity: minimum similarity score to filter out irrelevant information
+        :param ltm_num_results: max number of results to retrieve from Long-term memory
+        :param world_num_results: max number of results to retrieve from World Lore
+        :return: the prompt
+        """
         memories = self._ltm.remember_about(interaction,
                                             num_results=ltm_num_results,
                                             min_similarity=min_similarity).documents
@@ -164,7 +244,8 @@ class NPC:
         motivations = [x.feature for x in self._motivations] if self._motivations is not None else []
         mood = self._mood.feature if self._mood is not None else Mood.DEFAULT
 
-        conversational_style = self._conversational_style.retrieve_interaction_by_mood(mood).documents
+        conversational_style = self._conversational_style.retrieve_interaction_by_mood(
+            mood, interaction if self._semantic_styles else None).documents
 
         # I create the prompt
         prompt = World.create_prompt(memories,
@@ -178,17 +259,7 @@ class NPC:
 
         self._last_interaction = prompt
         logger.info(prompt)
-
-        chunks = []
-        for chunk in World.retrieve_answer_from_llm(prompt,
-                                                    max_tokens=max_tokens,
-                                                    do_sample=True,
-                                                    temperature=temperature):
-            yield chunk
-            chunks.append(chunk)
-
-        self._last_answer = "".join(chunks)
-        self._ltm.memorize(self._last_answer, self._mood)
+        return prompt
 
     def retrieve_feedback_to_finetune(self) -> Feedback:
         """
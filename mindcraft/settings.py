@@ -5,9 +5,69 @@ DATA_PATH = os.path.join(DIR_PATH, '../data')
 WORLD_DATA_PATH = os.path.join(DATA_PATH, 'world')
 LTM_DATA_PATH = os.path.join(DATA_PATH, 'ltm')
 STYLES_DATA_PATH = os.path.join(DATA_PATH, 'styles')
+EMBEDDINGS_DATA_PATH = os.path.join(DATA_PATH, 'embeddings')
 
 FAST_INFERENCE_URL = f"http://{os.environ['MINDCRAFT_HOST'] if 'MINDCRAFT_HOST' in os.environ else 'localhost'}:" \
                      f"{os.environ['MINDCRAFT_PORT'] if 'MINDCRAFT_PORT' in os.environ else '8000'}/v1/completions"
+FAST_INFERENCE_POOL_SIZE = int(os.environ['MINDCRAFT_FAST_INFERENCE_POOL_SIZE']) \
+    if 'MINDCRAFT_FAST_INFERENCE_POOL_SIZE' in os.environ else 10
+FAST_INFERENCE_CONNECT_TIMEOUT = float(os.environ['MINDCRAFT_FAST_INFERENCE_CONNECT_TIMEOUT']) \
+    if 'MINDCRAFT_FAST_INFERENCE_CONNECT_TIMEOUT' in os.environ else 3.05
+FAST_INFERENCE_READ_TIMEOUT = float(os.environ['MINDCRAFT_FAST_INFERENCE_READ_TIMEOUT']) \
+    if 'MINDCRAFT_FAST_INFERENCE_READ_TIMEOUT' in os.environ else 60
+FAST_INFERENCE_RETRIES = int(os.environ['MINDCRAFT_FAST_INFERENCE_RETRIES']) \
+    if 'MINDCRAFT_FAST_INFERENCE_RETRIES' in os.environ else 3
+FAST_INFERENCE_BACKOFF = float(os.environ['MINDCRAFT_FAST_INFERENCE_BACKOFF']) \
+    if 'MINDCRAFT_FAST_INFERENCE_BACKOFF' in os.environ else 0.5
+LLM_MAX_BATCH_SIZE = int(os.environ['MINDCRAFT_LLM_MAX_BATCH_SIZE']) \
+    if 'MINDCRAFT_LLM_MAX_BATCH_SIZE' in os.environ else 8
+LLM_MAX_WAIT = float(os.environ['MINDCRAFT_LLM_MAX_WAIT']) if 'MINDCRAFT_LLM_MAX_WAIT' in os.environ else 0.01
+LATENCY_STATS_WINDOW = int(os.environ['MINDCRAFT_LATENCY_STATS_WINDOW']) \
+    if 'MINDCRAFT_LATENCY_STATS_WINDOW' in os.environ else 1000
+
+EMBEDDINGS_MAX_MODELS = int(os.environ['MINDCRAFT_EMBEDDINGS_MAX_MODELS']) \
+    if 'MINDCRAFT_EMBEDDINGS_MAX_MODELS' in os.environ else 4
+EMBEDDINGS_BATCH_SIZE = int(os.environ['MINDCRAFT_EMBEDDINGS_BATCH_SIZE']) \
+    if 'MINDCRAFT_EMBEDDINGS_BATCH_SIZE' in os.environ else 64
+EMBEDDINGS_CACHE_MAX_ENTRIES = int(os.environ['MINDCRAFT_EMBEDDINGS_CACHE_MAX_ENTRIES']) \
+    if 'MINDCRAFT_EMBEDDINGS_CACHE_MAX_ENTRIES' in os.environ else 10000
+EMBEDDINGS_CACHE_MAX_BYTES = int(os.environ['MINDCRAFT_EMBEDDINGS_CACHE_MAX_BYTES']) \
+    if 'MINDCRAFT_EMBEDDINGS_CACHE_MAX_BYTES' in os.environ else 64 * 1024 * 1024
+QUERY_CACHE_MAX_ENTRIES = int(os.environ['MINDCRAFT_QUERY_CACHE_MAX_ENTRIES']) \
+    if 'MINDCRAFT_QUERY_CACHE_MAX_ENTRIES' in os.environ else 1024
+QUERY_CACHE_MAX_BYTES = int(os.environ['MINDCRAFT_QUERY_CACHE_MAX_BYTES']) \
+    if 'MINDCRAFT_QUERY_CACHE_MAX_BYTES' in os.environ else 64 * 1024 * 1024
+CHROMA_MAX_CLIENTS = int(os.environ['MINDCRAFT_CHROMA_MAX_CLIENTS']) \
+    if 'MINDCRAFT_CHROMA_MAX_CLIENTS' in os.environ else 16
+
+HNSW_M = int(os.environ['MINDCRAFT_HNSW_M']) if 'MINDCRAFT_HNSW_M' in os.environ else 16
+HNSW_EF_CONSTRUCTION = int(os.environ['MINDCRAFT_HNSW_EF_CONSTRUCTION']) \
+    if 'MINDCRAFT_HNSW_EF_CONSTRUCTION' in os.environ else 200
+HNSW_EF = int(os.environ['MINDCRAFT_HNSW_EF']) if 'MINDCRAFT_HNSW_EF' in os.environ else 64
+HNSW_SAVE_EVERY = int(os.environ['MINDCRAFT_HNSW_SAVE_EVERY']) \
+    if 'MINDCRAFT_HNSW_SAVE_EVERY' in os.environ else 10000
+LTM_RECENT_CAPACITY = int(os.environ['MINDCRAFT_LTM_RECENT_CAPACITY']) \
+    if 'MINDCRAFT_LTM_RECENT_CAPACITY' in os.environ else 50
+STYLES_NUM_EXAMPLES = int(os.environ['MINDCRAFT_STYLES_NUM_EXAMPLES']) \
+    if 'MINDCRAFT_STYLES_NUM_EXAMPLES' in os.environ else 5
+STYLES_POOL_SIZE = int(os.environ['MINDCRAFT_STYLES_POOL_SIZE']) if 'MINDCRAFT_STYLES_POOL_SIZE' in os.environ else 50
+STYLES_CACHE_MOODS = int(os.environ['MINDCRAFT_STYLES_CACHE_MOODS']) \
+    if 'MINDCRAFT_STYLES_CACHE_MOODS' in os.environ else 16
+LTM_CAPACITY = int(os.environ['MINDCRAFT_LTM_CAPACITY']) if 'MINDCRAFT_LTM_CAPACITY' in os.environ else 0
+LTM_DUPLICATE_DISTANCE = float(os.environ['MINDCRAFT_LTM_DUPLICATE_DISTANCE']) \
+    if 'MINDCRAFT_LTM_DUPLICATE_DISTANCE' in os.environ else 0.1
+LTM_CONSOLIDATION_INTERVAL = float(os.environ['MINDCRAFT_LTM_CONSOLIDATION_INTERVAL']) \
+    if 'MINDCRAFT_LTM_CONSOLIDATION_INTERVAL' in os.environ else 300
+LTM_HOT_CAPACITY = int(os.environ['MINDCRAFT_LTM_HOT_CAPACITY']) if 'MINDCRAFT_LTM_HOT_CAPACITY' in os.environ else 128
+LTM_HOT_DISTANCE = float(os.environ['MINDCRAFT_LTM_HOT_DISTANCE']) \
+    if 'MINDCRAFT_LTM_HOT_DISTANCE' in os.environ else 0
+LTM_PROMOTE_AFTER = int(os.environ['MINDCRAFT_LTM_PROMOTE_AFTER']) \
+    if 'MINDCRAFT_LTM_PROMOTE_AFTER' in os.environ else 2
+WRITE_BEHIND_BATCH_SIZE = int(os.environ['MINDCRAFT_WRITE_BEHIND_BATCH_SIZE']) \
+    if 'MINDCRAFT_WRITE_BEHIND_BATCH_SIZE' in os.environ else 32
+WRITE_BEHIND_MAX_DELAY = float(os.environ['MINDCRAFT_WRITE_BEHIND_MAX_DELAY']) \
+    if 'MINDCRAFT_WRITE_BEHIND_MAX_DELAY' in os.environ else 1.0
+ID_BLOCK_SIZE = int(os.environ['MINDCRAFT_ID_BLOCK_SIZE']) if 'MINDCRAFT_ID_BLOCK_SIZE' in os.environ else 100
 
 SEPARATOR = "||"
 ALL = 'all'
@@ -1,21 +1,38 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from mindcraft.infra.vectorstore.id_allocator import IdAllocator
 from mindcraft.infra.vectorstore.search_results import SearchResult
+from mindcraft.infra.vectorstore.write_behind_queue import WriteBehindQueue
 from mindcraft.features.mood import Mood
 from mindcraft.infra.vectorstore.stores_types import StoresTypes
 from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
-from mindcraft.settings import STYLES_DATA_PATH
+from mindcraft.settings import STYLES_DATA_PATH, STYLES_NUM_EXAMPLES, STYLES_POOL_SIZE, STYLES_CACHE_MOODS
 
 
 class ConversationalStyle:
     def __init__(self,
                  store_type: StoresTypes,
                  character_id: str,
-                 styles_embeddings: EmbeddingsTypes = EmbeddingsTypes.MINILM):
+                 styles_embeddings: EmbeddingsTypes = EmbeddingsTypes.MINILM,
+                 num_examples: int = STYLES_NUM_EXAMPLES,
+                 pool_size: int = STYLES_POOL_SIZE,
+                 cache_moods: int = STYLES_CACHE_MOODS,
+                 write_behind: bool = False):
         """
         Class that stores how characters speak depending on their moods.
         They are kept in the vector store
         :param store_type: type of vector store from those available in StoresTypes
         :param character_id: the unique `id` of the character
         :param styles_embeddings: Embeddings to use in the conversations in the Vector Store.
+        :param num_examples: number of examples retrieved per mood
+        :param pool_size: number of examples per mood kept in memory (the newest ones), among which the closest to an
+        interaction are picked in semantic mode
+        :param cache_moods: number of moods whose examples are kept in memory
+        :param write_behind: memorize in a background thread, in batches (see `WriteBehindQueue`). Examples are
+        written before they are retrieved.
         """
         match store_type.value:
             case StoresTypes.CHROMA.value:
@@ -27,10 +44,23 @@ class ConversationalStyle:
 
                 self.store = Chroma(STYLES_DATA_PATH, character_id, styles_embeddings)
 
+            case StoresTypes.NUMPY.value:
+                from mindcraft.infra.vectorstore.numpy_store import NumpyStore
+
+                self.store = NumpyStore(STYLES_DATA_PATH, character_id, styles_embeddings)
+
             case _:
                 raise NotImplementedError(f"{store_type} not implemented")
 
         self.embeddings = styles_embeddings
+        self._id_allocator = IdAllocator.for_store(self.store)
+        self._num_examples = num_examples
+        self._pool_size = max(pool_size, num_examples)
+        self._cache_moods = max(cache_moods, 1)
+        self._cache = OrderedDict()
+        self._versions = dict()
+        self._lock = threading.Lock()
+        self._writes = WriteBehindQueue(self.store) if write_behind else None
 
     def memorize(self, text: str, mood: Mood):
         """
@@ -38,16 +68,79 @@ class ConversationalStyle:
         :param text: last interaction happened to store in LTM.
         :param mood: the mood the npc had when said this
         """
-        self.store.add_to_collection(
-            text=text,
-            metadata={'mood': mood.feature if mood is not None else Mood.DEFAULT},
-            text_id=str(self.store.count()))
+        feature = mood.feature if mood is not None else Mood.DEFAULT
+        if self._writes is not None:
+            self._writes.put(text, {'mood': feature}, self._id_allocator.next_id())
+        else:
+            self.store.add_to_collection(
+                text=text,
+                metadata={'mood': feature},
+                text_id=self._id_allocator.next_id())
+        with self._lock:
+            self._cache.pop(feature, None)
+            self._versions[feature] = self._versions.get(feature, 0) + 1
+
+    def flush(self):
+        """ Writes the examples pending in the write-behind queue, if any"""
+        if self._writes is not None:
+            self._writes.flush()
+
+    @staticmethod
+    def _id_order(text_id: str) -> tuple:
+        """ Sorting key of the ids, which are minted in increasing order by the `IdAllocator`"""
+        return (0, int(text_id), "") if text_id.isdigit() else (1, 0, text_id)
+
+    def _examples(self, mood: str) -> SearchResult:
+        """
+        Newest `pool_size` examples of a mood, from the oldest to the newest. They are kept in memory, loading them
+        from the store if needed. The least recently used mood is forgotten when more than `cache_moods` are cached.
+        :param mood: the mood
+        :return SearchResult with the examples and their embeddings
+        """
+        with self._lock:
+            if mood in self._cache:
+                self._cache.move_to_end(mood)
+                return self._cache[mood]
+            version = self._versions.get(mood, 0)
+
+        self.flush()
+
+        # Only the ids of all the examples are read, to pick the newest ones
+        ids = sorted(self.store.get_ids(where={'mood': mood}), key=self._id_order)[-self._pool_size:]
+        examples = self.store.get(where={'mood': mood}, include_embeddings=True, ids=ids) if len(ids) > 0 \
+            else SearchResult()
+        order = {text_id: i for i, text_id in enumerate(ids)}
+        examples = examples.take(sorted(range(len(examples)), key=lambda i: order[examples.ids[i]]))
+        with self._lock:
+            if self._versions.get(mood, 0) != version:
+                # An example was memorized while loading, so these may be stale
+                return examples
+            self._cache[mood] = examples
+            while len(self._cache) > self._cache_moods:
+                self._cache.popitem(last=False)
+        return examples
 
     def retrieve_interaction_by_mood(self,
-                                     mood: str) -> SearchResult:
+                                     mood: str,
+                                     interaction: str = None) -> SearchResult:
         """
         Retrieves examples of interactions for a specific mood
         :param mood: the current mood of the character
-        :return SearchResult
+        :param interaction: if set (semantic mode), the examples closest to this interaction are returned. Otherwise,
+        the newest ones.
+        :return SearchResult with at most `num_examples` examples
         """
-        return self.store.get(where={'mood': mood})
+        examples = self._examples(mood)
+        if interaction is None or len(examples.documents) <= self._num_examples or examples.embeddings is None:
+            # The newest examples, which are the last ones of the pool
+            start = max(len(examples.documents) - self._num_examples, 0)
+            return SearchResult(documents=examples.documents[start:], ids=examples.ids[start:])
+
+        query = self.store.get_query_embeddings([interaction])[0]
+        embeddings = np.asarray(examples.embeddings, dtype=np.float32)
+        norms = np.maximum(np.linalg.norm(embeddings, axis=1) * max(float(np.linalg.norm(query)), 1e-12), 1e-12)
+        similarities = embeddings @ query / norms
+        top = np.argsort(-similarities)[:self._num_examples]
+        return SearchResult(documents=[examples.documents[i] for i in top],
+                            distances=2 - 2 * similarities[top],
+                            ids=[examples.ids[i] for i in top])
@@ -13,6 +13,7 @@ setup(
         "sentence_transformers==2.2.2",
         "autoawq==0.1.8",
         "requests~=2.31.0",
+        "numpy",
         "torch==2.1.2"
     ],
     python_requires=">=3.10.0",
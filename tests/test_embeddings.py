@@ -0,0 +1,110 @@
+import os
+import unittest
+
+import numpy as np
+import pytest
+
+from mindcraft.infra.embeddings.embeddings_cache import EmbeddingsCache
+from mindcraft.infra.embeddings.embeddings_disk_cache import EmbeddingsDiskCache
+from mindcraft.infra.embeddings.embeddings_registry import EmbeddingsRegistry
+from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
+
+
+def count_encoded(monkeypatch) -> list[str]:
+    """ Records the texts sent to the embeddings model"""
+    encoded = []
+    encode = EmbeddingsRegistry.encode
+
+    def counting_encode(embeddings, texts, batch_size=32):
+        encoded.extend(texts)
+        return encode(embeddings, texts, batch_size)
+
+    monkeypatch.setattr(EmbeddingsRegistry, "encode", counting_encode)
+    return encoded
+
+
+def test_embeddings_cache(monkeypatch):
+    EmbeddingsCache.clear()
+    encoded = count_encoded(monkeypatch)
+    stats = EmbeddingsCache.stats()
+    texts = ["Where do elves live?", "Where do zombies live?", "Where do elves live?"]
+
+    vectors = EmbeddingsCache.encode(EmbeddingsTypes.MINILM, texts)
+    assert encoded == texts[:2]
+    assert np.array_equal(vectors[0], vectors[2])
+    vectors = EmbeddingsCache.encode(EmbeddingsTypes.MINILM, texts[:2])
+    assert len(encoded) == 2
+    # The first call misses the three texts, the second hits two of them
+    assert EmbeddingsCache.stats()["misses"] - stats["misses"] == 3
+    assert EmbeddingsCache.stats()["hits"] - stats["hits"] == 2
+
+    # Callers get copies, and cached vectors are read-only
+    vectors[0] += 1
+    assert not np.array_equal(EmbeddingsCache.encode(EmbeddingsTypes.MINILM, texts[:1])[0], vectors[0])
+    with pytest.raises(ValueError):
+        EmbeddingsCache.get(EmbeddingsTypes.MINILM, texts[0])[0] = 1
+    EmbeddingsCache.clear()
+
+
+def test_embeddings_cache_eviction(monkeypatch):
+    EmbeddingsCache.clear()
+    encoded = count_encoded(monkeypatch)
+    monkeypatch.setattr(EmbeddingsCache, "max_entries", 2)
+    EmbeddingsCache.encode(EmbeddingsTypes.MINILM, ["Elves", "Zombies"])
+    EmbeddingsCache.encode(EmbeddingsTypes.MINILM, ["Elves"])
+    EmbeddingsCache.encode(EmbeddingsTypes.MINILM, ["Dwarves"])
+
+    # `Zombies` was the least recently used
+    assert EmbeddingsCache.get(EmbeddingsTypes.MINILM, "Zombies") is None
+    assert EmbeddingsCache.get(EmbeddingsTypes.MINILM, "Elves") is not None
+    assert EmbeddingsCache.stats()["entries"] == 2
+
+    # Bounded by bytes: only one vector fits
+    vector_bytes = EmbeddingsCache.stats()["bytes"] // 2
+    monkeypatch.setattr(EmbeddingsCache, "max_bytes", vector_bytes)
+    EmbeddingsCache.encode(EmbeddingsTypes.MINILM, ["Orcs"])
+    assert EmbeddingsCache.stats()["entries"] == 1 and EmbeddingsCache.stats()["bytes"] == vector_bytes
+    assert EmbeddingsCache.get(EmbeddingsTypes.MINILM, "Orcs") is not None
+    assert encoded == ["Elves", "Zombies", "Dwarves", "Orcs"]
+    EmbeddingsCache.clear()
+
+
+def test_embeddings_disk_cache(tmp_path, monkeypatch):
+    encoded = count_encoded(monkeypatch)
+    texts = ["Zombies live in the swamps", "Elves live in the forest"]
+    expected = EmbeddingsRegistry.encode(EmbeddingsTypes.MINILM, texts + ["Dwarves live in the mountains"])
+    encoded.clear()
+
+    cache = EmbeddingsDiskCache(EmbeddingsTypes.MINILM, str(tmp_path))
+    assert np.allclose(cache.encode(texts), expected[:2], atol=1e-5)
+    assert encoded == texts
+    assert np.allclose(cache.encode(texts[::-1]), expected[1::-1], atol=1e-5)
+    assert len(encoded) == 2
+
+    # Another instance (e.g. after restarting) reads the vectors from disk
+    reloaded = EmbeddingsDiskCache(EmbeddingsTypes.MINILM, str(tmp_path))
+    assert len(reloaded) == 2 and texts[0] in reloaded
+    assert np.allclose(reloaded.encode(texts + ["Dwarves live in the mountains"]), expected, atol=1e-5)
+    assert encoded[2:] == ["Dwarves live in the mountains"]
+
+
+def test_embeddings_disk_cache_two_writers(tmp_path):
+    texts = ["Zombies live in the swamps", "Elves live in the forest", "Dwarves live in the mountains"]
+    expected = EmbeddingsRegistry.encode(EmbeddingsTypes.MINILM, texts)
+
+    # Both are opened before any of them writes, as two processes would
+    first = EmbeddingsDiskCache(EmbeddingsTypes.MINILM, str(tmp_path))
+    second = EmbeddingsDiskCache(EmbeddingsTypes.MINILM, str(tmp_path))
+    first.encode(texts[:1])
+    second.encode(texts[1:])
+    first.encode(texts[1:2])
+
+    assert np.allclose(first.encode(texts), expected, atol=1e-5)
+    assert np.allclose(second.encode(texts), expected, atol=1e-5)
+    assert len(EmbeddingsDiskCache(EmbeddingsTypes.MINILM, str(tmp_path))) == 3
+    # The vector stored by the other writer is reused instead of being appended again
+    assert os.path.getsize(os.path.join(tmp_path, "minilm", "index.bin")) == 3 * EmbeddingsDiskCache.DIGEST_SIZE
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,343 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+import types
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import torch
+from transformers import BatchEncoding, LlamaConfig, LlamaForCausalLM
+
+from mindcraft import settings
+from mindcraft.infra.engine import local_llm
+from mindcraft.infra.engine.async_remote_vllm import AsyncRemoteVLLM
+from mindcraft.infra.engine.llm_types import LLMType
+from mindcraft.infra.engine.local_vllm import LocalVLLM
+from mindcraft.infra.engine.remote_vllm import RemoteVLLM
+
+
+class StubTokenizer:
+    """ One token per character of the prompt. Token `i` is decoded as the word `t<i>`"""
+    eos_token = "</s>"
+    eos_token_id = 2
+    vocab_size = 64
+
+    def __init__(self):
+        self.pad_token = None
+        self.padding_side = "right"
+
+    @property
+    def pad_token_id(self):
+        return self.eos_token_id if self.pad_token is not None else None
+
+    def encode(self, text: str) -> list[int]:
+        if text == "Boom":
+            raise ValueError("Unable to tokenize")
+        return [3 + ord(x) % (self.vocab_size - 3) for x in text]
+
+    def __call__(self, texts: list[str], return_tensors: str = "pt", padding: bool = False) -> BatchEncoding:
+        ids = [self.encode(x) for x in texts]
+        length = max(len(x) for x in ids)
+        input_ids, attention_mask = [], []
+        for x in ids:
+            pad = [self.eos_token_id] * (length - len(x))
+            mask = [1] * len(x)
+            input_ids.append(pad + x if self.padding_side == "left" else x + pad)
+            attention_mask.append([0] * len(pad) + mask if self.padding_side == "left" else mask + [0] * len(pad))
+        return BatchEncoding({"input_ids": torch.tensor(input_ids), "attention_mask": torch.tensor(attention_mask)})
+
+    def decode(self, ids, skip_special_tokens: bool = False, **kwargs) -> str:
+        ids = ids.tolist() if isinstance(ids, torch.Tensor) else ids
+        return "".join(f"t{x} " for x in ids if not (skip_special_tokens and x == self.eos_token_id))
+
+    def batch_decode(self, ids, **kwargs) -> list[str]:
+        return [self.decode(x, **kwargs) for x in ids]
+
+
+def tiny_llama() -> LlamaForCausalLM:
+    """ Randomly initialized 2-layer Llama, with the vocabulary of `StubTokenizer`"""
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=StubTokenizer.vocab_size, hidden_size=32, intermediate_size=64,
+                         num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=4,
+                         max_position_embeddings=256, bos_token_id=1, eos_token_id=StubTokenizer.eos_token_id,
+                         pad_token_id=StubTokenizer.eos_token_id)
+    return LlamaForCausalLM(config).eval()
+
+
+@pytest.fixture
+def tiny_local_llm(monkeypatch):
+    """ Makes `LocalLLM` load the tiny Llama and the stub tokenizer on CPU"""
+    model = tiny_llama()
+    monkeypatch.setattr(local_llm.AutoModelForCausalLM, "from_pretrained", lambda *args, **kwargs: model)
+    monkeypatch.setattr(local_llm.AutoTokenizer, "from_pretrained", lambda *args, **kwargs: StubTokenizer())
+    monkeypatch.setattr(torch.cuda, "is_available", lambda: False)
+    return model
+
+
+def greedy_answer(model: LlamaForCausalLM, prompt: str, max_tokens: int) -> str:
+    """ Answer of `generate` for a single prompt, without batching"""
+    tokenizer = StubTokenizer()
+    input_ids = tokenizer([prompt])["input_ids"]
+    with torch.inference_mode():
+        output = model.generate(input_ids, max_new_tokens=max_tokens, do_sample=False)
+    return tokenizer.decode(output[0, input_ids.shape[1]:], skip_special_tokens=True)
+
+
+class FlakyVLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests_received = 0
+    connections = set()
+
+    def do_POST(self):
+        FlakyVLLMHandler.requests_received += 1
+        FlakyVLLMHandler.connections.add(self.client_address)
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if FlakyVLLMHandler.requests_received == 1:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        words = request["prompt"].split()
+        body = b"".join(json.dumps({"choices": [{"text": f"{x} "}]}).encode() + b"\0" for x in words)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_remote_vllm_session(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyVLLMHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(settings, "FAST_INFERENCE_URL", f"http://127.0.0.1:{server.server_port}/generate")
+    try:
+        llm = RemoteVLLM(LLMType.ZEPHYR7B_AWQ, retries=2, backoff=0)
+
+        chunks = list(llm("Zombies live in the swamps", streaming=True))
+        assert chunks == ["Zombies ", "live ", "in ", "the ", "swamps "]
+        assert list(llm("Elves live in the forest")) == ["Elves live in the forest "]
+        # The 503 was retried and the connection was reused
+        assert FlakyVLLMHandler.requests_received == 3
+        assert len(FlakyVLLMHandler.connections) == 1
+        assert llm.latency_stats.stats()["count"] == 2
+        llm.close()
+    finally:
+        server.shutdown()
+
+
+class SplitChunksHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        words = request["prompt"].split()
+        body = b"".join(json.dumps({"choices": [{"text": f"{x} "}]}).encode() + b"\0" for x in words)
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        # The `\0` delimiters do not match the boundaries of the writes
+        for start in range(0, len(body), 7):
+            part = body[start:start + 7]
+            self.wfile.write(f"{len(part):x}\r\n".encode() + part + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *args):
+        pass
+
+
+def test_async_remote_vllm(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SplitChunksHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(settings, "FAST_INFERENCE_URL", f"http://127.0.0.1:{server.server_port}/generate")
+
+    async def converse():
+        llm = AsyncRemoteVLLM(LLMType.ZEPHYR7B_AWQ)
+
+        async def answer(prompt: str) -> str:
+            return "".join([x async for x in llm.agenerate(prompt)])
+
+        try:
+            streamed = [x async for x in llm.agenerate("Zombies live in the swamps", streaming=True)]
+            answers = await asyncio.gather(*[answer(f"Elf number {i}") for i in range(10)])
+            return streamed, answers
+        finally:
+            await llm.close()
+
+    try:
+        streamed, answers = asyncio.run(converse())
+        assert streamed == ["Zombies ", "live ", "in ", "the ", "swamps "]
+        assert answers == [f"Elf number {i} " for i in range(10)]
+    finally:
+        server.shutdown()
+
+
+def test_async_remote_vllm_several_event_loops(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SplitChunksHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(settings, "FAST_INFERENCE_URL", f"http://127.0.0.1:{server.server_port}/generate")
+    llm = AsyncRemoteVLLM(LLMType.ZEPHYR7B_AWQ)
+
+    async def answer(prompt: str) -> str:
+        return "".join([x async for x in llm.agenerate(prompt)])
+
+    async def answer_and_close(prompt: str) -> str:
+        try:
+            return await answer(prompt)
+        finally:
+            await llm.close()
+
+    try:
+        # Every `asyncio.run` creates a new event loop, which needs its own session
+        assert asyncio.run(answer("Zombies live in the swamps")) == "Zombies live in the swamps "
+        assert asyncio.run(answer_and_close("Elves live in the forest")) == "Elves live in the forest "
+    finally:
+        server.shutdown()
+
+
+def test_local_llm_streaming(tiny_local_llm):
+    llm = local_llm.LocalLLM()
+    chunks = list(llm("Zombies live in the swamps", max_tokens=12, do_sample=False, streaming=True))
+
+    assert len(chunks) > 1
+    assert "".join(chunks) == greedy_answer(tiny_local_llm, "Zombies live in the swamps", 12)
+    stats = llm.latency_stats.stats()
+    assert stats["count"] == 1 and 0 < stats["ttft_mean_ms"] <= stats["total_mean_ms"]
+
+
+def test_local_llm_streaming_stops(tiny_local_llm):
+    steps = []
+    tiny_local_llm.register_forward_hook(lambda *args: steps.append(1))
+    llm = local_llm.LocalLLM()
+
+    chunks = llm("Zombies live in the swamps", max_tokens=200, do_sample=False, streaming=True)
+    next(chunks)
+    chunks.close()
+    time.sleep(0.5)
+    # The worker stopped generating once the consumer stopped reading
+    generated = len(steps)
+    time.sleep(0.1)
+    assert len(steps) == generated < 200
+
+
+class StubSamplingParams:
+    def __init__(self, temperature: float = 1.0, max_tokens: int = 16):
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+
+
+class StubVLLM:
+    """ Stands for `vllm.LLM`: answers with the sampling parameters of each prompt, finishing them in reverse order"""
+    def __init__(self, **kwargs):
+        self.calls = []
+        self._request_id = 0
+
+    def generate(self, prompts: list[str], sampling_params, use_tqdm: bool = True) -> list:
+        self.calls.append((prompts, sampling_params))
+        params = sampling_params if isinstance(sampling_params, list) else [sampling_params] * len(prompts)
+        outputs = []
+        for prompt, x in zip(prompts, params):
+            text = f"{prompt}: temperature={x.temperature} max_tokens={x.max_tokens}"
+            outputs.append(types.SimpleNamespace(request_id=str(self._request_id),
+                                                 outputs=[types.SimpleNamespace(text=text)]))
+            self._request_id += 1
+        return outputs[::-1]
+
+
+def test_local_vllm_generate_many(monkeypatch):
+    monkeypatch.setitem(sys.modules, "vllm", types.SimpleNamespace(LLM=StubVLLM, SamplingParams=StubSamplingParams))
+    llm = LocalVLLM(LLMType.ZEPHYR7B_AWQ, temperature=0.8)
+    prompts = ["Zombies", "Elves", "Dwarves"]
+
+    # The same settings for all the prompts: a single SamplingParams
+    assert llm.generate_many(prompts, 10, False) == [f"{x}: temperature=0 max_tokens=10" for x in prompts]
+    assert isinstance(llm.llm.calls[-1][1], StubSamplingParams)
+
+    # Settings per prompt: one SamplingParams each, and the answers in the order of the prompts
+    answers = llm.generate_many(prompts, [10, 20, 10], [True, False, True])
+    assert answers == ["Zombies: temperature=0.8 max_tokens=10",
+                       "Elves: temperature=0 max_tokens=20",
+                       "Dwarves: temperature=0.8 max_tokens=10"]
+    assert len(llm.llm.calls[-1][1]) == 3
+    assert llm.generate_many([]) == [] and len(llm.llm.calls) == 2
+    with pytest.raises(Exception):
+        llm.generate_many(prompts, [10, 20])
+
+
+def test_batch_scheduler(tiny_local_llm):
+    llm = local_llm.LocalLLM(batching=True, max_batch_size=3, max_wait=0.05)
+    prompts = [("Zombies live in the swamps", 12), ("Elves", 5), ("Dwarves live in the mountains", 20),
+               ("Orcs", 8), ("Where do the hobbits live?", 15)]
+    answers = [None] * len(prompts)
+
+    def answer(i: int):
+        # Staggered submissions: some prompts join a batch which is already decoding
+        time.sleep(0.02 * i)
+        prompt, max_tokens = prompts[i]
+        answers[i] = "".join(llm.scheduler.submit(prompt, max_tokens, do_sample=False))
+
+    threads = [threading.Thread(target=answer, args=(i,)) for i in range(len(prompts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    try:
+        assert answers == [greedy_answer(tiny_local_llm, prompt, max_tokens) for prompt, max_tokens in prompts]
+        assert llm.latency_stats.stats()["count"] == len(prompts)
+    finally:
+        llm.scheduler.close()
+
+
+def test_batch_scheduler_cancel(tiny_local_llm):
+    llm = local_llm.LocalLLM(batching=True, max_batch_size=2, max_wait=0)
+    steps = []
+    step = llm.scheduler._step
+    llm.scheduler._step = lambda: (steps.append(len(llm.scheduler._active)), step())[1]
+    try:
+        # The tokenizer shared with the LLM is not modified
+        assert (llm.tokenizer.padding_side, llm.tokenizer.pad_token) == ("right", None)
+
+        chunks = llm.scheduler.submit("Elves", 200, do_sample=False)
+        next(chunks)
+        chunks.close()
+        deadline = time.perf_counter() + 10
+        while len(llm.scheduler._active) > 0 and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        # The sequence left the batch long before generating its 200 tokens, and the scheduler keeps serving
+        assert len(llm.scheduler._active) == 0 and len(steps) < 100
+        assert "".join(llm.scheduler.submit("Elves", 5, do_sample=False)) == greedy_answer(tiny_local_llm, "Elves", 5)
+    finally:
+        llm.scheduler.close()
+
+
+def test_batch_scheduler_error(tiny_local_llm):
+    llm = local_llm.LocalLLM(batching=True, max_batch_size=4, max_wait=0.2)
+    errors = []
+
+    def answer(prompt: str):
+        try:
+            "".join(llm.scheduler.submit(prompt, 10, do_sample=False))
+        except ValueError as e:
+            errors.append(e)
+
+    # Both prompts are prefilled together, and the tokenizer fails with the second one
+    threads = [threading.Thread(target=answer, args=(x,)) for x in ["Zombies live in the swamps", "Boom"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    try:
+        assert len(errors) == 2
+        # The scheduler keeps serving new requests
+        assert "".join(llm.scheduler.submit("Elves", 5, do_sample=False)) == greedy_answer(tiny_local_llm, "Elves", 5)
+    finally:
+        llm.scheduler.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
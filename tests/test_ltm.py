@@ -0,0 +1,93 @@
+import unittest
+
+from mindcraft.features.mood import Mood
+from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
+from mindcraft.infra.vectorstore.stores_types import StoresTypes
+from mindcraft.memory import ltm
+from mindcraft.memory.eviction_policy_types import EvictionPolicyTypes
+from mindcraft.memory.ltm import LTM
+
+
+def test_ltm_last_interactions(tmp_path, monkeypatch):
+    monkeypatch.setattr(ltm, "LTM_DATA_PATH", str(tmp_path))
+    memory = LTM(StoresTypes.NUMPY, "Sigmur", EmbeddingsTypes.MINILM, recent_capacity=3)
+    for i in range(5):
+        memory.memorize(f"Memory number {i}", Mood("angry"))
+
+    assert memory.get_last_interactions(2).documents == ["Memory number 3", "Memory number 4"]
+
+    memory = LTM(StoresTypes.NUMPY, "Sigmur", EmbeddingsTypes.MINILM, recent_capacity=3)
+    assert memory.get_last_interactions(3).documents == ["Memory number 2", "Memory number 3", "Memory number 4"]
+    assert len(memory.get_last_interactions(5).documents) == 5
+
+
+def test_ltm_consolidation(tmp_path, monkeypatch):
+    monkeypatch.setattr(ltm, "LTM_DATA_PATH", str(tmp_path))
+    memory = LTM(StoresTypes.NUMPY, "Sigmur", EmbeddingsTypes.MINILM)
+    for text in ["I hate zombies", "I hate zombies", "Elves live in the forest", "Dwarves live in the mountains"]:
+        memory.memorize(text, Mood("angry"))
+    memory.remember_about("Where do dwarves live?", num_results=1, min_similarity=2)
+
+    report = memory.consolidate(capacity=2, policy=EvictionPolicyTypes.FREQUENCY)
+
+    assert (report.merged, report.evicted, report.kept) == (1, 1, 2)
+    assert memory.get_last_interactions(5).documents == ["Elves live in the forest", "Dwarves live in the mountains"]
+
+
+def test_ltm_hot_tier(tmp_path, monkeypatch):
+    monkeypatch.setattr(ltm, "LTM_DATA_PATH", str(tmp_path))
+    memory = LTM(StoresTypes.NUMPY, "Sigmur", EmbeddingsTypes.MINILM, hot_capacity=2, hot_distance=2,
+                 promote_after=1)
+    for text in ["I hate zombies", "Elves live in the forest", "Dwarves live in the mountains"]:
+        memory.memorize(text, Mood("angry"))
+
+    stats = memory.tier_stats()
+    assert (stats["hot_size"], stats["promotions"], stats["demotions"]) == (2, 3, 1)
+
+    # Answered by the hot tier alone
+    assert len(memory.remember_about("Where do dwarves live?", num_results=2, min_similarity=4)) == 2
+    assert memory.tier_stats()["hot_answered"] == 1
+
+    # The hot tier has not enough memories: the store is queried and the results of both tiers are merged
+    result = memory.remember_about("Where do dwarves live?", num_results=3, min_similarity=4)
+    assert sorted(result.ids) == sorted(set(result.ids))
+    assert len(result) == 3
+    assert list(result.distances) == sorted(result.distances)
+    stats = memory.tier_stats()
+    assert (stats["queries"], stats["cold_results"]) == (2, 1)
+    assert stats["hot_hit_rate"] == 0.5
+
+
+def test_ltm_hot_tier_merges_with_the_store_by_default(tmp_path, monkeypatch):
+    monkeypatch.setattr(ltm, "LTM_DATA_PATH", str(tmp_path))
+    memory = LTM(StoresTypes.NUMPY, "Sigmur", EmbeddingsTypes.MINILM, hot_capacity=1, promote_after=1)
+    for text in ["Dwarves live in the mountains", "I hate zombies"]:
+        memory.memorize(text, Mood("angry"))
+
+    # Only the last memory is in the hot tier, but the closest one is in the store
+    assert memory.remember_about("Where do dwarves live?", num_results=1, min_similarity=4).documents == \
+           ["Dwarves live in the mountains"]
+    assert memory.tier_stats()["hot_answered"] == 0
+
+    memory = LTM(StoresTypes.NUMPY, "Sigmur", EmbeddingsTypes.MINILM, recent_capacity=1, hot_capacity=1)
+    assert memory.get_last_interactions(1).documents == ["I hate zombies"]
+    assert memory.tier_stats()["hot_size"] == 1
+
+
+def test_ltm_write_behind(tmp_path, monkeypatch):
+    monkeypatch.setattr(ltm, "LTM_DATA_PATH", str(tmp_path))
+    memory = LTM(StoresTypes.NUMPY, "Sigmur", EmbeddingsTypes.MINILM, write_behind=True)
+    for text in ["I hate zombies", "Elves live in the forest", "Dwarves live in the mountains"]:
+        memory.memorize(text, Mood("angry"))
+
+    assert memory.get_last_interactions(1).documents == ["Dwarves live in the mountains"]
+    assert len(memory.remember_about("Where do dwarves live?", num_results=3, min_similarity=4)) == 3
+    memory.memorize("Orcs live in the caves", Mood("angry"))
+    memory.close()
+
+    memory = LTM(StoresTypes.NUMPY, "Sigmur", EmbeddingsTypes.MINILM)
+    assert memory.get_last_interactions(1).documents == ["Orcs live in the caves"]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,388 @@
+import gc
+import os
+import threading
+import time
+import unittest
+import weakref
+
+import numpy as np
+import pytest
+from chromadb.api.client import SharedSystemClient
+
+from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
+from mindcraft.infra.vectorstore.chroma import Chroma
+from mindcraft.infra.vectorstore.chroma_client_pool import ChromaClientPool
+from mindcraft.infra.vectorstore.hnsw_store import HNSWStore
+from mindcraft.infra.vectorstore.id_allocator import IdAllocator
+from mindcraft.infra.vectorstore.numpy_store import NumpyStore
+from mindcraft.infra.vectorstore.query_cache import QueryCache
+from mindcraft.infra.vectorstore.search_results import SearchResult
+from mindcraft.infra.vectorstore.text_index import TextIndex
+from mindcraft.infra.vectorstore.visibility_index import VisibilityIndex
+from mindcraft.infra.vectorstore.write_behind_queue import WriteBehindQueue
+
+
+def test_numpy_store_query(tmp_path):
+    store = NumpyStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM)
+    store.add_many(["Zombies live in the swamps", "Elves live in the forest"],
+                   [{"known_by": "all"}, {"known_by": "Sigmur||Galadriel"}],
+                   ["0", "1"])
+
+    assert store.count() == 2
+    assert store.query("Where do elves live?", 1, ["all", "Galadriel"], min_similarity=2).documents == \
+           ["Elves live in the forest"]
+    assert "Elves live in the forest" not in store.query("Where do elves live?", 2, ["all"],
+                                                         min_similarity=2).documents
+
+
+def test_query_many(tmp_path):
+    for store in [NumpyStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM),
+                  Chroma(str(tmp_path), "Galadriel", EmbeddingsTypes.MINILM)]:
+        store.add_many(["Zombies live in the swamps", "Elves live in the forest", "Dwarves live in the mountains"],
+                       [{"known_by": "all"}, {"known_by": "Galadriel"}, {"known_by": "all"}],
+                       ["0", "1", "2"])
+        texts = ["Where do elves live?", "Where do zombies live?", "Where do dwarves live?"]
+        known_by = [["all", "Galadriel"], ["all"], ["all"]]
+
+        results = store.query_many(texts, known_by, 2, min_similarity=2)
+        assert [x.documents for x in results] == \
+               [store.query(text, 2, k, min_similarity=2).documents for text, k in zip(texts, known_by)]
+        assert "Elves live in the forest" not in results[1].documents
+
+
+def test_search_result_threshold():
+    result = SearchResult.from_arrays(["a", "b", "c"], [0.1, 0.9, 0.5], ["0", "1", "2"], min_similarity=0.5)
+
+    assert result.documents == ["a", "c"]
+    assert result.ids == ["0", "2"]
+    assert result.scores.dtype == np.float32
+    assert len(SearchResult()) == 0
+
+    # `distances` is still a list
+    assert isinstance(result.distances, list) and result.distances == pytest.approx([0.1, 0.5])
+    result.distances.append(0.7)
+    assert len(result.scores) == 3
+    if result.distances:
+        assert result.threshold(0.5).distances == pytest.approx([0.1, 0.5])
+
+
+def test_numpy_store_persistence(tmp_path):
+    store = NumpyStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM)
+    for i in range(5):
+        store.add_to_collection(f"Memory number {i}", {"mood": "angry"}, str(i))
+    store.delete(["0"])
+
+    store = NumpyStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM)
+    assert store.count() == 4
+    assert store.get_last(2).documents == ["Memory number 3", "Memory number 4"]
+    assert len(store.get(where={"mood": "angry"}).documents) == 4
+
+
+def test_numpy_store_recovers_from_an_interrupted_write(tmp_path):
+    store = NumpyStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM)
+    store.add_to_collection("Memory number 0", {"mood": "angry"}, "0")
+    with open(os.path.join(store.path, NumpyStore.METADATA_FILE), "a", encoding="utf-8") as f:
+        f.write('{"id": "1", "document": "Memory num')
+
+    # The truncated entry is dropped, and the next ones are readable after reloading
+    store = NumpyStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM)
+    assert store.get_last(5).documents == ["Memory number 0"]
+    store.add_to_collection("Memory number 2", {"mood": "angry"}, "2")
+    store = NumpyStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM)
+    assert store.get_last(5).documents == ["Memory number 0", "Memory number 2"]
+
+
+CREATURES = ["zombies", "elves", "dwarves", "orcs", "goblins", "trolls", "dragons", "giants", "wolves", "bears",
+             "spiders", "bats", "rats", "snakes", "eagles", "owls", "ravens", "horses", "unicorns", "griffins",
+             "wyverns", "krakens", "mermaids", "vampires", "werewolves", "ghosts", "skeletons", "witches", "wizards",
+             "knights", "pirates", "ogres", "gnomes", "fairies", "centaurs"]
+
+
+class KnnQuerySpy:
+    """ Delegates to an hnswlib index, recording the `filter` of every query"""
+    def __init__(self, index):
+        self.index = index
+        self.filters = []
+
+    def knn_query(self, *args, **kwargs):
+        self.filters.append(kwargs.get("filter"))
+        return self.index.knn_query(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+
+def test_hnsw_store(tmp_path):
+    # A small `ef`, so that the graph is used instead of the exact search
+    store = HNSWStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM, ef=4)
+    store.add_many([f"The {x} live in the swamps" for x in CREATURES[:30]],
+                   [{"known_by": "all" if i % 2 == 0 else "Sigmur"} for i in range(30)],
+                   [str(i) for i in range(30)])
+    store._index = KnnQuerySpy(store._index)
+
+    assert store.query("Where do the dragons live?", 1, ["all"], min_similarity=4).documents == \
+           ["The dragons live in the swamps"]
+    assert "The orcs live in the swamps" not in store.query("Where do the orcs live?", 3, ["all"],
+                                                            min_similarity=4).documents
+    assert store.query("Where do the orcs live?", 1, ["all", "Sigmur"], min_similarity=4).documents == \
+           ["The orcs live in the swamps"]
+    # Only the queries restricted to some of the rows filter the nodes of the graph
+    assert [x is None for x in store._index.filters] == [False, False, True]
+
+    store.delete(["6"])
+    assert "The dragons live in the swamps" not in store.query("Where do the dragons live?", 3, ["all", "Sigmur"],
+                                                              min_similarity=4).documents
+
+
+def test_hnsw_store_reload(tmp_path):
+    store = HNSWStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM, ef=4)
+    store.add_many([f"The {x} live in the swamps" for x in CREATURES[:30]], [{"known_by": "all"}] * 30,
+                   [str(i) for i in range(30)])
+    store.save_index()
+    # Stored after the graph was saved
+    store.add_many([f"The {x} live in the swamps" for x in CREATURES[30:]], [{"known_by": "all"}] * 5,
+                   [str(i) for i in range(30, 35)])
+
+    store = HNSWStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM, ef=4)
+    assert store.count() == 35
+    assert store._index.get_current_count() == 35
+    assert store.query("Where do the gnomes live?", 1, ["all"], min_similarity=4).documents == \
+           ["The gnomes live in the swamps"]
+
+    report = store.benchmark([f"Where do the {x} live?" for x in CREATURES], num_results=3)
+    assert 0 <= report["recall"] <= 1
+    assert set(report) == {"recall", "hnsw_mean_ms", "hnsw_p95_ms", "exact_mean_ms", "exact_p95_ms"}
+
+
+def test_hnsw_store_reload_after_an_interrupted_write(tmp_path):
+    store = HNSWStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM, ef=1)
+    store.add_many([f"The {x} live in the swamps" for x in CREATURES[:6]], [{"known_by": "all"}] * 6,
+                   [str(i) for i in range(6)])
+    store.save_index()
+    # The last two entries of the metadata are lost, while the graph still has their nodes
+    metadata_path = os.path.join(store.path, NumpyStore.METADATA_FILE)
+    with open(metadata_path, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    with open(metadata_path, "w", encoding="utf-8") as f:
+        f.writelines(lines[:4])
+
+    for _ in range(2):
+        store = HNSWStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM, ef=1)
+        assert store.count() == 4
+        # The graph is used, and the nodes of the lost rows are not returned
+        for x in CREATURES[4:6]:
+            assert set(store.query(f"Where do the {x} live?", 2, ["all"], min_similarity=4).ids) < {"0", "1", "2", "3"}
+        store.save_index()
+
+    # The rows are written again, replacing the deleted nodes
+    store.add_to_collection("The goblins live in the swamps", {"known_by": "all"}, "4")
+    assert store.query("Where do the goblins live?", 1, ["all"], min_similarity=4).ids == ["4"]
+
+
+def test_lore_known_by_several_characters(tmp_path):
+    store = Chroma(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM)
+    store.add_to_collection("Elves live in the forest", {"known_by": "Sigmur||Galadriel"}, "0")
+    store.add_to_collection("Zombies live in the swamps", {"known_by": "Sigmur"}, "1")
+
+    assert store.query("Where do elves live?", 2, ["Galadriel"], min_similarity=2).documents == \
+           ["Elves live in the forest"]
+    assert len(store.query("Where do elves live?", 2, ["Sigmur"], min_similarity=2).documents) == 2
+    assert len(store.query("Where do elves live?", 2, ["Aragorn"], min_similarity=2).documents) == 0
+
+
+def test_visibility_index_ids_are_shared(tmp_path):
+    path = str(tmp_path / "Sigmur.characters.json")
+    # Several indexes on the same file, as several processes or stores would have
+    indexes = [VisibilityIndex(path) for _ in range(8)]
+    barrier = threading.Barrier(len(indexes))
+    names = [[f"Character {i} {j}" for j in range(10)] for i in range(len(indexes))]
+
+    def register(i: int):
+        barrier.wait()
+        for name in names[i]:
+            indexes[i].character_id(name)
+
+    threads = [threading.Thread(target=register, args=(i,)) for i in range(len(indexes))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    reloaded = VisibilityIndex(path)
+    ids = {name: reloaded.character_id(name, create=False) for x in names for name in x}
+    assert sorted(ids.values()) == list(range(len(ids)))
+    for index, x in zip(indexes, names):
+        assert [index.character_id(name, create=False) for name in x] == [ids[name] for name in x]
+
+
+def test_text_index_candidates():
+    index = TextIndex()
+    index.add_many(["0", "1", "2"],
+                   ["Zombies live in the swamps", "The elves left, said Galadriel", "Elves live in the forest"],
+                   ["all", "all", "Galadriel"])
+
+    # The first and last tokens may be partial, the ones in between are whole tokens
+    assert index.candidates("lves left, said Gala") == ["1"]
+    assert index.candidates("ves") == ["1", "2"]
+    assert index.candidates("ves li", ["all"]) == []
+    assert index.candidates("ves li", ["Galadriel"]) == ["2"]
+    assert index.candidates("ombies live in") == ["0"]
+    assert index.candidates("zombies liv in") == []
+
+    # Tokens which are not in any document anymore are forgotten
+    index.delete(["0"])
+    assert index.candidates("ombie") == []
+    assert not any("zombies" in x for x in index._grams.values())
+
+
+def test_id_allocator(tmp_path):
+    store = NumpyStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM)
+    store.add_many(["Memory number 0", "Memory number 1"], None, ["0", "1"])
+
+    first = IdAllocator.for_store(store, block_size=3)
+    second = IdAllocator.for_store(store, block_size=3)
+    ids = [first.next_id(), second.next_id(), first.next_id(), first.next_id(), first.next_id()]
+
+    assert ids == ["2", "5", "3", "4", "8"]
+    assert IdAllocator.for_store(NumpyStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM)).next_id() == "11"
+
+
+def test_chroma_clients_are_pooled(tmp_path):
+    sigmur = Chroma(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM)
+    galadriel = Chroma(str(tmp_path), "Galadriel", EmbeddingsTypes.MINILM)
+    sigmur.add_to_collection("Zombies live in the swamps", {"mood": "angry"}, "0")
+
+    assert sigmur.client is galadriel.client
+    assert sigmur.count() == 1
+    assert galadriel.count() == 0
+
+    assert ChromaClientPool.references(str(tmp_path)) == 2
+
+    # Clients in use are never closed
+    ChromaClientPool.close_idle()
+    assert sigmur.client is galadriel.client
+
+    sigmur.shut_down()
+    galadriel.shut_down()
+    ChromaClientPool.close_idle()
+    assert ChromaClientPool.references(str(tmp_path)) == 0
+    assert sigmur.count() == 1
+    assert ChromaClientPool.references(str(tmp_path)) == 1
+
+
+def test_chroma_pool_only_evicts_idle_clients(tmp_path, monkeypatch):
+    monkeypatch.setattr(ChromaClientPool, "max_clients", 1)
+    sigmur = Chroma(str(tmp_path / "ltm"), "Sigmur", EmbeddingsTypes.MINILM)
+    galadriel = Chroma(str(tmp_path / "styles"), "Galadriel", EmbeddingsTypes.MINILM)
+    sigmur.add_to_collection("Zombies live in the swamps", {"mood": "angry"}, "0")
+    galadriel.add_to_collection("Elves live in the forest", {"mood": "happy"}, "0")
+
+    # Both are in use, so the pool grows beyond `max_clients`
+    assert ChromaClientPool.stats()["open"] >= 2
+    closed = ChromaClientPool.stats()["closed"]
+    sigmur.shut_down()
+    assert ChromaClientPool.stats()["closed"] > closed
+    assert galadriel.count() == 1 and sigmur.count() == 1
+    galadriel.shut_down()
+    sigmur.shut_down()
+
+
+def test_chroma_pool_stops_closed_clients(tmp_path):
+    sigmur = Chroma(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM)
+    sigmur.add_to_collection("Zombies live in the swamps", {"mood": "angry"}, "0")
+    system = sigmur.client._system
+    sigmur.shut_down()
+    ChromaClientPool.close_idle()
+
+    # The ChromaDB system is stopped and not cached anymore
+    assert system not in SharedSystemClient._identifer_to_system.values()
+    assert not system._running
+    # Opening the client again starts a new system, with the data persisted on disk
+    assert sigmur.count() == 1
+    assert sigmur.client._system is not system
+    sigmur.shut_down()
+
+
+def test_write_behind_queue(tmp_path):
+    store = NumpyStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM)
+    written = []
+    queue = WriteBehindQueue(store, batch_size=10, max_delay=60, on_write=lambda ids, texts, e: written.extend(ids))
+    queue.put("Zombies live in the swamps", {"mood": "angry"}, "0")
+    queue.put("Elves live in the forest", {"mood": "happy"}, "1")
+    assert (len(queue), store.count()) == (2, 0)
+
+    queue.flush()
+    assert (len(queue), store.count(), written) == (0, 2, ["0", "1"])
+    assert store.get(where={"mood": "happy"}).documents == ["Elves live in the forest"]
+
+    queue.put("Dwarves live in the mountains", None, "2")
+    queue.close()
+    assert store.count() == 3
+
+
+def test_write_behind_queue_is_garbage_collected(tmp_path):
+    store = NumpyStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM)
+    queue = WriteBehindQueue(store, batch_size=10, max_delay=60)
+    queue.put("Zombies live in the swamps", {"mood": "angry"}, "0")
+    thread, ref = queue._thread, weakref.ref(queue)
+
+    # Nothing but the caller holds the queue: its pending writes are stored and its thread ends
+    del queue
+    gc.collect()
+    assert ref() is None
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert store.count() == 1
+
+
+def test_write_behind_queue_errors(tmp_path, monkeypatch, caplog):
+    store = NumpyStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM)
+
+    def fail(*args, **kwargs):
+        raise ValueError("Disk full")
+
+    monkeypatch.setattr(store, "add_embeddings", fail)
+    queue = WriteBehindQueue(store, batch_size=1, max_delay=60)
+    queue.put("Zombies live in the swamps", {"mood": "angry"}, "0")
+    deadline = time.perf_counter() + 10
+    while queue._error is None and time.perf_counter() < deadline:
+        time.sleep(0.01)
+
+    # The failure is logged when it happens, and raised by `close`
+    assert "Disk full" in caplog.text
+    with pytest.raises(ValueError):
+        queue.close()
+
+
+def test_query_cache(tmp_path):
+    store = NumpyStore(str(tmp_path), "Sigmur", EmbeddingsTypes.MINILM)
+    store.add_many(["Zombies live in the swamps", "Elves live in the forest"],
+                   [{"known_by": "Sigmur"}, {"known_by": "Sigmur"}],
+                   ["0", "1"])
+
+    first = store.query("Where do elves live?", 2, ["Sigmur"], min_similarity=4)
+    assert store.query("Where do elves live?", 2, ["Sigmur"], min_similarity=4) == first
+    assert store.get(where={"known_by": "Sigmur"}, limit=5) == store.get(where={"known_by": "Sigmur"}, limit=5)
+    stats = QueryCache.stats(store.path)
+    assert (stats["hits"], stats["misses"], stats["hit_ratio"]) == (2, 2, 0.5)
+
+    # Every hit is a copy: modifying a result does not change the cached one
+    result = store.query("Where do elves live?", 2, ["Sigmur"], min_similarity=4)
+    result.documents.append("Orcs live in the caves")
+    result.distances.clear()
+    result.ids[0] = "42"
+    assert store.query("Where do elves live?", 2, ["Sigmur"], min_similarity=4) == first
+    result = store.get(where={"known_by": "Sigmur"}, limit=5)
+    result.metadatas[0].clear()
+    assert store.get(where={"known_by": "Sigmur"}, limit=5).metadatas[0] == {"known_by": "Sigmur"}
+    assert store.query_many(["Where do elves live?"], [["Sigmur"]], 2, min_similarity=4) == [first]
+
+    store.add_to_collection("Elves also live in the valleys", {"known_by": "Sigmur"}, "2")
+    assert len(store.query("Where do elves live?", 3, ["Sigmur"], min_similarity=4)) == 3
+    assert len(store.query("Where do elves live?", 2, ["Sigmur"], min_similarity=4)) == 2
+    store.delete(["0"])
+    assert len(store.get(where={"known_by": "Sigmur"}, limit=5)) == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+
+from mindcraft.features.mood import Mood
+from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
+from mindcraft.infra.vectorstore.stores_types import StoresTypes
+from mindcraft.styles import conversational_style
+from mindcraft.styles.conversational_style import ConversationalStyle
+
+
+def test_styles_are_bounded_and_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(conversational_style, "STYLES_DATA_PATH", str(tmp_path))
+    style = ConversationalStyle(StoresTypes.NUMPY, "Sigmur", EmbeddingsTypes.MINILM, num_examples=2)
+    for text in ["I will kill you", "Get out of my sight", "The swamps are full of zombies"]:
+        style.memorize(text, Mood("angry"))
+
+    # The newest examples
+    assert style.retrieve_interaction_by_mood("angry").documents == ["Get out of my sight",
+                                                                     "The swamps are full of zombies"]
+    assert style.retrieve_interaction_by_mood("angry", "Tell me about the zombies of the swamps").documents[0] == \
+           "The swamps are full of zombies"
+
+    style.memorize("Leave me alone", Mood("sad"))
+    assert style.retrieve_interaction_by_mood("sad").documents == ["Leave me alone"]
+
+
+def test_styles_pool_keeps_the_newest_examples(tmp_path, monkeypatch):
+    monkeypatch.setattr(conversational_style, "STYLES_DATA_PATH", str(tmp_path))
+    for store_type, character_id in [(StoresTypes.NUMPY, "Sigmur"), (StoresTypes.CHROMA, "Galadriel")]:
+        style = ConversationalStyle(store_type, character_id, EmbeddingsTypes.MINILM, num_examples=1, pool_size=3)
+        for i in range(5):
+            style.memorize(f"I have killed {i} orcs today", Mood("angry"))
+        style.retrieve_interaction_by_mood("angry")
+        style.memorize("The swamps are full of zombies", Mood("angry"))
+
+        assert style.retrieve_interaction_by_mood("angry", "Tell me about the zombies of the swamps").documents == \
+               ["The swamps are full of zombies"]
+        assert style.retrieve_interaction_by_mood("angry").documents == ["The swamps are full of zombies"]
+
+
+def test_styles_return_the_newest_examples(tmp_path, monkeypatch):
+    monkeypatch.setattr(conversational_style, "STYLES_DATA_PATH", str(tmp_path))
+    style = ConversationalStyle(StoresTypes.NUMPY, "Sigmur", EmbeddingsTypes.MINILM, num_examples=2, pool_size=10)
+    for i in range(5):
+        style.memorize(f"I have killed {i} orcs today", Mood("angry"))
+    assert style.retrieve_interaction_by_mood("angry").ids == ["3", "4"]
+
+    # Newly memorized examples show up right away
+    style.memorize("The swamps are full of zombies", Mood("angry"))
+    assert style.retrieve_interaction_by_mood("angry").documents == ["I have killed 4 orcs today",
+                                                                     "The swamps are full of zombies"]
+
+
+if __name__ == '__main__':
+    unittest.main()
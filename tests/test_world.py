@@ -1,11 +1,16 @@
+import asyncio
 import os
 import tempfile
+import time
 import unittest
 
+from mindcraft.infra.engine.llm import LLM
 from mindcraft.infra.splitters.text_splitters_types import TextSplitterTypes
 from mindcraft.infra.engine.llm_types import LLMType
+from mindcraft.infra.vectorstore.query_cache import QueryCache
 from mindcraft.infra.vectorstore.stores_types import StoresTypes
 from mindcraft.infra.embeddings.embeddings_types import EmbeddingsTypes
+from mindcraft.infra.embeddings.embeddings_registry import EmbeddingsRegistry
 from mindcraft.lore.world import World
 
 import pytest
@@ -119,5 +124,226 @@ def test_import_book_to_world_and_get_lore(temp_file):
     assert len(search_result.documents) > 0
 
 
+def test_embeddings_model_is_loaded_once(tmp_path):
+    world = World(world_name="TheAgeOfSigmur",
+                  embeddings=EmbeddingsTypes.MINILM,
+                  store_type=StoresTypes.CHROMA,
+                  llm_type=LLMType.ZEPHYR7B_AWQ,
+                  path=tmp_path,
+                  recreate=True)
+
+    world.add_lore("Sigmur is the king of the zombies", "0", ["all"])
+    world.get_lore("Who is Sigmur?", min_similarity=0.5)
+    loads = EmbeddingsRegistry.stats()["loads"]
+
+    world.add_lore("Zombies live in the swamps", "1", ["all"])
+    world.get_lore("Where do zombies live?", min_similarity=0.5)
+
+    assert EmbeddingsRegistry.is_loaded(EmbeddingsTypes.MINILM)
+    assert EmbeddingsRegistry.stats()["loads"] == loads
+
+
+def test_add_lore_many(tmp_path):
+    world = World(world_name="TheAgeOfSigmur",
+                  embeddings=EmbeddingsTypes.MINILM,
+                  store_type=StoresTypes.CHROMA,
+                  llm_type=LLMType.ZEPHYR7B_AWQ,
+                  path=tmp_path,
+                  recreate=True)
+
+    lore = [f"Zombie number {i} lives in the swamps" for i in range(10)]
+    world.add_lore_many(lore, [str(i) for i in range(10)], ["all"], batch_size=3)
+
+    assert world.store.count() == 10
+
+
+def test_get_lore_exact_match_and_hybrid(tmp_path):
+    world = World(world_name="TheAgeOfSigmur",
+                  embeddings=EmbeddingsTypes.MINILM,
+                  store_type=StoresTypes.CHROMA,
+                  llm_type=LLMType.ZEPHYR7B_AWQ,
+                  path=tmp_path,
+                  recreate=True)
+
+    world.add_lore_many(["Zombies live in the swamps", "The elves left, said Galadriel"], ["0", "1"], ["all"])
+    world.add_lore("Sigmur hides the sword of Elendil", "2", ["Sigmur"])
+
+    assert world.get_lore("elves", exact_match="said Galadriel", min_similarity=2).documents == \
+           ["The elves left, said Galadriel"]
+    assert len(world.get_lore("sword", exact_match="Elendil", min_similarity=2).documents) == 0
+    assert world.search_lore("Elendil", num_results=1, known_by="Sigmur", min_similarity=2).ids == ["2"]
+
+    # Substrings of the lore match, as with ChromaDB `$contains`
+    assert world.get_lore("elves", exact_match="lves left, said Gala", min_similarity=2).ids == ["1"]
+    assert world.get_lore("zombies", exact_match="Zombies live in the swamp", min_similarity=2).ids == ["0"]
+    assert len(world.get_lore("zombies", exact_match="zombies live", min_similarity=2).ids) == 0
+    # Lore added after the text index was built
+    world.add_lore("The elves sail to Valinor", "3", ["all"])
+    assert world.get_lore("elves", exact_match="Valinor", min_similarity=2).ids == ["3"]
+
+    # Repeated literal lookups are cached until the lore changes
+    hits = QueryCache.stats(world.store.path)["hits"]
+    assert world.get_lore("elves", exact_match="Valinor", min_similarity=2).ids == ["3"]
+    assert QueryCache.stats(world.store.path)["hits"] == hits + 1
+    world.add_lore("Galadriel sails to Valinor", "4", ["all"])
+    assert sorted(world.get_lore("elves", exact_match="Valinor", min_similarity=2).ids) == ["3", "4"]
+
+
+def test_export_and_load_snapshot(tmp_path):
+    world = World(world_name="TheAgeOfSigmur",
+                  embeddings=EmbeddingsTypes.MINILM,
+                  store_type=StoresTypes.CHROMA,
+                  llm_type=LLMType.ZEPHYR7B_AWQ,
+                  path=tmp_path,
+                  recreate=True)
+    world.add_lore_many(["Zombies live in the swamps", "Elves live in the forest"], ["0", "1"], ["all"])
+    world.add_lore("Sigmur hides the sword of Elendil", "2", ["Sigmur"])
+    expected = world.get_lore("Where is the sword?", known_by="Sigmur", min_similarity=2)
+
+    snapshot = os.path.join(tmp_path, "TheAgeOfSigmur.snapshot")
+    world.export_snapshot(snapshot)
+    world = World.load_snapshot(snapshot, llm_type=LLMType.ZEPHYR7B_AWQ)
+
+    assert world.store.count() == 3
+    assert world.get_lore("Where is the sword?", known_by="Sigmur", min_similarity=2).documents == expected.documents
+    assert "Sigmur hides the sword of Elendil" not in world.get_lore("sword", min_similarity=2).documents
+    assert world.get_lore("swamps", exact_match="Zombies", min_similarity=2).ids == ["0"]
+
+
+def test_import_book_to_world_incremental(tmp_path):
+    temp_file = os.path.join(tmp_path, 'book.txt')
+
+    world = World(world_name="TheAgeOfSigmur",
+                  embeddings=EmbeddingsTypes.MINILM,
+                  store_type=StoresTypes.CHROMA,
+                  llm_type=LLMType.ZEPHYR7B_AWQ,
+                  path=tmp_path,
+                  recreate=True)
+
+    with open(temp_file, 'w') as file:
+        file.write("In the age of Sigmur, everyone in the world is a zombie! Zombies live in the swamps.")
+
+    report = world.book_to_world(book_path=temp_file,
+                                 text_splitter=TextSplitterTypes.SENTENCE_SPLITTER,
+                                 max_units=1,
+                                 overlap=0,
+                                 incremental=True)
+    assert report.added == 2
+
+    with open(temp_file, 'w') as file:
+        file.write("In the age of Sigmur, everyone in the world is a zombie! Zombies live in the mountains.")
+
+    report = world.book_to_world(book_path=temp_file,
+                                 text_splitter=TextSplitterTypes.SENTENCE_SPLITTER,
+                                 max_units=1,
+                                 overlap=0,
+                                 incremental=True)
+    assert report.added == 1
+    assert report.kept == 1
+    assert report.removed == 1
+    assert world.store.count() == 2
+
+    # A book with the same name in another folder does not replace the chunks of the first one
+    other_file = os.path.join(tmp_path, 'other', 'book.txt')
+    os.makedirs(os.path.dirname(other_file))
+    with open(other_file, 'w') as file:
+        file.write("Elves live in the forest.")
+    report = world.book_to_world(book_path=other_file,
+                                 text_splitter=TextSplitterTypes.SENTENCE_SPLITTER,
+                                 max_units=1,
+                                 overlap=0,
+                                 incremental=True)
+    assert report.added == 1
+    assert report.removed == 0
+    assert world.store.count() == 3
+
+
+def test_retrieve_answers_from_llm(tmp_path):
+    class EchoLLM(LLM):
+        def retrieve_answer(self, prompt, max_tokens=100, do_sample=True, prompt_template=None, streaming=False):
+            yield f"{prompt} "
+            yield f"{max_tokens} {do_sample}"
+
+    world = World(world_name="TheAgeOfSigmur",
+                  embeddings=EmbeddingsTypes.MINILM,
+                  store_type=StoresTypes.CHROMA,
+                  llm_type=LLMType.ZEPHYR7B_AWQ,
+                  path=tmp_path,
+                  recreate=True)
+    world.llm = EchoLLM()
+
+    assert world.retrieve_answers_from_llm(["Hi", "Bye"], [10, 20], [True, False]) == ["Hi 10 True", "Bye 20 False"]
+
+
+def test_aretrieve_answer_from_llm(tmp_path):
+    class EchoLLM(LLM):
+        def retrieve_answer(self, prompt, max_tokens=100, do_sample=True, prompt_template=None, streaming=False):
+            yield from prompt.split()
+
+    world = World(world_name="TheAgeOfSigmur",
+                  embeddings=EmbeddingsTypes.MINILM,
+                  store_type=StoresTypes.CHROMA,
+                  llm_type=LLMType.ZEPHYR7B_AWQ,
+                  path=tmp_path,
+                  recreate=True)
+    world.llm = EchoLLM()
+
+    async def answer():
+        return [x async for x in World.aretrieve_answer_from_llm("Zombies live in the swamps")]
+
+    assert asyncio.run(answer()) == ["Zombies", "live", "in", "the", "swamps"]
+
+
+def test_aretrieve_answer_from_llm_stops_the_engine(tmp_path):
+    closed = []
+
+    answers = []
+
+    def endless(prompt: str):
+        try:
+            while True:
+                time.sleep(0.01)
+                yield prompt
+        finally:
+            closed.append(prompt)
+
+    class EndlessLLM(LLM):
+        def retrieve_answer(self, prompt, max_tokens=100, do_sample=True, prompt_template=None, streaming=False):
+            # Kept alive, as the engine would, so that only closing it stops the generation
+            answers.append(endless(prompt))
+            return answers[-1]
+
+    world = World(world_name="TheAgeOfSigmur",
+                  embeddings=EmbeddingsTypes.MINILM,
+                  store_type=StoresTypes.CHROMA,
+                  llm_type=LLMType.ZEPHYR7B_AWQ,
+                  path=tmp_path,
+                  recreate=True)
+    world.llm = EndlessLLM()
+
+    async def first_chunks() -> list[str]:
+        answer = World.aretrieve_answer_from_llm("Zombies")
+        chunks = [await answer.__anext__(), await answer.__anext__()]
+        await answer.aclose()
+        return chunks
+
+    async def cancel():
+        async def consume():
+            async for _ in World.aretrieve_answer_from_llm("Elves"):
+                pass
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    # The blocking answer is closed when the consumer stops early or is cancelled
+    assert asyncio.run(first_chunks()) == ["Zombies", "Zombies"]
+    assert closed == ["Zombies"]
+    asyncio.run(cancel())
+    assert closed == ["Zombies", "Elves"]
+
+
 if __name__ == '__main__':
     unittest.main()